@@ -0,0 +1,129 @@
+"""
+File: allreduce
+"""
+
+import numpy as np
+from threading import BrokenBarrierError
+from multiprocessing import Array, Barrier, Value, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+
+class SharedAllReduce:
+    """ collective operations on float32 vectors across a fixed group of
+    processes on one machine, through a single shared memory segment.
+
+    The all-reduce is a reduce-scatter followed by an all-gather, as in a
+    ring all-reduce, except that since every process can read every other
+    process's vector directly, each of the ring's neighbour-to-neighbour
+    passes is replaced by a direct read: each rank sums one chunk of the
+    vectors of all ranks, and then every rank copies the whole result.
+    Every rank therefore ends up with exactly the same bits, regardless of
+    the order in which floating point additions happen to be performed.
+
+    Each participating process must call `open` with its rank before any
+    other operation. Every operation blocks until all ranks have called it,
+    so a rank that fails must call `abort`, after which every operation
+    raises threading.BrokenBarrierError instead of waiting for it.
+    """
+    def __init__(self, num_ranks):
+        """ Construct
+        :param num_ranks: number of participating processes
+        """
+        self.num_ranks = num_ranks
+
+        self._size = Value('l', 0, lock=False)
+        self._name = Array('c', 64, lock=False)
+        self._barrier = Barrier(num_ranks)
+
+        # participants must share our resource tracker, otherwise each of
+        # them would unlink the shared memory segment when they exit
+        resource_tracker.ensure_running()
+
+        self.rank = None
+        self._shm = None
+        self._owner = False
+
+    def open(self, rank, size):
+        """ joins the group. Rank 0 allocates the shared memory.
+        :param rank: index of the calling process in [0, num_ranks)
+        :param size: length of the vectors to be reduced
+        """
+        self.rank = rank
+        if rank == 0:
+            self._shm = SharedMemory(create=True, size=(self.num_ranks + 1) * size * 4)
+            self._owner = True
+            self._name.value = self._shm.name.encode()
+            self._size.value = size
+        self._barrier.wait()
+
+        if rank != 0:
+            if size != self._size.value:
+                raise ValueError(f"Rank {rank} has size {size} but rank 0 has {self._size.value}")
+            self._shm = SharedMemory(name=self._name.value.decode())
+
+        buffer = np.ndarray((self.num_ranks + 1, size), dtype=np.float32, buffer=self._shm.buf)
+        self._inputs, self._output = buffer[:-1], buffer[-1]
+
+        bounds = [size * r // self.num_ranks for r in range(self.num_ranks + 1)]
+        self._chunk = slice(bounds[rank], bounds[rank + 1])
+
+    def sum(self, vector) -> np.ndarray:
+        """ element-wise sum of the vectors of all ranks
+        :param vector: this rank's vector
+        :return: the sum, identical on every rank
+        """
+        self._inputs[self.rank] = vector
+        self._barrier.wait()
+
+        # reduce-scatter: this rank is responsible for one chunk of the result
+        chunk = self._chunk
+        np.sum(self._inputs[:, chunk], axis=0, out=self._output[chunk])
+        self._barrier.wait()
+
+        # all-gather. The inputs aren't read after the barrier above, and neither
+        # operation writes to the output until all ranks have reached its first
+        # barrier, by which time this copy is finished.
+        return self._output.copy()
+
+    def mean(self, vector) -> np.ndarray:
+        """ element-wise mean of the vectors of all ranks """
+        return self.sum(vector) / np.float32(self.num_ranks)
+
+    def broadcast(self, vector, root=0) -> np.ndarray:
+        """ sends the root's vector to all ranks
+        :param vector: this rank's vector, ignored unless this rank is the root
+        :param root: rank whose vector is sent
+        :return: copy of the root's vector
+        """
+        self._barrier.wait()  # the root mustn't overwrite the output before everyone has copied it
+        if self.rank == root:
+            self._output[:] = vector
+        self._barrier.wait()
+        return self._output.copy()
+
+    def abort(self):
+        """ releases every rank waiting in, or yet to call, an operation
+        with a BrokenBarrierError. May be called by any process. """
+        self._barrier.abort()
+
+    def close(self):
+        """ leaves the group. Blocks until all ranks have left so that
+        the owner doesn't destroy the shared memory while it's in use,
+        unless the group has been aborted """
+        if self._shm is None:
+            return
+        try:
+            self._barrier.wait()
+        except BrokenBarrierError:
+            pass  # every rank is on its way out
+        self._inputs = self._output = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = None
+        state['_owner'] = False
+        return state
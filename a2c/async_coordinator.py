@@ -4,59 +4,263 @@ Date: 9/21/19
 Author: Jon Deaton (jonpauldeaton@gmail.com)
 """
 
-from multiprocessing import Process, Queue, Condition, Semaphore
+import time
+import multiprocessing
+from a2c.placement import placed_target
+
+
+class RolloutQueue:
+    """ queue through which workers send (version, datum) pairs to the learner.
+    If the queue has a capacity, workers block when it is full, and the time
+    that they spend blocked is recorded.
+    """
+    def __init__(self, capacity=0, context=None):
+        """ Construct
+        :param capacity: maximum number of items in the queue, or 0 for unbounded
+        :param context: multiprocessing context of the workers
+        """
+        context = context or multiprocessing.get_context()
+        self.capacity = capacity
+        self._queue = context.Queue(maxsize=capacity)
+        self._num_put = context.Value('l', 0)
+        self._wait_time = context.Value('d', 0.0)
+
+    def put(self, item):
+        """ adds an item, blocking while the queue is full """
+        start = time.time()
+        self._queue.put(item)
+        with self._wait_time.get_lock():
+            self._wait_time.value += time.time() - start
+        with self._num_put.get_lock():
+            self._num_put.value += 1
+
+    def get(self, timeout=None):
+        """ removes an item, blocking while the queue is empty
+        :param timeout: seconds to wait for an item before raising queue.Empty,
+        or None to wait indefinitely
+        """
+        return self._queue.get(timeout=timeout)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    @property
+    def num_put(self):
+        """ total number of items that workers have added """
+        return self._num_put.value
+
+    @property
+    def wait_time(self):
+        """ total seconds that workers have spent blocked on a full queue """
+        return self._wait_time.value
+
+
+class WorkerSignal:
+    """ tells a worker process when to begin and when to retire. A retired
+    worker finishes and sends the datum that it's working on before exiting,
+    so that nothing it holds (e.g. a roll-out slot) is leaked.
+    """
+    def __init__(self, context=None):
+        context = context or multiprocessing.get_context()
+        self._start = context.Semaphore(0)
+        self._active = context.Value('b', 1, lock=False)
+
+    def wait(self):
+        """ blocks until the worker is signalled to begin """
+        self._start.acquire()
+
+    def start(self):
+        """ signals the worker to begin """
+        self._start.release()
+
+    def retire(self):
+        """ signals the worker to exit after its current datum """
+        self._active.value = 0
+
+    @property
+    def active(self):
+        """ whether the worker should produce another datum """
+        return bool(self._active.value)
 
 
 class AsyncCoordinator:
     """ manages a collection of worker processes that
     produce data to be consumed by the client of this class.
     """
-    def __init__(self, num_workers, worker_target, args):
+    def __init__(self, num_workers, worker_target, args, inference_server=None,
+                 queue_capacity=0, max_staleness=None, rollout_slots=None, max_workers=None,
+                 placement=None, context=None):
         """ Construct
         :param num_workers: the number of worker processes
         :param worker_target: function for each worker process to execute
         :param args: the aforementioned additional
         arguments to be passed to each worker
+        :param inference_server: optional InferenceServer which selects actions
+        for the workers. If provided, each worker is passed its own client
+        of the server as the argument following the signal.
+        :param queue_capacity: maximum number of data waiting to be popped,
+        beyond which workers block. Zero means unbounded.
+        :param max_staleness: if provided, data generated by weights more than
+        this many versions older than the learner's are dropped by `pop`.
+        Workers must put (version, datum) pairs in the queue.
+        :param rollout_slots: optional RolloutSlots into which the workers record
+        roll-outs, putting only slot indices in the queue. The client of this
+        class must `release` each popped slot, and slots of dropped data are
+        released by `pop`.
+        :param max_workers: the most workers that may be running at once after
+        `add_worker`, which bounds the worker ids. Defaults to `num_workers`.
+        The inference server must have a client for each of them.
+        :param placement: optional PlacementPolicy which pins each worker
+        process to its own cores and limits its thread pools
+        :param context: multiprocessing context with which to start the workers,
+        e.g. a forkserver with modules preloaded (see a2c.worker_context). The
+        other arguments' synchronization primitives must belong to the same context.
         """
         self.num_workers = num_workers
+        self.max_workers = max_workers or num_workers
         self.worker_target = worker_target
         self.args = args
+        self.inference_server = inference_server
+        self.queue_capacity = queue_capacity
+        self.max_staleness = max_staleness
+        self.rollout_slots = rollout_slots
+        self.placement = placement
+        self.context = context or multiprocessing.get_context()
+
+        self.num_dropped = 0
 
         self.queue = None
-        self.sema = None
-        self._workers = None
+        self._workers = None  # worker id -> (process, signal)
+        self._retiring = None  # worker id -> process, for retired workers yet to exit
+        self._started = False
 
     def open(self):
         """ creates the collection of managed worker processes """
-        self.queue = Queue()
-        self.sema = Semaphore(0)
+        self.queue = RolloutQueue(self.queue_capacity, context=self.context)
+
+        if self.inference_server is not None:
+            self.inference_server.open()
 
-        self._workers = []
+        self._workers = {}
+        self._retiring = {}
         for wid in range(self.num_workers):
-            worker = Process(target=self.worker_target,
-                             args=(wid, self.queue, self.sema) + self.args)
-            worker.start()
-            self._workers.append(worker)
+            self._spawn(wid)
 
     def close(self):
         """ destroys the worker processes """
         del self.queue
-        for worker in self._workers:
+        processes = [process for process, _ in self._workers.values()]
+        for worker in processes + list(self._retiring.values()):
             worker.terminate()
             worker.join()
 
+        if self.inference_server is not None:
+            self.inference_server.close()
+
     def start(self):
         """ signals all worker processes to begin """
-        for _ in range(self.num_workers):
-            self.sema.release()
+        self._started = True
+        for _, signal in self._workers.values():
+            signal.start()
+
+    def add_worker(self):
+        """ starts another worker process. Since this happens while the client
+        is running, perhaps with TensorFlow initialized, workers mustn't be forked
+        from it: the context must use the "forkserver" or "spawn" start method.
+        :return: the id of the new worker, or None if there
+        are already `max_workers` worker processes running
+        """
+        if self.context.get_start_method() == "fork":
+            raise RuntimeError("Workers can't be added by forking the running process. "
+                               "Use a \"forkserver\" or \"spawn\" context")
+        self._reap()
+        in_use = set(self._workers) | set(self._retiring)
+        free = [wid for wid in range(self.max_workers) if wid not in in_use]
+        if not free:
+            return None
+
+        wid = free[0]
+        self._spawn(wid)
+        self.num_workers += 1
+        return wid
+
+    def retire_worker(self):
+        """ signals the most recently added worker process to exit once it has
+        finished its current datum
+        :return: the id of the retired worker, or None if there are no workers
+        """
+        if not self._workers:
+            return None
 
-    def pop(self):
+        wid = max(self._workers)
+        process, signal = self._workers.pop(wid)
+        signal.retire()
+        self._retiring[wid] = process
+        self.num_workers -= 1
+        return wid
+
+    def _spawn(self, wid):
+        signal = WorkerSignal(context=self.context)
+        worker_args = (wid, self.queue, signal)
+        if self.inference_server is not None:
+            worker_args += (self.inference_server.client(wid), )
+
+        if self.placement is None:
+            worker = self.context.Process(target=self.worker_target,
+                                          args=worker_args + self.args)
+        else:
+            worker = self.context.Process(target=placed_target,
+                                          args=(self.placement, wid, self.worker_target) + worker_args + self.args)
+        worker.start()
+        self._workers[wid] = worker, signal
+        if self._started:
+            signal.start()
+
+    def _reap(self):
+        """ forgets retired workers which have exited, freeing their ids """
+        for wid, process in list(self._retiring.items()):
+            if not process.is_alive():
+                process.join()
+                del self._retiring[wid]
+
+    def pop(self, version=None, timeout=None):
         """ blocks until there is a datum in the queue
         produced by a worker, then removes and returns it.
+        :param version: the learner's current version of the weights, used
+        to drop data which are more than `max_staleness` versions old
+        :param timeout: seconds to wait for each datum before raising queue.Empty,
+        or None to wait indefinitely
         """
         if self.queue is None:
             raise Exception()
-        return self.queue.get()
+
+        while True:
+            item = self.queue.get(timeout=timeout)
+            if version is None or self.max_staleness is None:
+                return item
+
+            item_version, datum = item
+            if version - item_version <= self.max_staleness:
+                return item
+            self.num_dropped += 1
+            if self.rollout_slots is not None:
+                self.release(datum)
+
+    def release(self, slot):
+        """ returns a popped roll-out slot to the pool """
+        self.rollout_slots.release(slot)
+
+    def stats(self):
+        """ statistics about the flow of data from the workers
+        :return: dictionary with the current queue depth, the number of
+        data that have been dropped for being stale, and the mean seconds that
+        workers have spent blocked on a full queue per datum
+        """
+        return {
+            'queue_depth': self.queue.qsize(),
+            'dropped': self.num_dropped,
+            'worker_wait_time': self.queue.wait_time / max(self.queue.num_put, 1)
+        }
 
     def __enter__(self):
         self.open()
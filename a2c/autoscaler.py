@@ -0,0 +1,110 @@
+"""
+File: autoscaler
+"""
+
+import time
+import logging
+logger = logging.getLogger("root")
+
+
+class Autoscaler:
+    """ adjusts the number of worker processes of an AsyncCoordinator so
+    that the rate at which they produce roll-outs matches the rate at which
+    the learner can consume them.
+
+    Every `interval` learner steps the autoscaler compares the rate at
+    which workers put data in the queue over the last interval with the
+    rate that the learner could sustain, given how long its steps take
+    when it isn't waiting for data. If the workers are too slow and the
+    queue is empty, a worker is added. If the workers are too fast, or the
+    queue is full, a worker is retired. Changing the worker count by at
+    most one per interval keeps the controller from oscillating.
+    """
+    def __init__(self, coordinator, min_workers, max_workers, interval=10, tolerance=0.1):
+        """ Construct
+        :param coordinator: the AsyncCoordinator whose workers to scale
+        :param min_workers: fewest workers to keep running
+        :param max_workers: most workers to run, at most the coordinator's max_workers
+        :param interval: number of learner steps between scaling decisions
+        :param tolerance: relative difference between the production and consumption
+        rates within which the number of workers is left alone
+        """
+        self.coordinator = coordinator
+        self.min_workers = min_workers
+        self.max_workers = min(max_workers, coordinator.max_workers)
+        self.interval = interval
+        self.tolerance = tolerance
+
+        self._num_steps = 0
+        self._step_time = 0.0
+        self._num_starved = 0
+        self._window_start = None
+        self._window_puts = None
+
+        self.stats = {}
+
+    def update(self, step_time, waited=False):
+        """ records a learner step and, every `interval` steps, scales the workers
+        :param step_time: seconds the learner spent on the step, excluding waiting for data
+        :param waited: whether the learner had to wait for data
+        :return: None if no decision was made at this step, otherwise +1 if
+        a worker was added, -1 if one was retired and 0 if neither
+        """
+        if self._window_start is None:
+            self._start_window()
+
+        self._num_steps += 1
+        self._step_time += step_time
+        self._num_starved += int(waited)
+        if self._num_steps < self.interval:
+            return None
+
+        elapsed = time.time() - self._window_start
+        num_workers = self.coordinator.num_workers
+        production = (self.coordinator.queue.num_put - self._window_puts) / elapsed
+        consumption = self._num_steps / max(self._step_time, 1e-9)
+        queue_depth = self.coordinator.queue.qsize()
+        starved = self._num_starved / self._num_steps
+        capacity = self.coordinator.queue_capacity
+
+        self.stats = {
+            'workers': num_workers,
+            'production_rate': production,
+            'consumption_rate': consumption,
+            'worker_episode_time': num_workers / production if production > 0 else float('inf'),
+            'learner_step_time': 1 / consumption,
+            'starved': starved,
+        }
+
+        logger.info(f"Autoscaler: {num_workers} workers producing {production:.2f} roll-outs/s, "
+                    f"learner consuming up to {consumption:.2f}/s, queue depth {queue_depth}, "
+                    f"starved {100 * starved:.0f}% of steps")
+
+        reason = None
+        decision = 0
+        if production < consumption * (1 - self.tolerance) and queue_depth == 0:
+            if num_workers < self.max_workers:
+                decision, reason = 1, "workers are slower than the learner"
+        elif production > consumption * (1 + self.tolerance) or (capacity and queue_depth >= capacity):
+            if num_workers > self.min_workers:
+                decision, reason = -1, "workers are faster than the learner"
+
+        if decision > 0:
+            wid = self.coordinator.add_worker()
+            if wid is None:  # retired workers haven't exited yet
+                decision = 0
+            else:
+                logger.info(f"Autoscaler: added worker {wid} ({num_workers + 1} workers), {reason}")
+        elif decision < 0:
+            wid = self.coordinator.retire_worker()
+            logger.info(f"Autoscaler: retired worker {wid} ({num_workers - 1} workers), {reason}")
+
+        self._start_window()
+        return decision
+
+    def _start_window(self):
+        self._num_steps = 0
+        self._step_time = 0.0
+        self._num_starved = 0
+        self._window_start = time.time()
+        self._window_puts = self.coordinator.queue.num_put
@@ -0,0 +1,199 @@
+"""
+File: benchmark
+
+Benchmarks for the asynchronous A2C actors.
+
+    python -m a2c.benchmark inference --workers 1 2 4 8
+    python -m a2c.benchmark placement --workers 4 8 --budgets none 1x1 2x1 2x2
+    python -m a2c.benchmark startup --workers 4 --start-methods fork forkserver spawn --rollouts 3
+"""
+
+import os
+import time
+import argparse, logging
+from functools import partial
+
+from a2c.async_coordinator import AsyncCoordinator
+from a2c.inference_server import InferenceServer
+from a2c.parameter_server import SharedWeights
+from a2c.placement import PlacementPolicy
+from a2c.training import actor_target, worker_target
+from a2c.worker_context import worker_context
+
+logger = logging.getLogger("root")
+logger.propagate = False
+
+
+def benchmark_inference(get_env, to_action, hyperams, observation_shape,
+                        worker_counts, num_rollouts):
+    """ measures how many observations per second the inference server
+    answers as a function of the number of actor processes
+    :return: list of (number of workers, observations per second, mean batch size)
+    """
+    results = []
+    for num_workers in worker_counts:
+        # the server starts with randomly initialized weights
+        server = InferenceServer(num_workers, SharedWeights(), observation_shape, hyperams)
+        coordinator = AsyncCoordinator(num_workers, actor_target,
+                                       (get_env, to_action, hyperams),
+                                       inference_server=server)
+        with coordinator:
+            coordinator.start()
+            coordinator.pop()  # exclude process and model start-up
+
+            start_stats = server.stats()
+            start = time.time()
+            for _ in range(num_rollouts):
+                coordinator.pop()
+            elapsed = time.time() - start
+            stats = server.stats()
+
+        observations = stats['observations'] - start_stats['observations']
+        throughput = observations / elapsed
+        results.append((num_workers, throughput, stats['mean_batch_size']))
+        logger.info(f"{num_workers} workers: {throughput:.1f} obs/s, "
+                    f"mean batch size: {stats['mean_batch_size']:.1f}")
+
+    return results
+
+
+def benchmark_placement(get_env, to_action, hyperams, worker_counts, budgets, num_rollouts):
+    """ measures how many environment steps per second the workers take
+    under different placements of processes on cores
+    :param budgets: list of (learner cores, threads per worker) pairs, or None for no placement
+    :return: list of (number of workers, budget, steps per second)
+    """
+    results = []
+    for num_workers in worker_counts:
+        for budget in budgets:
+            placement = None
+            if budget is not None:
+                learner_cores, worker_threads = budget
+                placement = PlacementPolicy(learner_cores=learner_cores, worker_threads=worker_threads)
+
+            # the workers keep their randomly initialized weights
+            shared_weights = SharedWeights()
+            coordinator = AsyncCoordinator(num_workers, worker_target,
+                                           (get_env, shared_weights, to_action, hyperams),
+                                           placement=placement)
+            with coordinator:
+                coordinator.start()
+                coordinator.pop()  # exclude process and model start-up
+
+                steps = 0
+                start = time.time()
+                for _ in range(num_rollouts):
+                    _, rollout_batch = coordinator.pop()
+                    steps += sum(len(actions) for actions in rollout_batch[1])
+                elapsed = time.time() - start
+
+            throughput = steps / elapsed
+            results.append((num_workers, budget, throughput))
+            logger.info(f"{num_workers} workers, budget {format_budget(budget)}: {throughput:.1f} steps/s")
+
+    return results
+
+
+def benchmark_startup(get_env, to_action, hyperams, worker_counts, start_methods, num_runs):
+    """ measures the time from starting the workers to receiving their first
+    roll-out, over consecutive runs in this process as in a hyper-parameter sweep
+    :param start_methods: multiprocessing start methods with which to start the workers
+    :param num_runs: number of runs of each configuration
+    :return: list of (number of workers, start method, seconds of each run)
+    """
+    results = []
+    for num_workers in worker_counts:
+        for start_method in start_methods:
+            context = worker_context(start_method)
+            times = []
+            for _ in range(num_runs):
+                # the workers keep their randomly initialized weights
+                shared_weights = SharedWeights(context=context)
+                coordinator = AsyncCoordinator(num_workers, worker_target,
+                                               (get_env, shared_weights, to_action, hyperams),
+                                               context=context)
+                with shared_weights, coordinator:
+                    start = time.time()
+                    coordinator.start()
+                    coordinator.pop()
+                    times.append(time.time() - start)
+
+            results.append((num_workers, start_method, times))
+            logger.info(f"{num_workers} workers, {start_method}: first roll-out after "
+                        + ", ".join(f"{seconds:.2f}" for seconds in times) + " s")
+
+    return results
+
+
+def parse_budget(budget):
+    """ parses "<learner cores>x<threads per worker>" or "none" """
+    if budget == "none":
+        return None
+    learner_cores, worker_threads = budget.split("x")
+    return int(learner_cores), int(worker_threads)
+
+
+def format_budget(budget):
+    return "none" if budget is None else "%dx%d" % budget
+
+
+def main():
+    args = parse_args()
+    from a2c.train import make_environment, agario_to_action, setup_logger
+    from a2c.hyperparameters import GridEnvHyperparameters
+    setup_logger(args, logger)
+
+    hyperams = GridEnvHyperparameters()
+    hyperams.override(args)
+
+    get_env = partial(make_environment, hyperams.env_name, hyperams)
+    to_action = partial(agario_to_action, action_shape=hyperams.action_shape)
+    observation_shape = get_env().observation_space.shape
+
+    if args.benchmark == "inference":
+        results = benchmark_inference(get_env, to_action, hyperams, observation_shape,
+                                      args.workers, args.rollouts)
+        print("workers\tobs/s\tmean batch")
+        for num_workers, throughput, batch_size in results:
+            print(f"{num_workers}\t{throughput:.1f}\t{batch_size:.1f}")
+
+    elif args.benchmark == "placement":
+        budgets = [parse_budget(budget) for budget in args.budgets]
+        results = benchmark_placement(get_env, to_action, hyperams, args.workers, budgets, args.rollouts)
+        print(f"{os.cpu_count()} cores")
+        print("workers\t" + "\t".join(format_budget(budget) for budget in budgets))
+        for num_workers in args.workers:
+            row = [throughput for n, _, throughput in results if n == num_workers]
+            print(f"{num_workers}\t" + "\t".join(f"{throughput:.1f}" for throughput in row))
+
+    elif args.benchmark == "startup":
+        results = benchmark_startup(get_env, to_action, hyperams, args.workers,
+                                    args.start_methods, args.rollouts)
+        print("workers\tstart method\t" + "\t".join(f"run {run}" for run in range(args.rollouts)))
+        for num_workers, start_method, times in results:
+            print(f"{num_workers}\t{start_method}\t" + "\t".join(f"{seconds:.2f}" for seconds in times))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark asynchronous A2C")
+    parser.add_argument("benchmark", choices=["inference", "placement", "startup"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="Numbers of worker processes to benchmark")
+    parser.add_argument("--rollouts", type=int, default=8,
+                        help="Number of roll-outs to time for each configuration, "
+                             "or of runs to time for the startup benchmark")
+    parser.add_argument("--budgets", nargs="+", default=["none", "1x1", "1x2", "2x1"],
+                        help="Placements to benchmark as <learner cores>x<threads per worker>, or none")
+    parser.add_argument("--start-methods", dest="start_methods", nargs="+", default=["fork", "forkserver"],
+                        choices=["fork", "forkserver", "spawn"],
+                        help="How to start the workers in the startup benchmark")
+    parser.add_argument("--episode-length", dest="episode_length", type=int, default=128)
+    parser.add_argument("--batch-size", dest="inference_batch_size", type=int)
+    parser.add_argument("--max-wait", dest="inference_max_wait", type=float)
+    parser.add_argument('--log', dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        default="INFO", help="Logging level")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
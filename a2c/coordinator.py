@@ -8,16 +8,24 @@ Inspired by: https://github.com/MG2033/A2C
 """
 
 import logging
+import numpy as np
 from multiprocessing import Pipe, Process
 from a2c.remote_environment import worker_task, RemoteCommand
+from a2c.placement import placed_target
 
 logger = logging.getLogger()
 
 
 class Coordinator:
-    def __init__(self, get_env, num_workers):
+    def __init__(self, get_env, num_workers, placement=None):
+        """ Construct
+        :param get_env: function which makes an environment
+        :param num_workers: number of environment processes
+        :param placement: optional PlacementPolicy for the environment processes
+        """
         self.get_env = get_env
         self.num_workers = num_workers
+        self.placement = placement
 
         self.pipes = None
         self.workers = None
@@ -27,8 +35,13 @@ class Coordinator:
     def open(self):
         worker_pipes = [Pipe() for _ in range(self.num_workers)]
         self.pipes = [pipe for _, pipe in worker_pipes]
-        self.workers = [Process(target=worker_task,
-                                args=(pipe, self.get_env)) for pipe, _ in worker_pipes]
+        if self.placement is None:
+            self.workers = [Process(target=worker_task,
+                                    args=(pipe, self.get_env)) for pipe, _ in worker_pipes]
+        else:
+            self.workers = [Process(target=placed_target,
+                                    args=(self.placement, wid, worker_task, pipe, self.get_env))
+                            for wid, (pipe, _) in enumerate(worker_pipes)]
 
         for worker in self.workers:
             worker.start()
@@ -43,7 +56,7 @@ class Coordinator:
     def step(self, actions):
         actions = list(actions)
         for i in range(self.num_workers):
-            if not self.dones[i]:
+            if not self._finished(i):
                 msg = RemoteCommand.step, actions[i]
                 self.pipes[i].send(msg)
 
@@ -51,7 +64,7 @@ class Coordinator:
         rs = []
         infos = []
         for i in range(self.num_workers):
-            if not self.dones[i]:
+            if not self._finished(i):
                 o, r, done, info = self.pipes[i].recv()
                 obs.append(o)
                 rs.append(r)
@@ -64,6 +77,11 @@ class Coordinator:
 
         return obs, rs, self.dones.copy(), infos
 
+    def _finished(self, i):
+        """ whether the i'th environment is done, which for a multi-agent
+        environment means that all of its agents are done """
+        return bool(np.all(self.dones[i]))
+
     def reset(self):
         for pipe in self.pipes:
             pipe.send(RemoteCommand.reset)
@@ -97,4 +115,59 @@ class Coordinator:
         try:
             return pipe.recv()
         except EOFError:
-            return None
\ No newline at end of file
+            return None
+
+
+class MultiEnvironment:
+    """ presents the environments of a Coordinator as a single multi-agent
+    environment whose agents are the agents of all of the environments, so
+    that a single forward pass of a model selects actions for every environment.
+
+    Once an environment is done its agents keep their last observation,
+    receive zero reward and remain done until the next reset.
+    """
+    def __init__(self, coordinator: Coordinator, agents_per_env):
+        """ Construct
+        :param coordinator: open coordinator of the environment processes
+        :param agents_per_env: number of agents in each environment
+        """
+        self.coordinator = coordinator
+        self.agents_per_env = agents_per_env
+        self.num_agents = coordinator.num_workers * agents_per_env
+        self._last_obs = None
+
+    @property
+    def observation_space(self):
+        return self.coordinator.observation_space()
+
+    @property
+    def action_space(self):
+        return self.coordinator.action_space()
+
+    def reset(self):
+        self._last_obs = self.coordinator.reset()
+        return self._concat(self._last_obs)
+
+    def step(self, actions):
+        """ steps every environment which isn't yet done
+        :param actions: one action for each agent of every environment
+        """
+        n = self.agents_per_env
+        env_actions = [actions[i * n: (i + 1) * n] for i in range(self.coordinator.num_workers)]
+        obs, rewards, dones, infos = self.coordinator.step(env_actions)
+
+        for i in range(self.coordinator.num_workers):
+            if obs[i] is None:  # was already done
+                obs[i] = self._last_obs[i]
+                rewards[i] = [0] * n
+                dones[i] = [True] * n
+        self._last_obs = obs
+        return self._concat(obs), self._concat(rewards), self._concat(dones), infos
+
+    def close(self):
+        self.coordinator.close()
+
+    @staticmethod
+    def _concat(per_env):
+        """ flattens per-environment lists of per-agent items into one list """
+        return [item for env_items in per_env for item in env_items]
@@ -0,0 +1,173 @@
+"""
+File: evaluation
+"""
+
+import os
+import queue
+import numpy as np
+import multiprocessing
+
+import logging
+logger = logging.getLogger("root")
+
+
+class AsyncEvaluator:
+    """ evaluates snapshots of the learner's weights on the test
+    environment in background processes.
+
+    The learner submits a copy of its weights and carries on training. If
+    every evaluation process is already busy the snapshot is skipped rather
+    than queued, so evaluation never holds the learner back or falls
+    behind it. The results are collected by polling, and the weights that
+    scored the highest mean return so far are kept on disk.
+    """
+    def __init__(self, get_test_env, to_action, hyperams, observation_shape,
+                 best_directory=None, context=None, make_policy=None):
+        """ Construct
+        :param get_test_env: function which makes a test environment
+        :param to_action: function converting action indices to environment actions
+        :param hyperams: hyper-parameters, including the number of evaluation
+        processes and the number of episodes to average over
+        :param observation_shape: shape of a single agent's observation
+        :param best_directory: directory in which to keep the best weights, or None
+        :param context: multiprocessing context of the evaluation processes
+        :param make_policy: function of the hyper-parameters and observation shape which
+        returns the model into which to load the weights and its policy, in each
+        evaluation process. Defaults to the Keras model described by the hyper-parameters.
+        """
+        self.get_test_env = get_test_env
+        self.to_action = to_action
+        self.hyperams = hyperams
+        self.observation_shape = observation_shape
+        self.best_directory = best_directory
+        self.context = context or multiprocessing.get_context()
+        self.make_policy = make_policy
+
+        self.num_workers = hyperams.eval_workers
+        self.best_return = None
+        self.best_episode = None
+
+        self._requests = None
+        self._results = None
+        self._workers = None
+        self._pending = {}  # episode -> weights being evaluated
+
+    def open(self):
+        """ starts the evaluation processes """
+        self._requests = self.context.Queue()
+        self._results = self.context.Queue()
+        self._workers = []
+        for _ in range(self.num_workers):
+            worker = self.context.Process(target=evaluation_target,
+                                          args=(self._requests, self._results, self.get_test_env,
+                                                self.to_action, self.hyperams, self.observation_shape,
+                                                self.make_policy))
+            worker.start()
+            self._workers.append(worker)
+
+    def close(self):
+        """ stops the evaluation processes, abandoning evaluations in progress """
+        for worker in self._workers:
+            worker.terminate()
+            worker.join()
+
+    def submit(self, episode, weights):
+        """ starts evaluating a snapshot of weights unless all evaluation processes are busy
+        :param episode: the learner's episode at which the snapshot was taken
+        :param weights: list of numpy arrays (e.g. from model.get_weights())
+        :return: whether the snapshot will be evaluated
+        """
+        self._check_workers()
+        if len(self._pending) >= self.num_workers:
+            return False
+        self._pending[episode] = weights
+        self._requests.put((episode, weights))
+        return True
+
+    def poll(self):
+        """ collects the evaluations that have finished, without blocking
+        :return: list of (episode, metrics) pairs in the order they finished
+        """
+        finished = []
+        while True:
+            try:
+                episode, metrics = self._results.get_nowait()
+            except queue.Empty:
+                self._check_workers()
+                return finished
+
+            weights = self._pending.pop(episode)
+            if self.best_return is None or metrics['return'] > self.best_return:
+                self.best_return = metrics['return']
+                self.best_episode = episode
+                self._save_best(episode, weights, metrics)
+            finished.append((episode, metrics))
+
+    def _check_workers(self):
+        """ raises an error if an evaluation process has died, since the snapshot
+        it was evaluating would stay pending forever and block later snapshots """
+        for worker in self._workers:
+            if worker.exitcode is not None:
+                raise RuntimeError(f"Evaluation process {worker.pid} exited with code {worker.exitcode}")
+
+    def _save_best(self, episode, weights, metrics):
+        if self.best_directory is None:
+            return
+        os.makedirs(self.best_directory, exist_ok=True)
+
+        # written to a temporary file first so that a crash never leaves a partial copy
+        path = os.path.join(self.best_directory, "weights.npz")
+        temporary = os.path.join(self.best_directory, "weights.tmp.npz")
+        np.savez(temporary, episode=episode, **metrics,
+                 **{f"weight_{i}": w for i, w in enumerate(weights)})
+        os.replace(temporary, path)
+        logger.info(f"New best weights from episode {episode} (return {metrics['return']:.2f})")
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_best_weights(best_directory):
+    """ loads the weights kept by an AsyncEvaluator
+    :return: the list of weights and the episode from which they came
+    """
+    with np.load(os.path.join(best_directory, "weights.npz")) as data:
+        num_weights = len([key for key in data.files if key.startswith("weight_")])
+        weights = [data[f"weight_{i}"] for i in range(num_weights)]
+        return weights, int(data["episode"])
+
+
+def evaluation_target(requests, results, get_test_env, to_action, hyperams, observation_shape,
+                      make_policy=None):
+    """ the task of each evaluation process: load snapshots of weights and
+    measure their performance over `eval_episodes` test episodes """
+    # evaluation can't use GPU because TensorFlow...
+    os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    from a2c.inference_server import make_model_policy
+    from a2c.training import get_rollout, get_performance
+
+    env = get_test_env()
+    make_policy = make_policy or make_model_policy
+    model, policy = make_policy(hyperams, tuple(observation_shape))
+
+    while True:
+        episode, weights = requests.get()
+        model.set_weights(weights)
+
+        performances = []
+        for _ in range(hyperams.eval_episodes):
+            rollout = get_rollout(policy, env,
+                                  hyperams.eval_agents,
+                                  hyperams.episode_length,
+                                  to_action,
+                                  progress_bar=False)
+            reward_batch = rollout.as_batch()[2]
+            performances.append(get_performance(reward_batch, len(reward_batch[0]), hyperams))
+
+        metrics = {name: float(np.mean([p[name] for p in performances])) for name in performances[0]}
+        results.put((episode, metrics))
@@ -28,11 +28,49 @@ class HyperParameters:
         self.action_shape = None
         self.batch_size = None
 
+        # off-policy correction of stale roll-outs
+        self.vtrace = False
+        self.vtrace_rho_bar = 1.0
+        self.vtrace_c_bar = 1.0
+
         self.agents_per_env = None
         self.episode_length = None
         self.num_episodes = None
 
         self.save_frequency = 8
+        self.keep_checkpoints = 3
+
+        # background evaluation on the test environment
+        self.eval_frequency = None  # episodes between evaluations, None = never
+        self.eval_episodes = 1  # test episodes to average over
+        self.eval_workers = 1
+        self.eval_agents = 8  # agents in the test environment
+
+        # placement of processes on cores
+        self.placement = False
+        self.learner_cores = 1  # cores reserved for each learner
+        self.server_cores = 1  # cores reserved for the inference server
+        self.learner_threads = None  # defaults to learner_cores
+        self.worker_threads = 1  # cores and threads per worker
+
+        # synchronous training with all environments stepped together
+        self.multi_env = False
+        self.num_learners = 1  # data-parallel learner processes
+
+        # asynchronous training
+        self.queue_capacity = 0  # roll-outs waiting for the learner, 0 = unbounded
+        self.max_staleness = None  # drop roll-outs older than this many updates
+        self.prefetch_depth = 1  # roll-outs prepared ahead of the learner, 0 = none
+        self.start_method = None  # "fork", or "forkserver" when autoscaling, which preloads modules
+        self.shared_rollouts = False  # hand roll-outs to the learner in shared memory
+        self.autoscale = False  # vary the number of workers between min and max
+        self.min_workers = 1
+        self.max_workers = None  # defaults to the number of CPUs
+        self.autoscale_interval = 10  # learner steps between scaling decisions
+        self.ship_gradients = False
+        self.inference_server = False
+        self.inference_batch_size = 256
+        self.inference_max_wait = 0.005  # seconds
 
     def override(self, params):
         """
@@ -0,0 +1,205 @@
+"""
+File: inference_server
+"""
+
+import time
+import queue
+import numpy as np
+import multiprocessing
+from multiprocessing import Queue
+
+
+class InferenceClient:
+    """ policy used by an actor process that forwards observations to
+    the inference server and waits for the sampled actions and values.
+    Has the same interface as a2c.training.ModelPolicy.
+    """
+    def __init__(self, cid, requests, pipe):
+        self.cid = cid
+        self._requests = requests
+        self._pipe = pipe
+
+        # version of the weights that served the first request since reset
+        self.version = None
+
+    def reset(self):
+        # the served model is not recurrent, so there is no state to reset
+        self.version = None
+
+    def __call__(self, observations):
+        self._requests.put((self.cid, np.asarray(observations)))
+        actions, values, logits, version = self._pipe.recv()
+        if self.version is None:
+            self.version = version
+        return actions, values, logits
+
+
+class InferenceServer:
+    """ runs a single copy of the model in its own process and serves
+    actions to actor processes. Requests from different actors are
+    batched dynamically: once a request arrives the server waits at most
+    `max_wait` seconds for more requests, up to `max_batch_size` observations,
+    before running them all through the model in a single forward pass.
+    """
+    def __init__(self, num_clients, shared_weights, observation_shape, hyperams, context=None, placement=None,
+                 make_policy=None):
+        """ Construct
+        :param num_clients: the number of actor processes that will make requests
+        :param shared_weights: SharedWeights from which the server pulls the latest model
+        :param observation_shape: shape of a single agent's observation
+        :param hyperams: hyper-parameters describing the model and batching limits
+        :param context: multiprocessing context of the server and its clients
+        :param placement: optional PlacementPolicy which pins the server to its own
+        cores and limits its thread pools
+        :param make_policy: function of the hyper-parameters and observation shape which
+        returns the model to serve and its policy, in the server process. Defaults to
+        the Keras model described by the hyper-parameters.
+        """
+        self.context = context or multiprocessing.get_context()
+        self.num_clients = num_clients
+        self.shared_weights = shared_weights
+        self.observation_shape = observation_shape
+        self.hyperams = hyperams
+        self.placement = placement
+        self.make_policy = make_policy
+
+        self.max_batch_size = hyperams.inference_batch_size
+        self.max_wait = hyperams.inference_max_wait
+
+        self._num_observations = self.context.Value('l', 0)
+        self._num_batches = self.context.Value('l', 0)
+        self._busy_time = self.context.Value('d', 0.0)
+
+        self._requests = None
+        self._pipes = None
+        self._process = None
+        self._start_time = None
+
+    def open(self):
+        """ starts the server process """
+        if self.make_policy is None and self.hyperams.architecture != 'Basic':
+            raise ValueError(f"Inference server does not support {self.hyperams.architecture} models")
+
+        self._requests = self.context.Queue()
+        self._pipes = [self.context.Pipe() for _ in range(self.num_clients)]
+
+        server_pipes = [pipe for pipe, _ in self._pipes]
+        counters = self._num_observations, self._num_batches, self._busy_time
+        self._process = self.context.Process(target=server_target,
+                                             args=(self._requests, server_pipes, self.shared_weights,
+                                                   self.observation_shape, self.hyperams,
+                                                   self.max_batch_size, self.max_wait, counters,
+                                                   self.placement, self.make_policy))
+        self._process.start()
+        self._start_time = time.time()
+
+    def close(self, timeout=5):
+        """ stops the server process once it has answered the requests it has
+        :param timeout: seconds to wait for it before terminating it
+        """
+        self._requests.put(None)
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+
+    def client(self, cid):
+        """ makes the policy object to be used by actor number `cid` """
+        _, client_pipe = self._pipes[cid]
+        return InferenceClient(cid, self._requests, client_pipe)
+
+    def stats(self):
+        """ throughput statistics of the server since it was opened
+        :return: dictionary of observations served, observations per second, mean
+        batch size and the fraction of time that the server spent running the model
+        """
+        elapsed = time.time() - self._start_time
+        num_observations = self._num_observations.value
+        num_batches = self._num_batches.value
+        return {
+            'observations': num_observations,
+            'observations_per_second': num_observations / elapsed,
+            'mean_batch_size': num_observations / max(num_batches, 1),
+            'utilization': self._busy_time.value / elapsed
+        }
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def server_target(requests: Queue, pipes, shared_weights, observation_shape, hyperams,
+                  max_batch_size, max_wait, counters, placement=None, make_policy=None):
+    """ the task performed by the inference server process """
+    if placement is not None:
+        placement.apply_server()  # must precede TensorFlow's initialization
+
+    make_policy = make_policy or make_model_policy
+    model, policy = make_policy(hyperams, observation_shape)
+    serve(requests, pipes, shared_weights, model, policy, max_batch_size, max_wait, counters)
+
+
+def make_model_policy(hyperams, observation_shape):
+    """ builds the model to be served and the policy which samples actions from it """
+    from a2c.eager_models import make_model
+    from a2c.training import ModelPolicy, initialize_weights
+
+    model = make_model(hyperams.architecture,
+                       hyperams.encoder_class,
+                       (None,) + observation_shape,
+                       hyperams.action_shape)
+    initialize_weights(model, observation_shape)
+    return model, ModelPolicy(model)
+
+
+def serve(requests: Queue, pipes, shared_weights, model, policy, max_batch_size, max_wait, counters):
+    """ answers batches of requests with the latest weights until a None request arrives
+    :param model: the model into which the weights are pulled
+    :param policy: maps a batch of observations to actions, values and logits
+    """
+    num_observations, num_batches, busy_time = counters
+
+    weights_version = 0
+    stopping = False
+    while not stopping:
+        request = requests.get()
+        if request is None: break
+        batch = [request]
+        batch_size = len(request[1])
+
+        # collect more requests until the batch is full or we've waited too long
+        deadline = time.time() + max_wait
+        while batch_size < max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0: break
+            try:
+                request = requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                stopping = True  # after answering the requests we already have
+                break
+            batch.append(request)
+            batch_size += len(request[1])
+
+        start = time.time()
+        weights_version = shared_weights.pull(model, weights_version)
+
+        observations = np.concatenate([obs for _, obs in batch])
+        actions, values, logits = policy(observations)
+
+        i = 0
+        for cid, obs in batch:
+            n = len(obs)
+            pipes[cid].send((actions[i:i + n], values[i:i + n], logits[i:i + n], weights_version))
+            i += n
+
+        with num_observations.get_lock():
+            num_observations.value += batch_size
+        with num_batches.get_lock():
+            num_batches.value += 1
+        with busy_time.get_lock():
+            busy_time.value += time.time() - start
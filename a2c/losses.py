@@ -17,7 +17,7 @@ def get_loss_variables(rollout_batch, gamma, recurrent):
     :param recurrent: boolean, whether the model to be trained is recurrent or not
     :return: set of variables to pass to a2c_loss
     """
-    observations, actions, rewards, values, dones = rollout_batch
+    observations, actions, rewards, values, dones, _ = rollout_batch
 
     returns = make_returns_batch(rewards, gamma)
 
@@ -28,6 +28,49 @@ def get_loss_variables(rollout_batch, gamma, recurrent):
     val_batch = np.array(values)
     adv_batch = ret_batch - val_batch
 
+    return mask_loss_variables(obs_batch, act_batch, adv_batch, ret_batch, dones, recurrent)
+
+
+def get_vtrace_loss_variables(model, rollout_batch, gamma, recurrent, rho_bar=1.0, c_bar=1.0):
+    """ like get_loss_variables, but corrects for the roll-out having been generated
+    by an older version of the policy than `model` using V-trace targets
+    (Espeholt et al. 2018, "IMPALA"). The returned advantages are the
+    importance-weighted policy gradient advantages, and the returns
+    are the V-trace value targets.
+    :param model: the current (target) policy
+    :param rollout_batch: batched roll-out returned from rollout.as_batch(),
+    which must include the behaviour policy's logits
+    :param rho_bar: truncation level of the importance weights in the targets
+    :param c_bar: truncation level of the "trace-cutting" importance weights
+    :return: set of variables to pass to a2c_loss
+    """
+    observations, actions, rewards, _, dones, behaviour_logits = rollout_batch
+
+    obs_batch = np.array(observations)
+    act_batch = np.array(actions)
+    num_agents, num_steps = act_batch.shape[:2]
+
+    # evaluate the roll-out under the current policy
+    if recurrent:
+        target_logits, target_values = model(obs_batch)
+    else:
+        flat_obs = obs_batch.reshape((-1, ) + obs_batch.shape[2:])
+        target_logits, target_values = model(flat_obs)
+    target_logits = np.reshape(target_logits, (num_agents, num_steps, -1))
+    target_values = np.reshape(target_values, (num_agents, num_steps))
+
+    ret_batch = np.zeros((num_agents, num_steps), dtype=np.float32)
+    adv_batch = np.zeros((num_agents, num_steps), dtype=np.float32)
+    for i in range(num_agents):
+        ret_batch[i], adv_batch[i] = vtrace_targets(behaviour_logits[i], target_logits[i],
+                                                    act_batch[i], rewards[i], target_values[i],
+                                                    gamma, rho_bar=rho_bar, c_bar=c_bar)
+
+    return mask_loss_variables(obs_batch, act_batch, adv_batch, ret_batch, dones, recurrent)
+
+
+def mask_loss_variables(obs_batch, act_batch, adv_batch, ret_batch, dones, recurrent):
+    """ removes or masks out the steps at which agents were already done """
     not_done_mask = np.logical_not(np.array(dones))
     if recurrent:  # for recurrent models, we pass the
         mask = tf.convert_to_tensor(not_done_mask, dtype=tf.bool)
@@ -42,6 +85,45 @@ def get_loss_variables(rollout_batch, gamma, recurrent):
     return loss_vars
 
 
+def log_softmax(logits: np.ndarray) -> np.ndarray:
+    """ numerically stable log of the softmax over the last axis """
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+
+def vtrace_targets(behaviour_logits, target_logits, actions, rewards, values,
+                   gamma, rho_bar=1.0, c_bar=1.0):
+    """ Calculates V-trace targets for a single trajectory
+    :param behaviour_logits: (T, num_actions) logits of the policy that chose the actions
+    :param target_logits: (T, num_actions) logits of the policy being learned
+    :param actions: (T,) indices of the actions taken
+    :param rewards: (T,) rewards received
+    :param values: (T,) value estimates of the policy being learned
+    :param gamma: discount factor 0 < gamma < 1
+    :return: tuple of the (T,) V-trace value targets and policy gradient advantages
+    """
+    steps = np.arange(len(actions))
+    actions = np.asarray(actions, dtype=np.int64)
+    log_rhos = log_softmax(target_logits)[steps, actions] - log_softmax(behaviour_logits)[steps, actions]
+    rhos = np.exp(log_rhos)
+    clipped_rhos = np.minimum(rho_bar, rhos)
+    cs = np.minimum(c_bar, rhos)
+
+    # the trajectory is not bootstrapped past its end, as in make_returns
+    next_values = np.append(values[1:], 0.0)
+    deltas = clipped_rhos * (rewards + gamma * next_values - values)
+
+    vs_minus_values = np.zeros_like(deltas)
+    acc = 0.0
+    for t in reversed(range(len(deltas))):
+        vs_minus_values[t] = acc = deltas[t] + gamma * cs[t] * acc
+    vs = values + vs_minus_values
+
+    next_vs = np.append(vs[1:], 0.0)
+    pg_advantages = clipped_rhos * (rewards + gamma * next_vs - values)
+    return vs, pg_advantages
+
+
 def div_round_up(n, d):
     """ ceil(n / d) """
     return int((n + d - 1) / d)
@@ -111,6 +193,34 @@ def actor_loss(actions, advantages, action_logits, entropy_weight):
     return tf.reduce_mean(policy_loss - entropy_weight * entropy_loss)
 
 
+def flatten_gradients(grads, variables) -> np.ndarray:
+    """ concatenates a list of gradient tensors into a single float32 vector
+    :param grads: gradients of `variables`, as returned by GradientTape.gradient
+    :param variables: the variables, whose shapes give the zeros of any None gradients
+    """
+    def dense(grad, var):
+        if grad is None:  # the variable wasn't used in computing the loss
+            return np.zeros(var.shape, dtype=np.float32)
+        if isinstance(grad, tf.IndexedSlices):  # e.g. from an embedding lookup
+            grad = tf.convert_to_tensor(grad)
+        return grad.numpy()
+
+    return np.concatenate([np.ravel(dense(g, v)) for g, v in zip(grads, variables)]).astype(np.float32)
+
+
+def unflatten_gradients(flat_grads: np.ndarray, variables) -> List[np.ndarray]:
+    """ splits a vector made by flatten_gradients back into
+    arrays with the same shapes as `variables`
+    """
+    grads = []
+    offset = 0
+    for var in variables:
+        size = int(np.prod(var.shape))
+        grads.append(flat_grads[offset:offset + size].reshape(var.shape))
+        offset += size
+    return grads
+
+
 def a2c_loss(model, entropy_weight, observations, mask, actions, advantages, returns):
     """ computes the A2C loss and gradients of the given model w.r.t. that loss """
     with tf.GradientTape() as tape:
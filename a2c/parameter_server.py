@@ -0,0 +1,115 @@
+"""
+File: parameter_server
+"""
+
+import os
+import numpy as np
+import multiprocessing
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+
+class SharedWeights:
+    """ a versioned store of model weights in shared memory.
+
+    The learner publishes its weights as a single flat float32 buffer
+    along with a sequence number, and workers copy the buffer into their
+    own model only when the sequence number has changed since they last
+    pulled. The shared memory segment is allocated by the first call to
+    `publish` so that the size of the model need not be known until then.
+    """
+    def __init__(self, context=None):
+        """ Construct
+        :param context: multiprocessing context of the processes that will share the weights
+        """
+        context = context or multiprocessing.get_context()
+        self._version = context.Value('l', 0, lock=False)
+        self._size = context.Value('l', 0, lock=False)
+        self._name = context.Array('c', 64, lock=False)
+        self._lock = context.Lock()
+
+        # workers must share our resource tracker, otherwise each of them
+        # would unlink the shared memory segment when they exit
+        resource_tracker.ensure_running()
+
+        self._shm = None  # this process's mapping of the segment
+        self._owner = None  # pid of the process that created the segment, the only one to destroy it
+        self._shapes = None
+
+    @property
+    def version(self):
+        """ the sequence number of the most recently published weights """
+        return self._version.value
+
+    def publish(self, weights):
+        """ copies weights into shared memory and increments the version
+        :param weights: list of numpy arrays (e.g. from model.get_weights())
+        :return: the new version number
+        """
+        flat = np.concatenate([np.ravel(w) for w in weights]).astype(np.float32)
+        with self._lock:
+            if self._shm is None:
+                self._shm = SharedMemory(create=True, size=flat.nbytes)
+                self._owner = os.getpid()
+                self._name.value = self._shm.name.encode()
+                self._size.value = flat.size
+            elif flat.size != self._size.value:
+                raise ValueError(f"Expected {self._size.value} parameters, got {flat.size}")
+
+            self._buffer()[:] = flat
+            self._version.value += 1
+            return self._version.value
+
+    def pull(self, model, version=0):
+        """ copies the published weights into `model` if they are newer than `version`
+        :param model: Keras model to copy the weights into
+        :param version: version of the weights that `model` currently holds
+        :return: version of the weights that `model` holds after the pull
+        """
+        if self._version.value == version:
+            return version
+
+        if self._shapes is None:
+            self._shapes = [w.shape for w in model.get_weights()]
+
+        with self._lock:
+            buffer = self._buffer()
+            weights = []
+            offset = 0
+            for shape in self._shapes:
+                size = int(np.prod(shape))
+                weights.append(buffer[offset:offset + size].reshape(shape).copy())
+                offset += size
+            version = self._version.value
+
+        model.set_weights(weights)
+        return version
+
+    def close(self):
+        """ releases this process's mapping and, if this process
+        created the shared memory segment, destroys it.
+        """
+        if self._shm is None:
+            return
+        self._shm.close()
+        if self._owner == os.getpid():
+            self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _buffer(self):
+        """ the flat shared parameter buffer, attaching to it if necessary """
+        if self._shm is None:
+            self._shm = SharedMemory(name=self._name.value.decode())
+        return np.ndarray((self._size.value, ), dtype=np.float32, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = None
+        state['_owner'] = None
+        return state
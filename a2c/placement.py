@@ -0,0 +1,116 @@
+"""
+File: placement
+"""
+
+import os
+import logging
+logger = logging.getLogger("root")
+
+# environment variables read by the thread pools of the numerical libraries
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+
+
+class PlacementPolicy:
+    """ assigns CPU cores and thread budgets to the learner and worker processes.
+
+    The first `learner_cores` of the available cores are reserved for the
+    learner, or for each of the learners in data-parallel training, and the
+    next `server_cores` for the inference server, if there is one. The rest
+    are divided between the workers, `worker_threads` cores each. Workers are
+    given disjoint sets of cores while there are enough of them, after which
+    the sets wrap around. Each process limits the thread pools of TensorFlow
+    and of NumPy's BLAS to its number of cores, so that processes don't each
+    start a thread per core of the machine and fight over them.
+    """
+    def __init__(self, learner_cores=1, worker_threads=1, learner_threads=None, cores=None,
+                 num_learners=1, server_cores=0):
+        """ Construct
+        :param learner_cores: number of cores reserved for each learner
+        :param worker_threads: number of cores, and intra-op threads, given to each worker
+        :param learner_threads: intra-op threads of each learner, defaults to `learner_cores`
+        :param cores: the cores to use, defaults to those this process may run on
+        :param num_learners: number of data-parallel learner processes
+        :param server_cores: number of cores reserved for the inference server. If
+        zero, the server shares the first learner's cores
+        """
+        if cores is None:
+            cores = sorted(os.sched_getaffinity(0))
+        self.cores = list(cores)
+        self.learner_threads = learner_threads or learner_cores
+        self.worker_threads = worker_threads
+
+        self._learner_cores = [self.cores[rank * learner_cores: (rank + 1) * learner_cores]
+                               for rank in range(num_learners)]
+        reserved = num_learners * learner_cores
+        self._server_cores = self.cores[reserved: reserved + server_cores]
+        self._worker_cores = self.cores[reserved + server_cores:]
+
+        if any(not cores for cores in self._learner_cores):
+            logger.warning(f"Only {len(self.cores)} cores: learners will share cores")
+            self._learner_cores = [cores or self.cores[:learner_cores] for cores in self._learner_cores]
+        if server_cores and not self._server_cores:
+            logger.warning(f"Only {len(self.cores)} cores: the inference server will share the learner's cores")
+        if not self._worker_cores:
+            logger.warning(f"Only {len(self.cores)} cores: workers will share the learner's cores")
+            self._worker_cores = self.cores
+
+    def learner_cores(self, rank=0):
+        """ the cores on which the given learner runs """
+        return list(self._learner_cores[rank])
+
+    def server_cores(self):
+        """ the cores on which the inference server runs """
+        return list(self._server_cores) or self.learner_cores()
+
+    def worker_cores(self, wid):
+        """ the cores on which the given worker runs """
+        n = len(self._worker_cores)
+        start = wid * self.worker_threads
+        return sorted({self._worker_cores[(start + i) % n] for i in range(min(self.worker_threads, n))})
+
+    def apply_learner(self, rank=0):
+        """ places the calling process as the given learner """
+        self._apply(self.learner_cores(rank), self.learner_threads)
+
+    def apply_server(self):
+        """ places the calling process as the inference server """
+        if self._server_cores:
+            self._apply(self.server_cores(), len(self._server_cores))
+        else:
+            self._apply(self.server_cores(), self.learner_threads)
+
+    def apply_worker(self, wid):
+        """ places the calling process as the given worker """
+        self._apply(self.worker_cores(wid), self.worker_threads)
+
+    def _apply(self, cores, num_threads):
+        """ pins the calling process to `cores` and limits its thread pools.
+        TensorFlow reads its thread counts when it's initialized so this must be
+        called before TensorFlow is used in the calling process. """
+        os.sched_setaffinity(0, cores)
+
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(num_threads)
+        os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+        for variable in THREAD_VARIABLES:
+            os.environ[variable] = str(num_threads)
+
+        # BLAS reads the environment variables when NumPy is imported, which it already is
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(limits=num_threads)
+        except ImportError:
+            pass
+
+        logger.debug(f"Process {os.getpid()} placed on cores {cores} with {num_threads} threads")
+
+    def describe(self):
+        learners = ", ".join(str(cores) for cores in self._learner_cores)
+        server = f"server: cores {self._server_cores}, " if self._server_cores else ""
+        return f"learners: cores {learners} x {self.learner_threads} threads, {server}" \
+               f"workers: {len(self._worker_cores)} cores, {self.worker_threads} threads each"
+
+
+def placed_target(placement: PlacementPolicy, wid, target, *args):
+    """ runs the target of a worker process after placing the process """
+    placement.apply_worker(wid)
+    target(*args)
@@ -0,0 +1,114 @@
+"""
+File: prefetch
+"""
+
+import time
+import queue
+import threading
+
+
+class Prefetcher:
+    """ calls a function repeatedly on a background thread, keeping up to
+    `depth` of its results ready so that the consumer of those results
+    doesn't have to wait for them to be prepared.
+
+    At most `depth` items are held at once, counting both those that are
+    ready and the one being prepared, so with a depth of 1 the next item is
+    prepared while the consumer works on the current one.
+
+    The background thread checks every `poll_interval` seconds whether it
+    has been stopped, so `fetch` should give up waiting by raising
+    queue.Empty now and then, after which it's called again.
+    """
+    poll_interval = 0.1
+
+    def __init__(self, prepare, depth=1, fetch=None):
+        """ Construct
+        :param prepare: function that produces the next item. It takes no
+        arguments, or the result of `fetch` if that is given
+        :param depth: maximum number of items to hold ahead of the consumer
+        :param fetch: optional function of no arguments which waits for the data
+        to prepare the next item from, raising queue.Empty if it times out.
+        Time spent in it isn't counted as preparation
+        """
+        self.prepare = prepare
+        self.fetch = fetch
+        self.depth = depth
+
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(depth)  # released as the consumer takes items
+        self._thread = None
+        self._stopped = threading.Event()
+
+        self.num_items = 0  # items consumed
+        self.num_prepared = 0
+        self.prepare_time = 0.0  # seconds spent preparing items, excluding fetching
+        self.wait_time = 0.0  # seconds the consumer spent waiting for items
+
+    def start(self):
+        """ starts preparing items on the background thread """
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ stops preparing items and waits for the background thread to
+        finish. Any item in preparation is discarded """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get(self):
+        """ blocks until an item is ready, then removes and returns it """
+        start = time.time()
+        item, error = self._queue.get()
+        self._slots.release()
+        self.wait_time += time.time() - start
+        self.num_items += 1
+        if error is not None:
+            raise error
+        return item
+
+    def stats(self):
+        """ per-item timing of the items consumed so far
+        :return: dictionary with the mean seconds spent preparing each
+        item, the mean seconds that the consumer waited for each item, and the
+        mean seconds of preparation that were hidden behind the consumer's work
+        """
+        prepare_time = self.prepare_time / max(self.num_prepared, 1)
+        wait_time = self.wait_time / max(self.num_items, 1)
+        return {
+            'prepare_time': prepare_time,
+            'wait_time': wait_time,
+            'hidden_time': max(prepare_time - wait_time, 0.0)
+        }
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if not self._slots.acquire(timeout=self.poll_interval):
+                continue
+            try:
+                if self.fetch is None:
+                    start = time.time()
+                    item = self.prepare()
+                else:
+                    try:
+                        data = self.fetch()
+                    except queue.Empty:
+                        self._slots.release()
+                        continue
+                    start = time.time()
+                    item = self.prepare(data)
+            except Exception as e:
+                self._queue.put((None, e))
+                return
+            self.prepare_time += time.time() - start
+            self.num_prepared += 1
+            self._queue.put((item, None))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -23,13 +23,19 @@ class RemoteEnvironment:
     def __init__(self, get_env):
         self.get_env = get_env
 
-    def __enter__(self):
+    def open(self):
         worker_pipe, self._pipe = Pipe()
         self._worker = Process(target=worker_task, args=(worker_pipe, self.get_env))
         self._worker.start()
+
+    def __enter__(self):
+        self.open()
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
         self._pipe.send(RemoteCommand.close)
         self._worker.join()
 
@@ -39,7 +45,15 @@ class RemoteEnvironment:
         return obs
 
     def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        """ starts a step of the environment, without waiting for it to finish """
         self._pipe.send((RemoteCommand.step, actions))
+
+    def step_wait(self):
+        """ waits for the step started by `step_async` to finish and returns its result """
         obs, rewards, dones, info = self._pipe.recv()
         return obs, rewards, dones, info
 
@@ -28,16 +28,23 @@ class Rollout:
         self.rewards = []
         self.values = []
         self.dones = []
+        self.logits = []
         self._batch = None
 
-    def record(self, observations, actions, rewards, values, dones):
+        # version of the weights of the policy that generated the roll-out
+        self.version = None
+
+    def record(self, observations, actions, rewards, values, dones, logits=None):
         """ records a single step forwards for each agent in in the batch
+        :param logits: the behaviour policy's action logits, needed for off-policy correction
         """
         self.observations.append(observations)
         self.actions.append(actions)
         self.rewards.append(rewards)
         self.values.append(values)
         self.dones.append(dones)
+        if logits is not None:
+            self.logits.append(logits)
 
     def as_batch(self, cache=True):
         """ returns the roll-out as a batch of experiences (optinoally cache) """
@@ -56,4 +63,5 @@ class Rollout:
         reward_batch = transpose_batch(self.rewards)
         value_batch  = transpose_batch(self.values)
         dones        = transpose_batch(self.dones)
-        return obs_batch, action_batch, reward_batch, value_batch, dones
+        logits_batch = transpose_batch(self.logits)
+        return obs_batch, action_batch, reward_batch, value_batch, dones, logits_batch
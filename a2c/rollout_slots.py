@@ -0,0 +1,152 @@
+"""
+File: rollout_slots
+"""
+
+import ctypes
+import numpy as np
+import multiprocessing
+from utils import is_not_None
+
+# fields filled in by the environment, in which dead agents' entries are None
+MASKED_FIELDS = ('observations', 'rewards', 'dones')
+
+
+class RolloutSlots:
+    """ a fixed pool of preallocated shared-memory roll-out buffers.
+
+    Each slot holds a complete roll-out as a set of (T, N, ...) arrays
+    (time steps by agents) plus its length, so that a worker can record
+    an episode directly into shared memory and hand it to the learner by
+    passing only the slot index through the queue. The learner reads the
+    roll-out in place and releases the slot back to the pool when done.
+    """
+    def __init__(self, num_slots, episode_length, num_agents, observation_shape,
+                 num_actions, observation_dtype=np.float32, context=None):
+        """ Construct
+        :param num_slots: number of roll-outs that may be in flight at once
+        :param episode_length: maximum number of steps in a roll-out (T)
+        :param num_agents: number of agents in each environment (N)
+        :param observation_shape: shape of a single agent's observation
+        :param num_actions: number of discrete actions (size of the logits)
+        :param observation_dtype: data type of the observations
+        :param context: multiprocessing context of the workers
+        """
+        context = context or multiprocessing.get_context()
+        self.num_slots = num_slots
+        self.episode_length = episode_length
+        self.num_agents = num_agents
+
+        steps = (num_slots, episode_length, num_agents)
+        self._specs = {
+            'observations': (steps + tuple(observation_shape), np.dtype(observation_dtype)),
+            'actions':      (steps, np.dtype(np.int64)),
+            'rewards':      (steps, np.dtype(np.float32)),
+            'values':       (steps, np.dtype(np.float32)),
+            'dones':        (steps, np.dtype(np.bool_)),
+            'logits':       (steps + (num_actions, ), np.dtype(np.float32)),
+            'lengths':      ((num_slots, ), np.dtype(np.int64)),
+        }
+        for name in MASKED_FIELDS:
+            self._specs[f'{name}_present'] = (steps, np.dtype(np.bool_))
+        self._buffers = {name: context.RawArray(ctypes.c_byte, int(np.prod(shape)) * dtype.itemsize)
+                         for name, (shape, dtype) in self._specs.items()}
+        self._arrays = None
+
+        self._free = context.Queue()
+        for slot in range(num_slots):
+            self._free.put(slot)
+
+    @property
+    def nbytes(self):
+        """ total size of the shared buffers """
+        return sum(len(buffer) for buffer in self._buffers.values())
+
+    def acquire(self):
+        """ blocks until a slot is free, then reserves and returns its index """
+        slot = self._free.get()
+        self.arrays['lengths'][slot] = 0
+        return slot
+
+    def release(self, slot):
+        """ returns a slot to the pool once the learner is done with it """
+        self._free.put(slot)
+
+    def rollout(self, slot):
+        """ makes a roll-out recorder which writes into the given slot """
+        return SlotRollout(self, slot)
+
+    def as_batch(self, slot):
+        """ the roll-out in the given slot in the same format as Rollout.as_batch().
+        Each element is an (N, T, ...) view into shared memory, so the slot
+        must not be released until the batch is no longer needed. If any
+        entries are missing, each element is instead a list of every agent's
+        present entries, as Rollout.as_batch() gives.
+        """
+        arrays = self.arrays
+        length = arrays['lengths'][slot]
+
+        def agent_major(name):
+            field = arrays[name][slot, :length].swapaxes(0, 1)
+            if name not in MASKED_FIELDS:
+                return field
+            present = arrays[f'{name}_present'][slot, :length].swapaxes(0, 1)
+            if present.all():
+                return field
+            return [agent[mask] for agent, mask in zip(field, present)]
+
+        return agent_major('observations'), agent_major('actions'), agent_major('rewards'), \
+               agent_major('values'), agent_major('dones'), agent_major('logits')
+
+    @property
+    def arrays(self):
+        """ numpy views of the shared buffers """
+        if self._arrays is None:
+            self._arrays = {name: np.frombuffer(self._buffers[name], dtype=dtype).reshape(shape)
+                            for name, (shape, dtype) in self._specs.items()}
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+
+class SlotRollout:
+    """ records a roll-out directly into a shared-memory slot.
+    Has the same recording interface as a2c.rollout.Rollout.
+    """
+    def __init__(self, slots: RolloutSlots, slot: int):
+        self.slots = slots
+        self.slot = slot
+        self._arrays = slots.arrays
+        self.version = None
+
+    def record(self, observations, actions, rewards, values, dones, logits=None):
+        """ records a single step forwards for each agent in the batch """
+        slot = self.slot
+        t = self._arrays['lengths'][slot]
+        if t >= self.slots.episode_length:
+            raise ValueError(f"Roll-out is longer than the slot ({self.slots.episode_length} steps)")
+
+        self._record_masked('observations', t, observations)
+        self._arrays['actions'][slot, t] = actions
+        self._record_masked('rewards', t, rewards)
+        self._arrays['values'][slot, t] = values
+        self._record_masked('dones', t, dones)
+        if logits is not None:
+            self._arrays['logits'][slot, t] = logits
+        self._arrays['lengths'][slot] = t + 1
+
+    def _record_masked(self, name, t, entries):
+        """ records the entries of a field which may be None for dead agents """
+        field = self._arrays[name][self.slot, t]
+        present = self._arrays[f'{name}_present'][self.slot, t]
+        if not any(entry is None for entry in entries):
+            field[:] = entries
+            present[:] = True
+            return
+
+        present[:] = list(map(is_not_None, entries))
+        field[~present] = 0
+        for i in np.flatnonzero(present):
+            field[i] = entries[i]
@@ -5,6 +5,7 @@ Author: Jon Deaton (jonpauldeaton@gmail.com)
 """
 import os, sys
 import argparse, logging
+from functools import partial
 import gym, gym_agario
 import numpy as np
 
@@ -17,7 +18,7 @@ logger.propagate = False
 def make_test_env(env_name, hyperams):
     """ creates an environment for testing """
     return gym.make(env_name, **{
-        'num_agents': 8,
+        'num_agents': hyperams.eval_agents,
         'difficulty': 'normal',
         'ticks_per_step': hyperams.ticks_per_step,
         'arena_size': 500,
@@ -79,6 +80,10 @@ def agario_to_action(index, action_shape):
     return np.array([x, y]), act
 
 
+def identity_action(index):
+    return index
+
+
 def main():
     args = parse_args()
     setup_logger(args, logger)
@@ -86,11 +91,11 @@ def main():
     if args.env == "CartPole-v1":
         from a2c.hyperparameters import CartPoleHyperparameters
         hyperams = CartPoleHyperparameters()
-        to_action = lambda index: index
+        to_action = identity_action
     elif args.env == "agario-grid-v0":
         from a2c.hyperparameters import GridEnvHyperparameters
         hyperams = GridEnvHyperparameters()
-        to_action = lambda i: agario_to_action(i, hyperams.action_shape)
+        to_action = partial(agario_to_action, action_shape=hyperams.action_shape)
     else:
         raise ValueError(args.env)
 
@@ -104,7 +109,7 @@ def main():
         output_dir = args.output
         os.makedirs(args.output, exist_ok=True)
 
-        training_dir = get_training_dir(output_dir, args.name)
+        training_dir = args.resume or get_training_dir(output_dir, args.name)
         os.makedirs(training_dir, exist_ok=True)
         logger.info(f"Model directory: {training_dir}")
 
@@ -112,13 +117,15 @@ def main():
         logger.debug(f"Saving hyper-parameters to: {hp_file}")
         hyperams.save(hp_file)
 
-    get_env = lambda: make_environment(args.env, hyperams)
+    # partials rather than lambdas so that they can be sent to forkserver workers
+    get_env = partial(make_environment, args.env, hyperams)
 
     test_env = make_test_env(args.env, hyperams)
 
-    trainer = Trainer(get_env, hyperams, to_action, test_env=test_env, training_dir=training_dir)
+    trainer = Trainer(get_env, hyperams, to_action, test_env=test_env, training_dir=training_dir,
+                      get_test_env=partial(make_test_env, args.env, hyperams))
 
-    trainer.train(asynchronous=hyperams.asynchronous)
+    trainer.train(asynchronous=hyperams.asynchronous, resume=args.resume is not None)
 
     logger.debug("Exiting.")
 
@@ -152,6 +159,7 @@ def parse_args():
     output_options.add_argument("--output", default="model_outputs", help="Output directory")
     output_options.add_argument("--name", default="a2c", help="Experiment or run name")
     output_options.add_argument("--debug", action="store_true", help="Debug mode")
+    output_options.add_argument("--resume", help="Training directory of a run to continue from its latest checkpoint")
 
     hyperams_options = parser.add_argument_group("HyperParameters")
     # note: make sure that the "dest" value is exactly the same as the 
@@ -160,6 +168,53 @@ def parse_args():
                                   help="Number of epochs to train")
     hyperams_options.add_argument('-async', '--asynchronous', dest='asynchronous',
                                   action='store_true', help="")
+    hyperams_options.add_argument('--multi-env', dest='multi_env', action='store_true',
+                                  help="Synchronously train on the agents of all environments at once")
+    hyperams_options.add_argument('--learners', dest='num_learners', type=int,
+                                  help="Number of synchronous data-parallel learner processes")
+    hyperams_options.add_argument('--placement', dest='placement', action='store_true',
+                                  help="Pin processes to cores and limit their thread pools")
+    hyperams_options.add_argument('--learner-cores', dest='learner_cores', type=int,
+                                  help="Number of cores reserved for each learner")
+    hyperams_options.add_argument('--server-cores', dest='server_cores', type=int,
+                                  help="Number of cores reserved for the inference server")
+    hyperams_options.add_argument('--learner-threads', dest='learner_threads', type=int,
+                                  help="Number of intra-op threads of the learner")
+    hyperams_options.add_argument('--worker-threads', dest='worker_threads', type=int,
+                                  help="Number of cores and threads given to each worker")
+    hyperams_options.add_argument('--start-method', dest='start_method',
+                                  choices=['fork', 'forkserver', 'spawn'],
+                                  help="How to start asynchronous workers. A forkserver preloads "
+                                       "TensorFlow and gym so that workers start quickly. Defaults to "
+                                       "fork, or to forkserver when autoscaling, which can't fork")
+    hyperams_options.add_argument('--eval-frequency', dest='eval_frequency', type=int,
+                                  help="Evaluate the model on the test environment every this many episodes")
+    hyperams_options.add_argument('--eval-episodes', dest='eval_episodes', type=int,
+                                  help="Number of test episodes per evaluation")
+    hyperams_options.add_argument('--eval-workers', dest='eval_workers', type=int,
+                                  help="Number of evaluation processes")
+    hyperams_options.add_argument('--queue-capacity', dest='queue_capacity', type=int,
+                                  help="Maximum number of roll-outs waiting for the learner (0 = unbounded)")
+    hyperams_options.add_argument('--max-staleness', dest='max_staleness', type=int,
+                                  help="Drop roll-outs generated more than this many updates ago")
+    hyperams_options.add_argument('--autoscale', dest='autoscale', action='store_true',
+                                  help="Add and retire asynchronous workers to match the learner")
+    hyperams_options.add_argument('--min-workers', dest='min_workers', type=int,
+                                  help="Fewest asynchronous workers when autoscaling")
+    hyperams_options.add_argument('--max-workers', dest='max_workers', type=int,
+                                  help="Most asynchronous workers when autoscaling")
+    hyperams_options.add_argument('--shared-rollouts', dest='shared_rollouts', action='store_true',
+                                  help="Hand roll-outs to the learner through shared memory slots")
+    hyperams_options.add_argument('--prefetch-depth', dest='prefetch_depth', type=int,
+                                  help="Number of roll-outs to prepare ahead of the learner (0 = none)")
+    hyperams_options.add_argument('--ship-gradients', dest='ship_gradients',
+                                  action='store_true', help="Asynchronous workers send gradients "
+                                                            "instead of roll-outs (A3C)")
+    hyperams_options.add_argument('--vtrace', dest='vtrace', action='store_true',
+                                  help="Correct for stale asynchronous roll-outs with V-trace")
+    hyperams_options.add_argument('--inference-server', dest='inference_server',
+                                  action='store_true', help="Select actions for asynchronous "
+                                                            "workers with a central inference server")
 
     logging_group = parser.add_argument_group("Logging")
     logging_group.add_argument('--log', dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
@@ -11,9 +11,23 @@ Inspired by:
 
 from a2c.hyperparameters import HyperParameters
 from a2c.rollout import Rollout, transpose_batch
-from a2c.async_coordinator import AsyncCoordinator
+from a2c.async_coordinator import AsyncCoordinator, WorkerSignal
+from a2c.autoscaler import Autoscaler
+from a2c.coordinator import Coordinator, MultiEnvironment
+from a2c.allreduce import SharedAllReduce
+from a2c.parameter_server import SharedWeights
+from a2c.inference_server import InferenceServer
+from a2c.rollout_slots import RolloutSlots, SlotRollout
+from a2c.prefetch import Prefetcher
+from a2c.placement import PlacementPolicy
+from a2c.worker_context import worker_context
+from a2c.evaluation import AsyncEvaluator
+from utils.checkpoint import CheckpointWriter, latest_checkpoint, load_checkpoint
 
 import os
+import time
+import contextlib
+from functools import partial
 from tqdm import tqdm
 import numpy as np
 import random
@@ -21,14 +35,17 @@ import logging
 logger = logging.getLogger("root")
 logger.propagate = False
 
-from multiprocessing import Queue, Semaphore
+from multiprocessing import Process, Queue
+from multiprocessing.connection import wait
 
 
-def worker_target(wid: int, queue: Queue, sema: Semaphore,
-                  get_env, model_directory, to_action, hyperams: HyperParameters):
+def worker_target(wid: int, queue: Queue, signal: WorkerSignal,
+                  get_env, shared_weights: SharedWeights, to_action, hyperams: HyperParameters,
+                  rollout_slots: RolloutSlots = None):
     """ the task that each worker process performs: gather the complete
         roll-out of an episode using the latest model and send it back to the
-        master process. """
+        master process, either through the queue or, if `rollout_slots` is
+        provided, by recording it into a shared-memory slot. """
     print(f"Worker {wid} started")
 
     env = get_env()
@@ -43,36 +60,142 @@ def worker_target(wid: int, queue: Queue, sema: Semaphore,
                        hyperams.encoder_class,
                        input_shape,
                        hyperams.action_shape)
+    initialize_weights(model, env.observation_space.shape)
+
+    signal.wait()  # wait for master process to signal
+
+    weights_version = 0
+    while signal.active:  # until retired
+        # only copies weights if the learner has published new ones
+        weights_version = shared_weights.pull(model, weights_version)
+        rollout = new_rollout(rollout_slots)
+        get_rollout(ModelPolicy(model, version=weights_version), env,
+                    hyperams.agents_per_env,
+                    hyperams.episode_length,
+                    to_action,
+                    progress_bar=True,
+                    rollout=rollout)
+        send_rollout(queue, rollout)
+        del rollout  # saves some memory
+
+
+def gradient_worker_target(wid: int, queue: Queue, signal: WorkerSignal,
+                           get_env, shared_weights: SharedWeights, to_action, hyperams: HyperParameters):
+    """ the task that each worker process performs in A3C-style training: gather
+        the roll-out of an episode with the latest model, compute the A2C gradients
+        locally, and send only the flattened gradients (and the rewards, for
+        logging) back to the master process. """
+    print(f"Worker {wid} started")
+
+    env = get_env()
+
+    # workers can't use GPU because TensorFlow...
+    os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
-    sema.acquire()  # wait for master process to signal
+    from a2c.eager_models import make_model
+    from a2c.losses import a2c_loss, get_loss_variables, flatten_gradients
 
-    while True:
-        model.load_weights(model_directory)
-        rollout = get_rollout(model, env,
+    input_shape = (None,) + env.observation_space.shape
+    model = make_model(hyperams.architecture,
+                       hyperams.encoder_class,
+                       input_shape,
+                       hyperams.action_shape)
+    initialize_weights(model, env.observation_space.shape)
+
+    signal.wait()  # wait for master process to signal
+
+    weights_version = 0
+    while signal.active:
+        weights_version = shared_weights.pull(model, weights_version)
+        rollout = get_rollout(ModelPolicy(model, version=weights_version), env,
                               hyperams.agents_per_env,
                               hyperams.episode_length,
                               to_action,
-                              progress_bar=True)
-        queue.put(rollout.as_batch(cache=False))
-        del rollout  # saves some memory
+                              progress_bar=False)
+        rollout_batch = rollout.as_batch(cache=False)
 
+        loss_vars = get_loss_variables(rollout_batch, hyperams.gamma, model.recurrent)
+        losses, grads = a2c_loss(model, hyperams.entropy_weight, *loss_vars)
 
-def get_rollout(model, env, agents_per_env, episode_length, to_action,
-                record=True, progress_bar=True) -> Rollout:
-    """ performs a roll-out """
-    import tensorflow as tf
-    rollout = Rollout() if record else None
+        losses = [float(loss) for loss in losses]
+        flat_grads = flatten_gradients(grads, model.trainable_variables)
+        queue.put((weights_version, (flat_grads, losses, rollout_batch[2])))
+        del rollout, rollout_batch
+
+
+def actor_target(wid: int, queue: Queue, signal: WorkerSignal, policy,
+                 get_env, to_action, hyperams: HyperParameters,
+                 rollout_slots: RolloutSlots = None):
+    """ the task that each worker process performs when actions are served by
+        an inference server: step the environment with actions from `policy`
+        and send the complete roll-out back to the master process. These
+        workers never import TensorFlow or build a model of their own. """
+    print(f"Actor {wid} started")
+
+    env = get_env()
+
+    signal.wait()  # wait for master process to signal
+
+    while signal.active:
+        rollout = new_rollout(rollout_slots)
+        get_rollout(policy, env,
+                    hyperams.agents_per_env,
+                    hyperams.episode_length,
+                    to_action,
+                    progress_bar=False,
+                    rollout=rollout)
+        send_rollout(queue, rollout)
+        del rollout
 
-    observations = env.reset()
-    dones = [False] * agents_per_env
 
+def new_rollout(rollout_slots: RolloutSlots = None):
+    """ makes an empty roll-out, recorded in a shared-memory slot if slots are
+    provided. Blocks until a slot is free. """
+    if rollout_slots is None:
+        return Rollout()
+    return rollout_slots.rollout(rollout_slots.acquire())
+
+
+def send_rollout(queue: Queue, rollout):
+    """ sends a complete roll-out to the master process """
+    if isinstance(rollout, SlotRollout):
+        queue.put((rollout.version, rollout.slot))
+    else:
+        queue.put((rollout.version, rollout.as_batch(cache=False)))
+
+
+def initialize_weights(model, observation_shape):
+    """ runs a dummy observation through the model so that its variables get created """
+    import tensorflow as tf
+    dummy_obs = tf.zeros((1,) + tuple(observation_shape))
     if model.recurrent:
-        model.reset_states()
+        dummy_obs = tf.expand_dims(dummy_obs, axis=1)
+    model(dummy_obs)
 
-    iter = tqdm(range(episode_length)) if progress_bar else range(episode_length)
-    for _ in iter:
-        if all(dones): break
 
+class ModelPolicy:
+    """ samples actions and value estimates from a local model """
+
+    def __init__(self, model, version=None):
+        """ Construct
+        :param model: the actor-critic model
+        :param version: the version of the shared weights held by the model
+        """
+        self.model = model
+        self.version = version
+
+    def reset(self):
+        """ called at the start of every roll-out """
+        if self.model.recurrent:
+            self.model.reset_states()
+
+    def __call__(self, observations):
+        """ samples an action for each observation
+        :param observations: batch of observations, one per agent
+        :return: numpy arrays of sampled action indices, value estimates and action logits
+        """
+        import tensorflow as tf
+        model = self.model
         obs_tensor = tf.convert_to_tensor(observations)
 
         # need to add time time dimension for recurrent models only
@@ -89,39 +212,116 @@ def get_rollout(model, env, agents_per_env, episode_length, to_action,
         # reshape the critic's value estimations
         # todo: im only like 90% sure that this is part is corect...
         squeeze_axes = [1, 2] if model.recurrent else 1
-        values = list(tf.squeeze(est_values, axis=squeeze_axes).numpy())
+        values = tf.squeeze(est_values, axis=squeeze_axes).numpy()
+        return actions, values, action_logits.numpy()
+
+
+def get_rollout(policy, env, agents_per_env, episode_length, to_action,
+                record=True, progress_bar=True, rollout=None) -> Rollout:
+    """ performs a roll-out
+    :param policy: callable mapping a batch of observations to actions, values
+    and logits, e.g. a ModelPolicy or an InferenceClient
+    :param rollout: optional empty roll-out to record into
+    """
+    if record and rollout is None:
+        rollout = Rollout()
+
+    observations = env.reset()
+    dones = [False] * agents_per_env
+
+    policy.reset()
+
+    iter = tqdm(range(episode_length)) if progress_bar else range(episode_length)
+    for _ in iter:
+        if all(dones): break
+
+        actions, values, logits = policy(observations)
+        values = list(values)
 
         next_obs, rewards, next_dones, _ = env.step(list(map(to_action, actions)))
 
         if record:
-            rollout.record(observations, actions, rewards, values, dones)
+            rollout.record(observations, actions, rewards, values, dones, logits=list(logits))
         dones = next_dones
         observations = next_obs
 
+    if record:
+        rollout.version = policy.version
     return rollout
 
 
+# observation spaces of the environments made by each `get_env`, shared by
+# every Trainer in the process, e.g. by all of the runs of a sweep
+_observation_spaces = {}
+
+
+def environment_key(get_env):
+    """ identifies the environments made by `get_env`. Partials of the same
+    function with the same arguments are equivalent even if they're different objects """
+    if isinstance(get_env, partial):
+        try:
+            key = get_env.func, get_env.args, tuple(sorted(get_env.keywords.items()))
+            hash(key)
+            return key
+        except TypeError:  # unhashable arguments
+            pass
+    return get_env
+
+
 class Trainer:
 
-    def __init__(self, get_env, hyperams: HyperParameters, to_action, test_env=None, training_dir=None):
+    def __init__(self, get_env, hyperams: HyperParameters, to_action, test_env=None, training_dir=None,
+                 get_test_env=None):
         self.get_env = get_env
         self.hyperams = hyperams
         self.to_action = to_action
         self.test_env = test_env
+        self.get_test_env = get_test_env
         self.num_envs = hyperams.num_envs
         self.training_dir = training_dir
 
-    def train(self, asynchronous=False):
-        """ trains a model """
+        self.resume = False
+
+    def train(self, asynchronous=False, resume=False):
+        """ trains a model
+        :param asynchronous: train with asynchronous workers
+        :param resume: continue from the latest checkpoint in the training directory
+        """
+        self.resume = resume
         if asynchronous:
             self._train_async()
+        elif self.hyperams.num_learners > 1:
+            self._train_data_parallel()
         else:
             self._train_sync()
 
     def _train_sync(self):
-        """ trains a model sequentially with a single environment """
-        env = self.get_env()
-
+        """ trains a model synchronously, either with a single environment or, in
+        multi-environment mode, with the agents of all `num_envs` environments at once """
+        placement = self._make_placement()
+        observation_shape = self._get_observation_space().shape
+
+        with self._make_evaluator(observation_shape) as evaluator, \
+                self._make_checkpoint_writer() as checkpoints:
+            if not self.hyperams.multi_env:
+                if placement is not None:
+                    placement.apply_learner()
+                self._train_sync_on(self.get_env(), self.hyperams.agents_per_env, evaluator, checkpoints)
+                return
+
+            with Coordinator(self.get_env, self.num_envs, placement=placement) as coordinator:
+                if placement is not None:
+                    placement.apply_learner()
+                env = MultiEnvironment(coordinator, self.hyperams.agents_per_env)
+                self._train_sync_on(env, env.num_agents, evaluator, checkpoints)
+
+    def _train_sync_on(self, env, num_agents, evaluator=None, checkpoints=None):
+        """ trains a model sequentially on a single (possibly composite) environment
+        :param env: the environment
+        :param num_agents: number of agents in the environment
+        :param evaluator: optional open AsyncEvaluator
+        :param checkpoints: optional CheckpointWriter
+        """
         import tensorflow as tf
         from a2c.eager_models import make_model
         input_shape = (None,) + env.observation_space.shape
@@ -129,65 +329,298 @@ class Trainer:
                            self.hyperams.encoder_class,
                            input_shape,
                            self.hyperams.action_shape)
+        initialize_weights(model, env.observation_space.shape)
 
         self.optimizer = tf.keras.optimizers.Adam(lr=self.hyperams.learning_rate, clipnorm=1.0)
+        first_episode = self._restore_checkpoint(model)
 
         summary_writer = None
         if self.training_dir is not None:
-            model_directory = os.path.join(self.training_dir, "model")
             summary_writer = tf.summary.create_file_writer(self.training_dir)
 
-        for ep in range(self.hyperams.num_episodes):
+        for ep in range(first_episode, self.hyperams.num_episodes):
             logger.info(f"Episode {ep}")
             episode_length = self.hyperams.episode_length
-            rollout = get_rollout(model, env,
-                                  self.hyperams.agents_per_env,
+            rollout = get_rollout(ModelPolicy(model), env,
+                                  num_agents,
                                   episode_length,
                                   self.to_action)
 
             losses = self._update_with_rollout(model, rollout.as_batch())
             self._log_rollout(summary_writer, ep, rollout.as_batch(), losses)
+            self._evaluate(summary_writer, ep, model, evaluator)
+
+            if ep % self.hyperams.save_frequency == 0:
+                self._save_checkpoint(checkpoints, model, ep)
+
+    def _train_data_parallel(self):
+        """ trains a model synchronously with `num_learners` learner processes,
+        each of which collects its own share of the roll-outs and computes the
+        gradients of its share. The gradients are averaged across learners before
+        being applied so that every learner holds exactly the same weights.
+        Snapshots aren't evaluated on the test environment in this mode. """
+        if self.hyperams.eval_frequency:
+            logger.warning("Data-parallel training doesn't evaluate on the test environment")
+
+        allreduce = SharedAllReduce(self.hyperams.num_learners)
+        placement = self._make_placement(num_learners=self.hyperams.num_learners)
+        learners = [Process(target=self._data_parallel_learner, args=(rank, allreduce, placement))
+                    for rank in range(self.hyperams.num_learners)]
+        for learner in learners:
+            learner.start()
+
+        try:
+            while any(learner.is_alive() for learner in learners):
+                if any(learner.exitcode for learner in learners):
+                    # a learner that died without aborting would leave the others waiting for it
+                    allreduce.abort()
+                    break
+                wait([learner.sentinel for learner in learners], timeout=1)
+        finally:
+            for learner in learners:
+                learner.join(timeout=30)
+                if learner.is_alive():
+                    learner.terminate()
+                    learner.join()
+
+        failed = [rank for rank, learner in enumerate(learners) if learner.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"Learners {failed} failed")
+
+    def _data_parallel_learner(self, rank, allreduce: SharedAllReduce, placement=None):
+        """ the task of each learner process in data-parallel training """
+        if placement is not None:
+            placement.apply_learner(rank)  # must precede TensorFlow's initialization
+        try:
+            self._learn_data_parallel(rank, allreduce)
+        except BaseException:
+            allreduce.abort()  # so that the other learners don't wait for this one forever
+            raise
+        finally:
+            allreduce.close()
+
+    def _learn_data_parallel(self, rank, allreduce: SharedAllReduce):
+        """ trains one learner's share in data-parallel training. Only the first
+        learner logs and saves the model. Non-trainable variables aren't shared
+        between learners: they are neither broadcast nor checked for divergence. """
+        env = self.get_env()
 
-            if self.training_dir is not None and ep % self.hyperams.save_frequency == 0:
-                logger.info("Checkpointing model...")
-                model.save_weights(model_directory)
+        import tensorflow as tf
+        from a2c.eager_models import make_model
+        from a2c.losses import a2c_loss, get_loss_variables, flatten_gradients, unflatten_gradients
+        input_shape = (None,) + env.observation_space.shape
+        model = make_model(self.hyperams.architecture,
+                           self.hyperams.encoder_class,
+                           input_shape,
+                           self.hyperams.action_shape)
+        initialize_weights(model, env.observation_space.shape)
+        self.optimizer = tf.keras.optimizers.Adam(lr=self.hyperams.learning_rate, clipnorm=1.0)
 
-    def _train_async(self):
-        """ trains a model asynchronously """
+        # every learner restores the same checkpoint, so their optimizers agree too
+        first_episode = self._restore_checkpoint(model)
+
+        num_params = sum(int(np.prod(v.shape)) for v in model.trainable_variables)
+        allreduce.open(rank, num_params)
+
+        def flat_weights():
+            return np.concatenate([np.ravel(v.numpy()) for v in model.trainable_variables]).astype(np.float32)
 
-        model_directory = os.path.join(self.training_dir, "model")
+        # all learners start from the first learner's weights
+        initial = unflatten_gradients(allreduce.broadcast(flat_weights()), model.trainable_variables)
+        for var, value in zip(model.trainable_variables, initial):
+            var.assign(value)
 
-        args = self.get_env, model_directory, self.to_action, self.hyperams
-        coordinator = AsyncCoordinator(self.hyperams.num_envs,
-                                       worker_target, args)
+        summary_writer = None
+        checkpoints = None
+        if rank == 0 and self.training_dir is not None:
+            summary_writer = tf.summary.create_file_writer(self.training_dir)
+            checkpoints = self._make_checkpoint_writer()
+
+        for ep in range(first_episode, self.hyperams.num_episodes):
+            rollout = get_rollout(ModelPolicy(model), env,
+                                  self.hyperams.agents_per_env,
+                                  self.hyperams.episode_length,
+                                  self.to_action,
+                                  progress_bar=rank == 0)
+            rollout_batch = rollout.as_batch()
+
+            # each learner must contribute exactly one gradient per update, so the
+            # roll-out isn't split into mini-batches as it can be in _update_with_rollout
+            loss_vars = get_loss_variables(rollout_batch, self.hyperams.gamma, model.recurrent)
+            losses, grads = a2c_loss(model, self.hyperams.entropy_weight, *loss_vars)
+            flat_grads = flatten_gradients(grads, model.trainable_variables)
+            self._apply_flat_gradients(model, allreduce.mean(flat_grads))
+
+            if ep % self.hyperams.save_frequency == 0:
+                # all learners must agree, bit for bit
+                if not np.array_equal(allreduce.broadcast(flat_weights()), flat_weights()):
+                    raise RuntimeError(f"Learner {rank} weights diverged from learner 0 at episode {ep}")
+
+                self._save_checkpoint(checkpoints, model, ep)
+
+            if rank == 0:
+                logger.info(f"Episode {ep}")
+                self._log_rollout(summary_writer, ep, rollout_batch, losses)
+
+        if checkpoints is not None:
+            checkpoints.close()
+
+    def _train_async(self):
+        """ trains a model asynchronously """
+        observation_space = self._get_observation_space()
+        observation_shape = observation_space.shape
+        context = worker_context(self._start_method())
+
+        # with autoscaling, workers may be added up to `max_workers`
+        num_workers = self.hyperams.num_envs
+        max_workers = num_workers
+        if self.hyperams.autoscale:
+            max_workers = self.hyperams.max_workers or os.cpu_count()
+            num_workers = min(max(num_workers, self.hyperams.min_workers), max_workers)
+
+        placement = self._make_placement()
+        shared_weights = SharedWeights(context=context)
+        if self.hyperams.ship_gradients:
+            if self.hyperams.inference_server:
+                raise ValueError("Gradient shipping requires workers to have their own model")
+            if self.hyperams.vtrace:
+                raise ValueError("Shipped gradients are computed on-policy and cannot be V-trace corrected")
+            # workers compute gradients, the learner only applies them
+            inference_server = None
+            target, args = gradient_worker_target, (self.get_env, shared_weights, self.to_action, self.hyperams)
+        elif self.hyperams.inference_server:
+            # workers only step environments, the server runs the model for all of them
+            inference_server = InferenceServer(max_workers, shared_weights,
+                                               observation_shape, self.hyperams, context=context,
+                                               placement=placement)
+            target, args = actor_target, (self.get_env, self.to_action, self.hyperams)
+        else:
+            inference_server = None
+            target, args = worker_target, (self.get_env, shared_weights, self.to_action, self.hyperams)
+
+        rollout_slots = None
+        if self.hyperams.shared_rollouts and not self.hyperams.ship_gradients:
+            # enough for every worker to be recording while the queue is full and the learner holds one.
+            # An unbounded queue is instead bounded by the slots, once they're all waiting in it
+            num_slots = max_workers + self.hyperams.queue_capacity + 1
+            rollout_slots = RolloutSlots(num_slots,
+                                         self.hyperams.episode_length,
+                                         self.hyperams.agents_per_env,
+                                         observation_shape,
+                                         int(np.prod(self.hyperams.action_shape)),
+                                         observation_dtype=observation_space.dtype,
+                                         context=context)
+            logger.info(f"Allocated {num_slots} roll-out slots ({rollout_slots.nbytes / 2 ** 20:.0f} MB)")
+            args += (rollout_slots, )
+
+        coordinator = AsyncCoordinator(num_workers, target, args,
+                                       inference_server=inference_server,
+                                       queue_capacity=self.hyperams.queue_capacity,
+                                       max_staleness=self.hyperams.max_staleness,
+                                       rollout_slots=rollout_slots,
+                                       max_workers=max_workers,
+                                       placement=placement,
+                                       context=context)
+
+        start_time = time.time()
+        # closing the weights last, even if training fails, destroys their shared memory
+        with shared_weights, coordinator, self._make_evaluator(observation_shape, context) as evaluator, \
+                self._make_checkpoint_writer() as checkpoints:
+            if placement is not None:
+                placement.apply_learner()  # must precede TensorFlow's initialization
 
-        with coordinator:
             import tensorflow as tf
             from a2c.eager_models import make_model
 
             summary_writer = tf.summary.create_file_writer(self.training_dir)
 
-            input_shape = (None,) + self.get_env().observation_space.shape
+            input_shape = (None,) + observation_shape
             model = make_model(self.hyperams.architecture,
                                self.hyperams.encoder_class,
                                input_shape,
                                self.hyperams.action_shape)
+            initialize_weights(model, observation_shape)
 
             self.optimizer = tf.keras.optimizers.Adam(lr=self.hyperams.learning_rate, clipnorm=1.0)
+            first_episode = self._restore_checkpoint(model)
 
-            logger.info("Saving initial model...")
-            model.save_weights(model_directory)
-            logger.info("Initial model saved.")
-
+            # workers wait for the first version of the weights before starting
+            shared_weights.publish(model.get_weights())
             coordinator.start()  # start the worker processes
 
-            for episode in range(self.hyperams.num_episodes):
-                rollout_batch = coordinator.pop()
-
-                losses = self._update_with_rollout(model, rollout_batch)
-                self._log_rollout(summary_writer, episode, rollout_batch, losses=losses)
-
-                model.save_weights(model_directory)
+            def fetch():
+                """ waits for the next datum from the workers, giving up every
+                so often so that the prefetcher can tell if it's been stopped """
+                return coordinator.pop(shared_weights.version, timeout=Prefetcher.poll_interval)
+
+            def prepare(popped):
+                """ prepares a popped datum for training, unless it's gradients """
+                version, datum = popped
+                if self.hyperams.ship_gradients:
+                    return version, datum
+
+                if rollout_slots is None:
+                    return version, self._prepare_rollout(model, datum)
+
+                prepared = self._prepare_rollout(model, rollout_slots.as_batch(datum))
+                coordinator.release(datum)  # everything needed has been copied out of the slot
+                return version, prepared
+
+            # prepares the next roll-out on a background thread while the current one is trained on
+            prefetcher = Prefetcher(prepare, depth=self.hyperams.prefetch_depth, fetch=fetch)
+            if self.hyperams.prefetch_depth > 0:
+                prefetcher.start()
+                next_datum = prefetcher.get
+            else:
+                def next_datum():
+                    return prepare(coordinator.pop(shared_weights.version))
+
+            autoscaler = None
+            if self.hyperams.autoscale:
+                autoscaler = Autoscaler(coordinator, self.hyperams.min_workers, max_workers,
+                                        interval=self.hyperams.autoscale_interval)
+
+            try:
+                for episode in range(first_episode, self.hyperams.num_episodes):
+                    wait_start = time.time()
+                    version, datum = next_datum()
+                    step_start = time.time()
+                    if episode == first_episode:
+                        self._log_first_rollout(summary_writer, step_start - start_time)
+                    self._log_staleness(summary_writer, episode, shared_weights.version - version)
+                    self._log_queue(summary_writer, episode, coordinator)
+
+                    if self.hyperams.ship_gradients:
+                        flat_grads, losses, reward_batch = datum
+                        self._apply_flat_gradients(model, flat_grads)
+                    else:
+                        prepared, reward_batch = datum
+                        if self.hyperams.vtrace:
+                            # the correction needs the current weights so can't be prepared in advance
+                            loss_vars = self._get_vtrace_loss_variables(model, prepared)
+                        else:
+                            loss_vars = prepared
+                        losses = self._update_with_loss_variables(model, loss_vars)
+
+                    self._log_rewards(summary_writer, episode, reward_batch, losses=losses)
+                    if self.hyperams.prefetch_depth > 0:
+                        self._log_prefetch(summary_writer, episode, prefetcher)
+                    if inference_server is not None:
+                        self._log_inference(summary_writer, episode, inference_server,
+                                            coordinator.num_workers)
+
+                    shared_weights.publish(model.get_weights())
+                    self._evaluate(summary_writer, episode, model, evaluator)
+
+                    if autoscaler is not None:
+                        waited = step_start - wait_start > 1e-3
+                        if autoscaler.update(time.time() - step_start, waited=waited) is not None:
+                            self._log_autoscaler(summary_writer, episode, autoscaler)
+
+                    if episode % self.hyperams.save_frequency == 0:
+                        self._save_checkpoint(checkpoints, model, episode)
+            finally:
+                prefetcher.stop()
 
     def _train_async_shared(self):
         """ trains asynchronously with a single shared model
@@ -223,12 +656,146 @@ class Trainer:
         #         self._log_rollout(rollout, ep)
         #         self._update_with_rollout(rollout)
 
+    def _start_method(self):
+        """ how to start asynchronous workers. The autoscaler adds workers once
+        TensorFlow is running in the learner, which isn't safe to fork, so
+        they're started from a forkserver unless told to spawn them. """
+        start_method = self.hyperams.start_method
+        if not self.hyperams.autoscale:
+            return start_method or "fork"
+        if start_method == "fork":
+            raise ValueError("Autoscaling can't fork workers from the learner once TensorFlow is "
+                             "initialized. Use the \"forkserver\" or \"spawn\" start method")
+        return start_method or "forkserver"
+
+    def _get_observation_space(self):
+        """ the environment's observation space, which is only read from an environment
+        once for all of the Trainers in this process with the same `get_env` """
+        key = environment_key(self.get_env)
+        if key not in _observation_spaces:
+            env = self.get_env()
+            _observation_spaces[key] = env.observation_space
+            if hasattr(env, "close"):
+                env.close()
+        return _observation_spaces[key]
+
+    def _make_evaluator(self, observation_shape, context=None):
+        """ the background evaluator, if enabled, otherwise a context which does nothing """
+        if not self.hyperams.eval_frequency or self.get_test_env is None:
+            return contextlib.nullcontext()
+
+        best_directory = None
+        if self.training_dir is not None:
+            best_directory = os.path.join(self.training_dir, "best")
+        return AsyncEvaluator(self.get_test_env, self.to_action, self.hyperams, observation_shape,
+                              best_directory=best_directory, context=context)
+
+    def _evaluate(self, summary_writer, episode, model, evaluator):
+        """ submits a snapshot of the model for evaluation every `eval_frequency`
+        episodes, and logs any evaluations that have finished """
+        if evaluator is None:
+            return
+
+        if episode % self.hyperams.eval_frequency == 0:
+            if not evaluator.submit(episode, model.get_weights()):
+                logger.info(f"Skipped evaluation at episode {episode}: evaluators are busy")
+
+        for eval_episode, metrics in evaluator.poll():
+            self._log_evaluation(summary_writer, eval_episode, metrics)
+
+    def _make_checkpoint_writer(self):
+        """ the background checkpoint writer, or a context which does nothing
+        if there is no training directory to write checkpoints to """
+        if self.training_dir is None:
+            return contextlib.nullcontext()
+        return CheckpointWriter(os.path.join(self.training_dir, "checkpoints"),
+                                keep=self.hyperams.keep_checkpoints)
+
+    def _save_checkpoint(self, checkpoints, model, episode):
+        """ snapshots the model and optimizer for the checkpoint writer to save """
+        if checkpoints is None:
+            return
+        logger.info("Checkpointing model...")
+        checkpoints.save(episode, {
+            'episode': episode,
+            'weights': model.get_weights(),
+            'optimizer': self.optimizer.get_weights(),
+        })
+
+    def _restore_checkpoint(self, model):
+        """ restores the model and optimizer from the latest checkpoint when resuming
+        :return: the episode from which to continue training
+        """
+        if not self.resume or self.training_dir is None:
+            return 0
+
+        path = latest_checkpoint(os.path.join(self.training_dir, "checkpoints"))
+        if path is None:
+            logger.warning(f"No checkpoint to resume from in {self.training_dir}")
+            return 0
+
+        state = load_checkpoint(path)
+        model.set_weights(state['weights'])
+
+        # the optimizer's variables aren't created until it first applies gradients.
+        # Adam's update for zero gradients is zero, so this doesn't change the weights.
+        import tensorflow as tf
+        zeros = [tf.zeros_like(var) for var in model.trainable_variables]
+        self.optimizer.apply_gradients(zip(zeros, model.trainable_variables))
+        self.optimizer.set_weights(state['optimizer'])
+
+        logger.info(f"Resumed from {path} at episode {state['episode']}")
+        return state['episode'] + 1
+
+    def _make_placement(self, num_learners=1):
+        """ the placement of processes on cores, if enabled
+        :param num_learners: number of learner processes to reserve cores for
+        """
+        if not self.hyperams.placement:
+            return None
+        server_cores = self.hyperams.server_cores if self.hyperams.inference_server else 0
+        placement = PlacementPolicy(learner_cores=self.hyperams.learner_cores,
+                                    worker_threads=self.hyperams.worker_threads,
+                                    learner_threads=self.hyperams.learner_threads,
+                                    num_learners=num_learners,
+                                    server_cores=server_cores)
+        logger.info(f"Placement: {placement.describe()}")
+        return placement
+
     def _update_with_rollout(self, model, rollout_batch):
         """ updates the network using a roll-out """
+        from a2c.losses import get_loss_variables
+
+        if self.hyperams.vtrace:
+            loss_vars = self._get_vtrace_loss_variables(model, rollout_batch)
+        else:
+            loss_vars = get_loss_variables(rollout_batch, self.hyperams.gamma, model.recurrent)
+
+        return self._update_with_loss_variables(model, loss_vars)
 
-        from a2c.losses import a2c_loss, get_loss_variables, batch_loss_variables
+    def _prepare_rollout(self, model, rollout_batch):
+        """ does as much of the conversion of a roll-out into loss variables as
+        possible without using the model's weights, so that it can be done in the
+        background while the model is being updated.
+        :return: tuple of loss variables (or, for V-trace, a copy of the roll-out) and the rewards
+        """
+        from a2c.losses import get_loss_variables
+        reward_batch = [np.array(rewards) for rewards in rollout_batch[2]]
+
+        if self.hyperams.vtrace:
+            return tuple(np.array(field) for field in rollout_batch), reward_batch
+        else:
+            return get_loss_variables(rollout_batch, self.hyperams.gamma, model.recurrent), reward_batch
 
-        loss_vars = get_loss_variables(rollout_batch, self.hyperams.gamma, model.recurrent)
+    def _get_vtrace_loss_variables(self, model, rollout_batch):
+        from a2c.losses import get_vtrace_loss_variables
+        return get_vtrace_loss_variables(model, rollout_batch, self.hyperams.gamma, model.recurrent,
+                                         rho_bar=self.hyperams.vtrace_rho_bar,
+                                         c_bar=self.hyperams.vtrace_c_bar)
+
+    def _update_with_loss_variables(self, model, loss_vars):
+        """ updates the network using the loss variables of a roll-out """
+        from a2c.losses import a2c_loss, batch_loss_variables
 
         if self.hyperams.batch:
             for loss_vars_batch in batch_loss_variables(loss_vars, self.hyperams.batch_size):
@@ -240,51 +807,155 @@ class Trainer:
 
         return losses
 
+    def _apply_flat_gradients(self, model, flat_grads):
+        """ updates the network with gradients computed by a worker process """
+        from a2c.losses import unflatten_gradients
+        grads = unflatten_gradients(flat_grads, model.trainable_variables)
+        self.optimizer.apply_gradients(zip(grads, model.trainable_variables))
+
     def _log_rollout(self, summary_writer, episode, rollout_batch, losses=None):
         """ logs the performance of the roll-out """
-        episode_length = len(rollout_batch[2][0])
+        self._log_rewards(summary_writer, episode, rollout_batch[2], losses=losses)
+
+    def _log_rewards(self, summary_writer, episode, reward_batch, losses=None):
+        """ logs the performance of a roll-out given only its rewards """
+        episode_length = len(reward_batch[0])
         logger.info(f"Episode {episode}, length: {episode_length}")
         if losses is not None:
             logger.info(f"Actor loss: {losses[0]:.3f}, Critic loss: {losses[1]:.3f}")
 
-        returns = []
-        max_masses = []
-        average_masses = []
-        efficiencies = []
-
-        for rewards in rollout_batch[2]:
-            episode_return = rewards.sum()
-            mass = 10 + rewards.cumsum()
-            eff = get_efficiency(rewards, episode_length, self.hyperams)
+        performance = get_performance(reward_batch, episode_length, self.hyperams)
 
-            returns.append(episode_return)
-            max_masses.append(mass.max())
-            average_masses.append(mass.mean())
-            efficiencies.append(eff)
-
-        print(f"Average Ep Return:\t{np.mean(returns):.2f}")
-        print(f"Average Max mass:\t{np.mean(max_masses):.2f}")
-        print(f"Average Avg mass:\t{np.mean(average_masses):.2f}")
-        print(f"Average efficiency:\t{np.mean(efficiencies):.2f}")
+        print(f"Average Ep Return:\t{performance['return']:.2f}")
+        print(f"Average Max mass:\t{performance['max_mass']:.2f}")
+        print(f"Average Avg mass:\t{performance['average_mass']:.2f}")
+        print(f"Average efficiency:\t{performance['efficiency']:.2f}")
 
         if summary_writer is not None:  # in debug mode theres no directory to write to
             import tensorflow as tf
             with summary_writer.as_default():
-                tf.summary.scalar('train/efficiency', np.mean(efficiencies), step=episode)
+                tf.summary.scalar('train/efficiency', performance['efficiency'], step=episode)
                 if losses is not None:
                     tf.summary.scalar('loss/actor', losses[0], step=episode)
                     tf.summary.scalar('loss/critic', losses[1], step=episode)
 
+    def _log_staleness(self, summary_writer, episode, staleness):
+        """ logs how many updates behind the learner's weights were those that
+        generated the data being trained on """
+        logger.info(f"Staleness: {staleness} updates")
+        if summary_writer is not None:
+            import tensorflow as tf
+            with summary_writer.as_default():
+                tf.summary.scalar('async/staleness', staleness, step=episode)
+
+    def _log_queue(self, summary_writer, episode, coordinator):
+        """ logs the state of the queue of data from the asynchronous workers """
+        stats = coordinator.stats()
+        logger.info(f"Queue depth: {stats['queue_depth']}, dropped: {stats['dropped']}, "
+                    f"worker wait: {stats['worker_wait_time']:.3f} s")
+
+        if summary_writer is not None:
+            import tensorflow as tf
+            with summary_writer.as_default():
+                tf.summary.scalar('queue/depth', stats['queue_depth'], step=episode)
+                tf.summary.scalar('queue/dropped', stats['dropped'], step=episode)
+                tf.summary.scalar('queue/worker_wait_time', stats['worker_wait_time'], step=episode)
+
+    def _log_evaluation(self, summary_writer, episode, metrics):
+        """ logs the performance of the weights from the given episode on the test environment """
+        logger.info(f"Evaluation of episode {episode}: return {metrics['return']:.2f}, "
+                    f"max mass {metrics['max_mass']:.2f}, efficiency {metrics['efficiency']:.2f}")
+        if summary_writer is not None:
+            import tensorflow as tf
+            with summary_writer.as_default():
+                for name, value in metrics.items():
+                    tf.summary.scalar(f'test/{name}', value, step=episode)
+
+    def _log_first_rollout(self, summary_writer, seconds):
+        """ logs the time from starting the workers to the learner receiving their first roll-out """
+        logger.info(f"Time to first roll-out: {seconds:.1f} s")
+        if summary_writer is not None:
+            import tensorflow as tf
+            with summary_writer.as_default():
+                tf.summary.scalar('async/time_to_first_rollout', seconds, step=0)
+
+    def _log_autoscaler(self, summary_writer, episode, autoscaler):
+        """ logs the measurements behind the autoscaler's latest decision """
+        if summary_writer is None:
+            return
+        import tensorflow as tf
+        with summary_writer.as_default():
+            for name, value in autoscaler.stats.items():
+                tf.summary.scalar(f'autoscaler/{name}', value, step=episode)
+
+    def _log_prefetch(self, summary_writer, episode, prefetcher):
+        """ logs how much of the time spent preparing roll-outs was hidden from the learner """
+        stats = prefetcher.stats()
+        logger.info(f"Prefetch: prepare {stats['prepare_time']:.3f} s, wait {stats['wait_time']:.3f} s, "
+                    f"hidden {stats['hidden_time']:.3f} s per roll-out")
+
+        if summary_writer is not None:
+            import tensorflow as tf
+            with summary_writer.as_default():
+                tf.summary.scalar('prefetch/prepare_time', stats['prepare_time'], step=episode)
+                tf.summary.scalar('prefetch/wait_time', stats['wait_time'], step=episode)
+                tf.summary.scalar('prefetch/hidden_time', stats['hidden_time'], step=episode)
+
+    def _log_inference(self, summary_writer, episode, inference_server, num_workers):
+        """ logs the throughput of the inference server
+        :param num_workers: the number of workers currently sending it observations
+        """
+        stats = inference_server.stats()
+        logger.info(f"Inference: {stats['observations_per_second']:.1f} obs/s "
+                    f"with {num_workers} workers, "
+                    f"mean batch size: {stats['mean_batch_size']:.1f}, "
+                    f"utilization: {stats['utilization']:.2f}")
+
+        if summary_writer is not None:
+            import tensorflow as tf
+            with summary_writer.as_default():
+                tf.summary.scalar('inference/observations_per_second',
+                                  stats['observations_per_second'], step=episode)
+                tf.summary.scalar('inference/mean_batch_size', stats['mean_batch_size'], step=episode)
+                tf.summary.scalar('inference/utilization', stats['utilization'], step=episode)
+
     def _test(self, model, summary_writer=None, episode_length=None):
         logger.info(f"Testing performance...")
         episode_length = episode_length or self.hyperams.episode_length
-        rollout = get_rollout(model, self.test_env, self.hyperams.agents_per_env,
+        rollout = get_rollout(ModelPolicy(model), self.test_env, self.hyperams.agents_per_env,
                               episode_length, self.to_action)
 
         # todo: pass the real summary writer to log results to TensorBoard.
         self._log_rollout(summary_writer, "test", rollout.as_batch(), episode_length)
 
 
+def get_performance(reward_batch, episode_length, hyperams):
+    """ measures the performance of a roll-out from the rewards of each of its agents
+    :return: dictionary of the mean return, maximum mass, average mass and efficiency
+    """
+    returns = []
+    max_masses = []
+    average_masses = []
+    efficiencies = []
+
+    for rewards in reward_batch:
+        episode_return = rewards.sum()
+        mass = 10 + rewards.cumsum()
+        eff = get_efficiency(rewards, episode_length, hyperams)
+
+        returns.append(episode_return)
+        max_masses.append(mass.max())
+        average_masses.append(mass.mean())
+        efficiencies.append(eff)
+
+    return {
+        'return': np.mean(returns),
+        'max_mass': np.mean(max_masses),
+        'average_mass': np.mean(average_masses),
+        'efficiency': np.mean(efficiencies)
+    }
+
+
 def get_efficiency(rewards, episode_length, hyperams):
     """ calculates the "agario mass efficiency", which is a quantity that i invented lol
     It is supposed to capture the rate at which mass was accumulated relative to
@@ -0,0 +1,36 @@
+"""
+File: worker_context
+"""
+
+import multiprocessing
+
+# imported once by the forkserver so that workers forked from it start warm
+PRELOAD_MODULES = [
+    "numpy",
+    "tensorflow",
+    "gym",
+    "gym_agario",
+    "a2c.eager_models",
+    "a2c.losses",
+    "a2c.training",
+]
+
+
+def worker_context(start_method="fork", preload=PRELOAD_MODULES):
+    """ the multiprocessing context with which to start worker processes.
+
+    With "forkserver", workers are forked from a server process which has
+    already imported `preload`, so that each worker doesn't spend seconds
+    importing TensorFlow and gym itself. The server is started by the
+    first worker and is shared by every run in this process, e.g. every run
+    of a hyper-parameter sweep, so the imports are only paid for once.
+    Modules that can't be imported are skipped by the server.
+
+    :param start_method: "fork", "forkserver" or "spawn"
+    :param preload: modules for the forkserver to import
+    :return: the multiprocessing context
+    """
+    context = multiprocessing.get_context(start_method)
+    if start_method == "forkserver":
+        context.set_forkserver_preload(list(preload))
+    return context
@@ -0,0 +1,275 @@
+"""
+File: apex
+
+Distributed prioritized experience replay (Ape-X, Horgan et al. 2018).
+
+Actor processes each play their own environment with a fixed epsilon
+from a ladder spanning greedy to exploratory. They compute the initial
+priorities of their transitions with their own copies of the networks
+and send them to the learner in blocks. The learner owns the prioritized
+replay memory, trains on it continuously and periodically publishes its
+weights to shared memory, from which the actors load them.
+"""
+
+import time
+import queue
+import numpy as np
+
+import torch
+import torch.multiprocessing as mp
+
+from dqn import HyperParameters
+from dqn.training import Trainer
+from dqn.replay_memory import Transition
+from log import tensorboard
+
+import logging
+logger = logging.getLogger("root")
+
+
+def epsilon_ladder(num_actors, epsilon=0.4, alpha=7):
+    """ the exploration rate of each actor: epsilon ^ (1 + alpha * i / (N - 1)) """
+    if num_actors == 1:
+        return np.array([epsilon])
+    return np.power(epsilon, 1 + alpha * np.arange(num_actors) / (num_actors - 1))
+
+
+class SharedWeights:
+    """ the learner's online and target network weights in shared memory """
+    def __init__(self, q, target_q):
+        def share(module):
+            return {name: tensor.detach().cpu().clone().share_memory_()
+                    for name, tensor in module.state_dict().items()}
+
+        self.q = share(q)
+        self.target_q = share(target_q)
+        self.version = mp.Value('l', 0, lock=False)
+        self.lock = mp.Lock()
+
+    def publish(self, q, target_q):
+        """ copies the weights of the networks into shared memory """
+        with self.lock:
+            for shared, module in ((self.q, q), (self.target_q, target_q)):
+                for name, tensor in module.state_dict().items():
+                    shared[name].copy_(tensor)
+            self.version.value += 1
+
+    def load(self, q, target_q, version):
+        """ loads the weights into the networks if they've been published since `version`
+        :return: the version of the weights in the networks
+        """
+        if self.version.value == version:
+            return version
+        with self.lock:
+            q.load_state_dict(self.q)
+            target_q.load_state_dict(self.target_q)
+            return self.version.value
+
+
+class Actor(Trainer):
+    """ plays episodes with a fixed epsilon and sends their transitions to the
+    learner instead of training on them. Transitions are never added to the
+    actor's own replay memory, so `train_episode` never takes a gradient step. """
+
+    def __init__(self, aid, env, q, target_q, hyperams: HyperParameters, epsilon,
+                 weights: SharedWeights, messages, stop, extractor=None):
+        super(Actor, self).__init__(env, q, target_q, hyperams, extractor=extractor)
+        self.aid = aid
+        self.fixed_epsilon = epsilon
+        self.weights = weights
+        self.weights_version = -1
+        self.messages = messages
+        self.stop = stop
+        self.block = []
+        self.block_continues = False  # whether the block continues the last one sent
+
+        self.set_seed(hyperams.seed + 1 + aid)
+        self.load_weights()
+
+    @property
+    def epsilon(self):
+        return self.fixed_epsilon
+
+    def load_weights(self):
+        self.weights_version = self.weights.load(self.q, self.target_q, self.weights_version)
+
+    def remember(self, transition: Transition, continues=False):
+        if self.block and not continues:
+            self.prioritize()
+        if not self.block:
+            self.block_continues = continues
+
+        state, next_state = transition.state, transition.next_state
+        self.block.append(Transition(np.asarray(state, dtype=np.float32),
+                                     transition.action,
+                                     None if next_state is None else np.asarray(next_state, dtype=np.float32),
+                                     transition.reward))
+
+        if len(self.block) >= self.hyperams.actor_block_size:
+            self.prioritize()
+        if self.time_steps % self.hyperams.actor_sync_freq == 0:
+            self.load_weights()
+
+    def prioritize(self):
+        """ sends the block of transitions to the learner with their TD errors """
+        if not self.block:
+            return
+        errors = np.atleast_1d(self.get_errors(self.block))
+        self.send(("transitions", self.aid, self.block, errors, self.block_continues))
+        self.block = []
+
+    def send(self, message):
+        while not self.stop.is_set():
+            try:
+                self.messages.put(message, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+
+def actor_task(aid, get_env, get_networks, get_extractor, hyperams, epsilon, weights, messages, stop):
+    """ plays episodes until told to stop """
+    torch.set_num_threads(1)
+    env = get_env()
+    q, target_q = get_networks()
+    extractor = get_extractor() if get_extractor is not None else None
+    actor = Actor(aid, env, q, target_q, hyperams, epsilon, weights, messages, stop, extractor=extractor)
+
+    q.train()
+    while not stop.is_set():
+        ep_return = actor.train_episode()
+        actor.send(("episode", aid, ep_return))
+
+    messages.cancel_join_thread()
+    env.close()
+
+
+class ApeX:
+    """ trains a DQN with actor processes feeding a single learner """
+
+    def __init__(self, trainer: Trainer, get_env, get_networks, get_extractor=None):
+        """ Construct
+        :param trainer: Trainer of the learner's networks, whose environment isn't used
+        :param get_env: function which makes an environment for an actor
+        :param get_networks: function which makes an online and target Q network for an actor
+        :param get_extractor: function which makes a feature extractor for an actor, or None
+        """
+        self.trainer = trainer
+        self.hyperams = trainer.hyperams
+        self.get_env = get_env
+        self.get_networks = get_networks
+        self.get_extractor = get_extractor
+
+        self.actor_episodes = np.zeros(self.hyperams.num_actors, dtype=int)
+        self.last_block = None  # actor whose episode the last block pushed was from
+        self.num_transitions = 0
+        self.num_gradient_steps = 0
+        self.train_time = 0.0  # seconds the learner spent taking gradient steps
+
+    def train(self, num_episodes=None, training_dir=None, resume=False):
+        """ trains until the actors have played `num_episodes` episodes in total,
+        including those before the checkpoint that a resumed run starts from """
+        num_episodes = num_episodes or self.hyperams.num_episodes
+        trainer = self.trainer
+        checkpoints = trainer.open_training_dir(training_dir, resume)
+
+        weights = SharedWeights(trainer.q, trainer.target_q)
+        messages = mp.Queue(maxsize=4 * self.hyperams.num_actors)
+        stop = mp.Event()
+
+        epsilons = epsilon_ladder(self.hyperams.num_actors, self.hyperams.apex_epsilon, self.hyperams.apex_alpha)
+        logger.info(f"Starting {len(epsilons)} actors with epsilons: {np.round(epsilons, 4)}")
+        actors = [mp.Process(target=actor_task,
+                             args=(aid, self.get_env, self.get_networks, self.get_extractor,
+                                   self.hyperams, epsilon, weights, messages, stop))
+                  for aid, epsilon in enumerate(epsilons)]
+        for actor in actors:
+            actor.start()
+
+        trainer.q.train()
+        start = last_log = time.time()
+        try:
+            while trainer.episodes < num_episodes:
+                self.check_actors(actors)
+                self.receive(messages, block=not trainer.replay_memory.full())
+
+                if trainer.replay_memory.full():
+                    step_start = time.time()
+                    trainer.gradient_step()
+                    self.num_gradient_steps += 1
+                    if trainer.gradient_steps % self.hyperams.learner_publish_freq == 0:
+                        weights.publish(trainer.q, trainer.target_q)
+                    self.train_time += time.time() - step_start
+
+                trainer.maybe_checkpoint(checkpoints)
+                if time.time() - last_log > 10:
+                    self.log_throughput(time.time() - start)
+                    last_log = time.time()
+        finally:
+            stop.set()
+            for actor in actors:
+                while actor.is_alive():
+                    self.drain(messages)
+                    actor.join(timeout=0.1)
+            trainer.finish_training(checkpoints)
+
+        self.log_throughput(time.time() - start)
+
+    def check_actors(self, actors):
+        """ raises an error if an actor has exited, since actors only exit
+        once told to stop and the learner would otherwise wait for them forever """
+        for aid, actor in enumerate(actors):
+            if actor.exitcode is not None:
+                raise RuntimeError(f"Ape-X actor {aid} exited with code {actor.exitcode}")
+
+    def receive(self, messages, block):
+        """ handles the messages from the actors that have arrived, taking at
+        most one per actor so that the learner keeps taking gradient steps
+        :param block: wait for a message if none have arrived
+        """
+        for i in range(self.hyperams.num_actors):
+            try:
+                message = messages.get(block=block and i == 0, timeout=1)
+            except queue.Empty:
+                return
+            self.handle(message)
+
+    def handle(self, message):
+        kind, aid = message[:2]
+        trainer = self.trainer
+        if kind == "transitions":
+            _, _, transitions, errors, continues = message
+            # a block only continues the actor's last one if no other actor's came in between
+            continues = continues and self.last_block == aid
+            with trainer.replay_lock:
+                for i, (error, transition) in enumerate(zip(errors, transitions)):
+                    trainer.replay_memory.push(error, transition, continues or i > 0)
+            self.last_block = None if transitions[-1].next_state is None else aid
+            self.num_transitions += len(transitions)
+
+        elif kind == "episode":
+            ep_return = message[2]
+            tensorboard.log_scalar(f"train/actor_{aid}/EpisodeReturns", ep_return, self.actor_episodes[aid])
+            trainer.log_episode(ep_return)
+            self.actor_episodes[aid] += 1
+
+    def drain(self, messages):
+        """ discards any messages waiting, so that the actors can exit """
+        try:
+            while True:
+                messages.get_nowait()
+        except queue.Empty:
+            pass
+
+    def log_throughput(self, elapsed):
+        """ logs the rate at which the actors produce transitions and how busy the learner is """
+        trainer = self.trainer
+        transition_rate = self.num_transitions / elapsed
+        step_rate = self.num_gradient_steps / elapsed
+        utilization = self.train_time / elapsed
+        logger.info(f"Ape-X: {transition_rate:.1f} transitions/s from {self.hyperams.num_actors} actors, "
+                    f"{step_rate:.1f} gradient steps/s, learner utilization {100 * utilization:.0f}%")
+
+        tensorboard.log_scalar("apex/transitions_per_second", transition_rate, trainer.episodes)
+        tensorboard.log_scalar("apex/gradient_steps_per_second", step_rate, trainer.episodes)
+        tensorboard.log_scalar("apex/learner_utilization", utilization, trainer.episodes)
@@ -0,0 +1,206 @@
+"""
+File: benchmark
+
+Micro-benchmarks for the DQN replay memory.
+
+    python -m dqn.benchmark replay --capacity 1000000 --batch-size 32
+    python -m dqn.benchmark memory --capacity 10000 --shape 5 128 128
+    python -m dqn.benchmark codecs --shape 5 128 128
+    python -m dqn.benchmark assembly --shape 5 128 128 --batch-sizes 32 128 512 1024
+"""
+
+import time
+import argparse
+import numpy as np
+import torch
+
+from dqn.replay_memory import SumTree, ReplayMemory, Transition
+from dqn.replay_storage import make_frame_store
+from dqn.staging import BatchStaging
+
+
+def benchmark_sum_tree(capacity, batch_size, iterations):
+    """ times sampling a batch of leaves from a full tree and updating
+    their priorities, both batched and one leaf at a time
+    :return: dictionary of microseconds per batch for each method
+    """
+    tree = SumTree(capacity)
+    tree.update_batch(np.arange(capacity) + tree.num_leaves - 1, np.random.uniform(0.1, 2, size=capacity))
+    tree.n_entries = capacity
+
+    def stratified():
+        segment = tree.total() / batch_size
+        return (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+
+    def batched():
+        idxs, _, _ = tree.get_batch(stratified())
+        tree.update_batch(idxs, np.random.uniform(0.1, 2, size=batch_size))
+
+    def one_at_a_time():
+        for s in stratified():
+            idx, _, _ = tree.get(s)
+            tree.update(idx, np.random.uniform(0.1, 2))
+
+    results = {}
+    for name, method in [("batched", batched), ("one at a time", one_at_a_time)]:
+        method()  # warm up
+        start = time.perf_counter()
+        for _ in range(iterations):
+            method()
+        results[name] = 1e6 * (time.perf_counter() - start) / iterations
+    return results
+
+
+def benchmark_memory(capacity, shape, episode_length=500):
+    """ fills a replay memory with `capacity` transitions of float64 frames, as made
+    by the feature extractor, in episodes of `episode_length` steps
+    :return: bytes per transition stored by the replay memory, and bytes per
+    transition of the frames themselves were they kept as they are made
+    """
+    memory = ReplayMemory(capacity)
+    frame = np.zeros(shape)
+    for t in range(capacity):
+        next_frame = None if (t + 1) % episode_length == 0 else np.zeros(shape)
+        memory.push(1.0, Transition(frame, 0, next_frame, 0.0), continues=t % episode_length > 0)
+        frame = next_frame if next_frame is not None else np.zeros(shape)
+
+    # each distinct frame is one float64 array, plus the last frame of each episode
+    frames = capacity + capacity // episode_length
+    return memory.nbytes / capacity, frames * frame.nbytes / capacity
+
+
+def grid_frame(shape, num_entities=40):
+    """ a frame like those made by the grid feature extractor: mostly zeros,
+    a few entities with counts or masses and an out of bounds border of -1 """
+    frame = np.zeros(shape, dtype=np.float32)
+    for channel in frame:
+        xs, ys = np.random.randint(0, shape[-1], size=(2, num_entities))
+        channel[xs, ys] = np.random.randint(1, 4, size=num_entities)
+        border = np.random.randint(0, shape[-1] // 4)
+        channel[:border] = -1
+    frame[1, shape[-1] // 2, shape[-1] // 2] = np.random.uniform(1, 50)  # the agent's mass
+    return frame
+
+
+def benchmark_codecs(shape, batch_size, num_frames=1000):
+    """ times storing frames one at a time and loading them in batches with each codec
+    :return: dictionary of (bytes per frame, frames stored per second,
+    frames loaded per second, maximum absolute error) for each codec
+    """
+    frames = [grid_frame(shape) for _ in range(num_frames)]
+    results = {}
+    for codec in ["float32", "float16", "uint8", "zlib"]:
+        store = make_frame_store(codec, num_frames, shape)
+
+        start = time.perf_counter()
+        for slot, frame in enumerate(frames):
+            store[slot] = frame
+        encode = num_frames / (time.perf_counter() - start)
+
+        batches = [np.random.randint(num_frames, size=batch_size) for _ in range(num_frames // batch_size)]
+        start = time.perf_counter()
+        for slots in batches:
+            store[slots]
+        decode = len(batches) * batch_size / (time.perf_counter() - start)
+
+        error = np.abs(store[np.arange(num_frames)] - np.stack(frames)).max()
+        results[codec] = store.nbytes / num_frames, encode, decode, error
+    return results
+
+
+def benchmark_assembly(shape, batch_sizes, iterations, device="cpu"):
+    """ times assembling batches of tensors from sampled replay memory slots,
+    from a replay memory holding twice the largest batch of transitions
+    :return: dictionary of milliseconds per batch of each method for each batch size
+    """
+    capacity = 2 * max(batch_sizes)
+    memory = ReplayMemory(capacity)
+    frames = [np.random.randn(*shape) for _ in range(capacity + 1)]
+    transitions = []
+    for i in range(capacity):
+        next_state = None if i % 100 == 99 else frames[i + 1]
+        transitions.append(Transition(frames[i], 0, next_state, 0.0))
+        memory.push(1.0, transitions[-1], continues=i % 100 > 0)
+
+    def from_transitions(slots):
+        """ stacking a list of Transitions of float64 frames """
+        batch = Transition(*zip(*[transitions[i] for i in slots]))
+
+        def to_tensor(array_list):
+            tensors = tuple(torch.from_numpy(np.array(a)) for a in array_list if a is not None)
+            return torch.stack(tensors, dim=0).type(torch.FloatTensor).to(device)
+
+        mask = torch.tensor(tuple(s is not None for s in batch.next_state), device=device, dtype=torch.uint8)
+        return to_tensor(batch.state), to_tensor(batch.action).to(torch.long), \
+               to_tensor(batch.reward), mask, to_tensor(batch.next_state)
+
+    def gathered(slots):
+        """ gathering into new arrays and wrapping them in tensors """
+        batch = memory.gather(slots)
+        return tuple(torch.from_numpy(a).to(device) for a in batch)
+
+    results = {}
+    for batch_size in batch_sizes:
+        staging = BatchStaging(batch_size, shape, device)
+
+        def staged(slots):
+            """ gathering into preallocated (pinned) tensors """
+            return staging.to_tensor_batch(memory.gather(slots, out=staging.arrays))
+
+        results[batch_size] = {}
+        for method in [from_transitions, gathered, staged]:
+            batches = [np.random.randint(capacity, size=batch_size) for _ in range(iterations + 1)]
+            method(batches[0])  # warm up
+            start = time.perf_counter()
+            for slots in batches[1:]:
+                method(slots)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            results[batch_size][method.__name__] = 1e3 * (time.perf_counter() - start) / iterations
+    return results
+
+
+def main():
+    args = parse_args()
+    if args.benchmark == "replay":
+        results = benchmark_sum_tree(args.capacity, args.batch_size, args.iterations)
+        print(f"capacity {args.capacity}, batch size {args.batch_size}: sample + update")
+        for name, microseconds in results.items():
+            print(f"{name}:\t{microseconds:.1f} us per batch")
+
+    elif args.benchmark == "codecs":
+        results = benchmark_codecs(tuple(args.shape), args.batch_size)
+        print(f"frames of shape {tuple(args.shape)}, loaded in batches of {args.batch_size}")
+        for codec, (nbytes, encode, decode, error) in results.items():
+            print(f"{codec}:\t{nbytes / 1e3:.1f} KB per frame ({1e6 / nbytes:.1f}k frames per GB), "
+                  f"store {encode:.0f} frames/s, load {decode:.0f} frames/s, max error {error:.3g}")
+
+    elif args.benchmark == "assembly":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        results = benchmark_assembly(tuple(args.shape), args.batch_sizes, args.iterations, device)
+        print(f"frames of shape {tuple(args.shape)} on {device}: milliseconds to assemble a batch")
+        methods = list(next(iter(results.values())))
+        print("batch size\t" + "\t".join(methods))
+        for batch_size, times in results.items():
+            print(f"{batch_size}\t\t" + "\t\t".join(f"{times[method]:.2f}" for method in methods))
+
+    elif args.benchmark == "memory":
+        stored, frames = benchmark_memory(args.capacity, tuple(args.shape))
+        print(f"capacity {args.capacity}, frames of shape {tuple(args.shape)}")
+        print(f"replay memory:\t{stored / 1e3:.1f} KB per transition")
+        print(f"float64 frames:\t{frames / 1e3:.1f} KB per transition ({frames / stored:.2f}x)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the DQN replay memory")
+    parser.add_argument("benchmark", choices=["replay", "memory", "codecs", "assembly"])
+    parser.add_argument("--capacity", type=int, default=1000000)
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=32)
+    parser.add_argument("--batch-sizes", dest="batch_sizes", type=int, nargs="+", default=[32, 64, 128, 256, 512, 1024])
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--shape", type=int, nargs="+", default=[5, 128, 128])
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+File: hogwild
+
+Hogwild! DQN training (Recht et al. 2011): several processes, each with
+its own environment, replay memory shard and optimizer, act and learn at
+the same time, applying their gradient updates without any locking to a
+single pair of Q networks kept in shared memory.
+"""
+
+import time
+import queue
+import numpy as np
+
+import torch
+import torch.multiprocessing as mp
+
+from dqn import HyperParameters
+from dqn.training import Trainer
+from dqn.replay_memory import ReplayMemory
+from log import tensorboard
+
+import logging
+logger = logging.getLogger("root")
+
+
+class HogwildWorker(Trainer):
+    """ trains the shared networks on a replay memory shard of its own. The
+    gradient steps of all of the workers are counted together, which sets
+    epsilon and when the shared target network is updated. """
+
+    def __init__(self, wid, env, q, target_q, hyperams: HyperParameters, global_steps, extractor=None):
+        super(HogwildWorker, self).__init__(env, q, target_q, hyperams, extractor=extractor)
+        self.wid = wid
+        self.global_steps = global_steps
+
+        shard_capacity = hyperams.replay_memory_capacity // hyperams.hogwild_workers
+        self.replay_memory = ReplayMemory(shard_capacity, codec=hyperams.replay_codec)
+        self.set_seed(hyperams.seed + 1 + wid)
+
+    @property
+    def epsilon(self):
+        r = np.exp(- self.hyperams.epsilon_decay * self.global_steps.value)
+        diff = self.hyperams.epsilon_base - self.hyperams.epsilon_end
+        return self.hyperams.epsilon_end + r * diff
+
+    def gradient_step(self):
+        self.train_step()
+        self.gradient_steps += 1
+
+        with self.global_steps.get_lock():
+            self.global_steps.value += 1
+            step = self.global_steps.value
+
+        if step % self.hyperams.target_update_freq == 0:
+            self.update_target_network()
+
+
+def worker_task(wid, get_env, get_extractor, q, target_q, hyperams, global_steps, episodes_left, messages):
+    """ trains on episodes until enough have been played by all of the workers """
+    torch.set_num_threads(hyperams.hogwild_threads)
+    env = get_env()
+    extractor = get_extractor() if get_extractor is not None else None
+    worker = HogwildWorker(wid, env, q, target_q, hyperams, global_steps, extractor=extractor)
+
+    q.train()
+    try:
+        while True:
+            with episodes_left.get_lock():
+                if episodes_left.value <= 0:
+                    break
+                episodes_left.value -= 1
+
+            ep_return = worker.train_episode()
+            messages.put((wid, ep_return, worker.time_steps))
+    finally:
+        worker.finish_training()
+        env.close()
+
+
+class Hogwild:
+    """ trains a DQN with several processes sharing its networks """
+
+    def __init__(self, trainer: Trainer, get_env, get_extractor=None):
+        """ Construct
+        :param trainer: Trainer of the networks to share, whose environment isn't used.
+        It logs the episodes and saves checkpoints of the shared networks.
+        :param get_env: function which makes an environment for a worker
+        :param get_extractor: function which makes a feature extractor for a worker, or None
+        """
+        self.trainer = trainer
+        self.hyperams = trainer.hyperams
+        self.get_env = get_env
+        self.get_extractor = get_extractor
+
+    def train(self, num_episodes=None, training_dir=None, resume=False):
+        """ trains until the workers have played `num_episodes` episodes in total,
+        including those before the checkpoint that a resumed run starts from """
+        num_episodes = num_episodes or self.hyperams.num_episodes
+        trainer = self.trainer
+        if torch.device(trainer.device).type != "cpu":
+            raise ValueError(f"Hogwild shares its networks through CPU shared memory, "
+                             f"so they can't be on {trainer.device}")
+        checkpoints = trainer.open_training_dir(training_dir, resume)
+
+        trainer.q.share_memory()
+        trainer.target_q.share_memory()
+        global_steps = mp.Value('l', trainer.gradient_steps)
+        episodes_left = mp.Value('l', max(num_episodes - trainer.episodes, 0))
+        messages = mp.Queue()
+
+        num_workers = self.hyperams.hogwild_workers
+        logger.info(f"Starting {num_workers} Hogwild workers")
+        workers = [mp.Process(target=worker_task,
+                              args=(wid, self.get_env, self.get_extractor, trainer.q, trainer.target_q,
+                                    self.hyperams, global_steps, episodes_left, messages))
+                   for wid in range(num_workers)]
+        for worker in workers:
+            worker.start()
+
+        start = time.time()
+        first_step, first_time_step = trainer.gradient_steps, trainer.time_steps
+        worker_episodes = np.zeros(num_workers, dtype=int)
+        worker_steps = np.zeros(num_workers, dtype=int)
+        while any(worker.is_alive() for worker in workers) or not messages.empty():
+            self.check_workers(workers)
+            try:
+                wid, ep_return, time_steps = messages.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            tensorboard.log_scalar(f"train/worker_{wid}/EpisodeReturns", ep_return, worker_episodes[wid])
+            worker_episodes[wid] += 1
+            worker_steps[wid] = time_steps
+
+            trainer.gradient_steps = global_steps.value
+            trainer.time_steps = first_time_step + int(worker_steps.sum())
+            trainer.log_episode(ep_return)
+            trainer.maybe_checkpoint(checkpoints)
+
+        for worker in workers:
+            worker.join()
+        self.check_workers(workers)
+
+        trainer.gradient_steps = global_steps.value
+        elapsed = time.time() - start
+        logger.info(f"Hogwild: {(trainer.time_steps - first_time_step) / elapsed:.1f} steps/s and "
+                    f"{(trainer.gradient_steps - first_step) / elapsed:.1f} gradient steps/s "
+                    f"from {num_workers} workers")
+        trainer.finish_training(checkpoints)
+
+    def check_workers(self, workers):
+        """ raises an error if a worker has failed, since the episode it was
+        playing is never played, after stopping the other workers """
+        failed = [(wid, worker) for wid, worker in enumerate(workers) if worker.exitcode not in (None, 0)]
+        if not failed:
+            return
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        wid, worker = failed[0]
+        raise RuntimeError(f"Hogwild worker {wid} exited with code {worker.exitcode}")
@@ -40,6 +40,26 @@ class HyperParameters(object):
 
         self.batch_size = 32
         self.replay_memory_capacity = 10000
+        self.replay_codec = "float32"  # float32, float16, uint8 or zlib
+        self.replay_on_disk = False  # memory map the replay memory into the training directory
+        self.priority_init = "td"  # td, max or batched: see Trainer.remember
+        self.priority_init_batch = 32
+        self.prefetch_depth = 0  # batches sampled ahead of the gradient steps, 0 = none
+
+        self.num_envs = 1  # environments stepped together
+        self.remote_envs = False  # step each environment in a process of its own
+
+        # Ape-X: actor processes feeding a single learner, when num_actors > 0
+        self.num_actors = 0
+        self.apex_epsilon = 0.4  # actor i explores with apex_epsilon ^ (1 + apex_alpha * i / (num_actors - 1))
+        self.apex_alpha = 7
+        self.actor_block_size = 50  # transitions sent to the learner at once
+        self.actor_sync_freq = 400  # actor steps between loading the learner's weights
+        self.learner_publish_freq = 50  # gradient steps between publishing the learner's weights
+
+        # Hogwild: processes training shared networks without locking, when hogwild_workers > 0
+        self.hogwild_workers = 0
+        self.hogwild_threads = 1  # torch threads in each worker
         self.lean_freq = 16
         self.target_update_freq = 128
 
@@ -53,6 +73,8 @@ class HyperParameters(object):
         self.adam_eps = 1e-8
         self.grad_clip_norm = 1
 
+        self.keep_checkpoints = 3
+
     def override(self, params):
         """
         Overrides attributes of this object with those of "params".
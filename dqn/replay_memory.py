@@ -5,97 +5,329 @@ https://github.com/rlcode/per
 
 """
 
+import os
 import numpy as np
-import random
+from collections import namedtuple
+
+from dqn.replay_storage import make_frame_store, allocate, flush
+
+import logging
+logger = logging.getLogger("root")
+
+Transition = namedtuple('Transition',
+                        ('state', 'action', 'next_state', 'reward'))
+
+# arrays for a batch of transitions. Terminal transitions have no next
+# state, so 'next_state' only has rows for those where 'done' is False.
+TransitionBatch = namedtuple('TransitionBatch',
+                             ('state', 'action', 'next_state', 'reward', 'done'))
+
+
+def stack_transitions(transitions):
+    """ stacks a list of Transitions into a TransitionBatch """
+    done = np.array([t.next_state is None for t in transitions], dtype=bool)
+    next_states = [t.next_state for t in transitions if t.next_state is not None]
+    return TransitionBatch(state=np.stack([t.state for t in transitions]).astype(np.float32),
+                           action=np.array([t.action for t in transitions], dtype=np.int64),
+                           next_state=np.stack(next_states).astype(np.float32) if next_states else None,
+                           reward=np.array([t.reward for t in transitions], dtype=np.float32),
+                           done=done)
+
 
 class ReplayMemory:  # stored as ( s, a, r, s_ ) in SumTree
+    """ prioritized replay memory storing transitions in preallocated arrays.
+
+    Slot `i` of the ring holds the state, action, reward and done flag of
+    one transition, and its next state is the state in slot `i + 1`, so
+    that each frame is stored only once. The next state of the newest
+    transition is kept aside until the following transition is pushed.
+    Callers say whether that transition continues from it. When it doesn't
+    (e.g. a new episode after one was cut short, or a run of transitions
+    from another environment) the next state is written to a slot of its
+    own with zero priority, which is never sampled but still takes up a
+    slot of the ring. The arrays are allocated when
+    the first transition is pushed, from the shape of its state. The
+    states may be stored compressed or quantized (see replay_storage).
+
+    Given a directory, the arrays are memory mapped to files in it, so the
+    memory can be larger than RAM. `save` flushes them and snapshots the
+    priority tree next to them, from which a later run can resume with the
+    memory as it was. The number of times each slot has been written is
+    kept on disk too, so that slots written after the last snapshot (which
+    no longer hold the transitions the snapshot's priorities are for) are
+    given zero priority on resuming, until they're overwritten.
+    """
     e = 0.01
     a = 0.6
     beta = 0.4
     beta_increment_per_sampling = 0.001
 
-    def __init__(self, capacity):
+    def __init__(self, capacity, codec="float32", directory=None, resume=False):
+        """ Construct
+        :param capacity: number of transitions to store
+        :param codec: how to store the states, see `make_frame_store`
+        :param directory: directory in which to memory map the transitions,
+        or None to keep them in memory
+        :param resume: open the transitions saved in `directory`
+        """
         self.tree = SumTree(capacity)
         self.capacity = capacity
+        self.codec = codec
+        self.directory = directory
+
+        self._pending = None  # next state of the newest transition
+        self._newest = None  # slot of the newest transition, if non-terminal
+        self.max_priority = 1.0  # highest priority given to any transition
+
+        snapshot = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            if resume:
+                snapshot = self._load_snapshot()
+
+        existing = snapshot is not None
+        self.states = None
+        self.actions = allocate((capacity,), np.int64, self._path("actions.npy"), existing)
+        self.rewards = allocate((capacity,), np.float32, self._path("rewards.npy"), existing)
+        self.dones = allocate((capacity,), bool, self._path("dones.npy"), existing)
+        # times each slot has been written
+        self.generations = allocate((capacity,), np.int64, self._path("generations.npy"),
+                                    existing and 'generations' in snapshot)
+
+        if snapshot is not None:
+            self._restore(snapshot)
 
     def full(self):
         return self.tree.n_entries >= self.capacity
 
+    @property
+    def nbytes(self):
+        """ bytes used to store the transitions """
+        arrays = [self.states, self.actions, self.rewards, self.dones]
+        return sum(a.nbytes for a in arrays if a is not None)
+
     def _get_priority(self, error):
         return (error + self.e) ** self.a
 
-    def push(self, error, sample):
-        p = self._get_priority(error)
-        self.tree.add(p, sample)
-
-    def sample(self, n):
-        batch = []
-        idxs = []
+    def push(self, error, transition, continues=False):
+        """ adds a transition with the priority of its TD error or, if
+        `error` is None, with the highest priority given to any transition
+        so far, so that it's sampled at least once before its error is known
+        :param continues: whether the transition's state is the next state
+        of the transition pushed just before it, i.e. they are consecutive
+        steps of the same episode
+        """
+        if self.states is None:
+            self.states = make_frame_store(self.codec, self.capacity, np.shape(transition.state), self.directory)
+
+        if self._pending is not None and not continues:
+            self._write(0, self._pending, 0, 0, True)
+
+        p = self.max_priority if error is None else self._get_priority(error)
+        self.max_priority = max(self.max_priority, p)
+        slot = self._write(p, transition.state, transition.action, transition.reward,
+                           transition.next_state is None)
+
+        if transition.next_state is None:
+            self._pending, self._newest = None, None
+        else:
+            self._pending = np.array(transition.next_state, dtype=np.float32)
+            self._newest = slot
+
+    def _write(self, p, state, action, reward, done):
+        slot = self.tree.write
+        self.states[slot] = state
+        self.actions[slot] = action
+        self.rewards[slot] = reward
+        self.dones[slot] = done
+        self.generations[slot] += 1
+        self.tree.add(p)
+        return slot
+
+    def sample(self, n, out=None):
+        """ samples a batch of `n` transitions with probability proportional to their
+        priority, taking one sample from each of `n` equal segments of the total priority
+        :param out: TransitionBatch of arrays with at least `n` rows to gather the transitions into
+        :return: TransitionBatch of the transitions, array of their tree indices and
+        array of their importance sampling weights
+        """
         segment = self.tree.total() / n
-        priorities = []
-
         self.beta = np.min([1., self.beta + self.beta_increment_per_sampling])
 
-        for i in range(n):
-            a = segment * i
-            b = segment * (i + 1)
-
-            s = random.uniform(a, b)
-            (idx, p, data) = self.tree.get(s)
-            priorities.append(p)
-            batch.append(data)
-            idxs.append(idx)
+        s = (np.arange(n) + np.random.uniform(size=n)) * segment
+        idxs, priorities, data_idxs = self.tree.get_batch(s)
+        batch = self.gather(data_idxs, out)
 
+        # normalized by the largest possible weight, that of the lowest priority transition
         sampling_probabilities = priorities / self.tree.total()
         is_weight = np.power(self.tree.n_entries * sampling_probabilities, -self.beta)
-        is_weight /= is_weight.max()
+        max_weight = np.power(self.tree.n_entries * self.tree.min() / self.tree.total(), -self.beta)
+        is_weight /= max_weight
 
         return batch, idxs, is_weight
 
-    def update(self, idx, error):
+    def gather(self, data_idxs, out=None):
+        """ gathers the transitions in the given slots into a TransitionBatch
+        :param data_idxs: slots of the transitions
+        :param out: TransitionBatch of arrays with enough rows to gather into,
+        or None to gather into new arrays
+        :return: TransitionBatch of the arrays or, given `out`, of views of its first rows
+        """
+        def rows(name, n):
+            return None if out is None else getattr(out, name)[:n]
+
+        n = len(data_idxs)
+        done = np.take(self.dones, data_idxs, out=rows('done', n))
+        non_final = data_idxs[~done]
+        next_states = self.states.load((non_final + 1) % self.capacity, rows('next_state', len(non_final)))
+        if self._newest is not None:
+            next_states[non_final == self._newest] = self._pending
+
+        return TransitionBatch(state=self.states.load(data_idxs, rows('state', n)),
+                               action=np.take(self.actions, data_idxs, out=rows('action', n)),
+                               next_state=next_states,
+                               reward=np.take(self.rewards, data_idxs, out=rows('reward', n)),
+                               done=done)
+
+    def save(self):
+        """ flushes the memory mapped transitions and snapshots the priority
+        tree and the rest of the memory's state alongside them """
+        if self.directory is None:
+            raise ValueError("Only a replay memory with a directory can be saved")
+
+        if self.states is not None:
+            self.states.flush()
+        for array in (self.actions, self.rewards, self.dones, self.generations):
+            flush(array)
+
+        snapshot = {
+            'capacity': self.capacity,
+            'codec': self.codec,
+            'state_shape': () if self.states is None else self.states.shape,
+            'has_states': self.states is not None,
+            'tree': self.tree.tree,
+            'min_tree': self.tree.min_tree,
+            'write': self.tree.write,
+            'n_entries': self.tree.n_entries,
+            'generations': self.generations,
+            'beta': self.beta,
+            'max_priority': self.max_priority,
+            'pending': np.zeros(0) if self._pending is None else self._pending,
+            'newest': -1 if self._newest is None else self._newest,
+        }
+        path = self._path("tree.npz")
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _load_snapshot(self):
+        path = self._path("tree.npz")
+        if not os.path.exists(path):
+            logger.warning(f"No replay memory to resume from in {self.directory}")
+            return None
+
+        snapshot = dict(np.load(path))
+        if int(snapshot['capacity']) != self.capacity or str(snapshot['codec']) != self.codec:
+            raise ValueError(f"Replay memory in {self.directory} has capacity {snapshot['capacity']} "
+                             f"and codec {snapshot['codec']}, not {self.capacity} and {self.codec}")
+        return snapshot
+
+    def _restore(self, snapshot):
+        if snapshot['has_states']:
+            self.states = make_frame_store(self.codec, self.capacity, tuple(snapshot['state_shape']),
+                                           self.directory, existing=True)
+        self.tree.tree[:] = snapshot['tree']
+        self.tree.min_tree[:] = snapshot['min_tree']
+        self.tree.write = int(snapshot['write'])
+        self.tree.n_entries = int(snapshot['n_entries'])
+        self.beta = float(snapshot['beta'])
+        # snapshots from before it was saved only have the priorities in the tree
+        leaves = self.tree.tree[self.tree.num_leaves - 1:]
+        self.max_priority = float(snapshot.get('max_priority', max(self.max_priority, leaves.max())))
+        if snapshot['newest'] >= 0:
+            self._pending = snapshot['pending']
+            self._newest = int(snapshot['newest'])
+
+        if 'generations' not in snapshot:
+            logger.warning(f"Replay memory in {self.directory} doesn't record which slots were "
+                           f"written after it was saved, so some transitions may be wrong")
+        else:
+            # the slots written after the snapshot follow on from `write`, so
+            # they're the first to be overwritten. Until then they're counted
+            # in `n_entries`, like the zero priority slots between episodes
+            stale = np.flatnonzero(self.generations != snapshot['generations'])
+            if len(stale) > 0:
+                self.tree.update_batch(stale + self.tree.num_leaves - 1, 0)
+                logger.info(f"Ignoring {len(stale)} replay memory slots written after it was saved")
+        logger.info(f"Resumed replay memory of {self.tree.n_entries} transitions from {self.directory}")
+
+    def _path(self, file_name):
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, file_name)
+
+    def generation(self, idx):
+        """ the number of times the slots of the given tree indices have been
+        written, which tells whether they still hold the same transitions """
+        return self.generations[np.asarray(idx) - self.tree.num_leaves + 1]
+
+    def update(self, idx, error, generation=None):
+        """ updates the priority of one transition or, given
+        arrays of indices and errors, of a batch of transitions
+        :param generation: the `generation` of the indices when their transitions
+        were sampled. Transitions that have since been overwritten are left as they are.
+        """
         p = self._get_priority(error)
-        self.tree.update(idx, p)
+        if generation is not None:
+            current = self.generation(idx) == generation
+            if np.ndim(idx) == 0:
+                if not current: return
+            else:
+                idx, p = np.asarray(idx)[current], np.broadcast_to(p, np.shape(idx))[current]
+                if len(idx) == 0: return
+
+        self.max_priority = max(self.max_priority, np.max(p))
+        if np.ndim(idx) == 0:
+            self.tree.update(idx, p)
+        else:
+            self.tree.update_batch(idx, p)
 
 
 class SumTree:
+    """ binary tree stored in an array, in which each leaf holds the priority
+    of one transition and each internal node the sum of its children. A
+    parallel tree holding the minimum of the children instead allows the
+    lowest priority to be found in constant time.
+
+    Node `i` has children `2i + 1` and `2i + 2`. The number of leaves is
+    rounded up to a power of two so that every leaf is at the same depth,
+    which lets the batched operations move all of their nodes up or down
+    the tree together one level at a time. The spare leaves have zero
+    priority, so they are never sampled. Leaves with zero priority are
+    left out of the minimum.
+    """
     write = 0
 
     def __init__(self, capacity):
         self.capacity = capacity
-        self.tree = np.zeros(2 * capacity - 1)
-        self.data = np.zeros(capacity, dtype=object)
+        self.num_leaves = 1 << max(capacity - 1, 0).bit_length()
+        self.depth = self.num_leaves.bit_length() - 1
+        self.tree = np.zeros(2 * self.num_leaves - 1)
+        self.min_tree = np.full(2 * self.num_leaves - 1, np.inf)
         self.n_entries = 0
 
-    # update to the root node
-    def _propagate(self, idx, change):
-        parent = (idx - 1) // 2
-
-        self.tree[parent] += change
-
-        if parent != 0:
-            self._propagate(parent, change)
-
-    # find sample on leaf node
-    def _retrieve(self, idx, s):
-        left = 2 * idx + 1
-        right = left + 1
-
-        if left >= len(self.tree):
-            return idx
-
-        if s <= self.tree[left]:
-            return self._retrieve(left, s)
-        else:
-            return self._retrieve(right, s - self.tree[left])
-
     def total(self):
         return self.tree[0]
 
-    # store priority and sample
-    def add(self, p, data):
-        idx = self.write + self.capacity - 1
+    def min(self):
+        """ the lowest priority of any transition """
+        return self.min_tree[0]
 
-        self.data[self.write] = data
+    # store priority in the next slot
+    def add(self, p):
+        idx = self.write + self.num_leaves - 1
         self.update(idx, p)
 
         self.write += 1
@@ -107,14 +339,64 @@ class SumTree:
 
     # update priority
     def update(self, idx, p):
-        change = p - self.tree[idx]
-
-        self.tree[idx] = p
-        self._propagate(idx, change)
-
-    # get priority and sample
+        tree, min_tree = self.tree, self.min_tree
+        tree[idx] = p
+        min_tree[idx] = p if p > 0 else np.inf
+        while idx > 0:
+            idx = (idx - 1) // 2
+            left = 2 * idx + 1
+            tree[idx] = tree[left] + tree[left + 1]
+            min_tree[idx] = min(min_tree[left], min_tree[left + 1])
+
+    def update_batch(self, idxs, ps):
+        """ sets the priorities of several leaves and updates their ancestors.
+        Parents are recomputed from their children rather than incremented, so
+        a leaf that appears more than once just takes its last priority.
+        :param idxs: tree indices of the leaves
+        :param ps: their new priorities
+        """
+        nodes = np.asarray(idxs, dtype=np.int64)
+        ps = np.broadcast_to(np.asarray(ps, dtype=np.float64), nodes.shape)
+        self.tree[nodes] = ps
+        self.min_tree[nodes] = np.where(ps > 0, ps, np.inf)
+
+        for _ in range(self.depth):
+            nodes = (nodes - 1) // 2
+            left = 2 * nodes + 1
+            self.tree[nodes] = self.tree[left] + self.tree[left + 1]
+            self.min_tree[nodes] = np.minimum(self.min_tree[left], self.min_tree[left + 1])
+
+    # get priority and slot
     def get(self, s):
-        idx = self._retrieve(0, s)
-        dataIdx = idx - self.capacity + 1
-
-        return (idx, self.tree[idx], self.data[dataIdx])
+        tree = self.tree
+        idx = 0
+        for _ in range(self.depth):
+            left = 2 * idx + 1
+            # rounding error mustn't lead to the empty leaves on the right
+            if s <= tree[left] or tree[left + 1] == 0:
+                idx = left
+            else:
+                s -= tree[left]
+                idx = left + 1
+
+        dataIdx = idx - self.num_leaves + 1
+        return (idx, tree[idx], dataIdx)
+
+    def get_batch(self, s):
+        """ finds the leaves at which each of the cumulative sums `s` falls,
+        descending the tree for all of them together one level at a time
+        :param s: array of values in [0, total())
+        :return: arrays of the leaves' tree indices, priorities and data indices
+        """
+        s = np.array(s, dtype=np.float64)
+        idxs = np.zeros(len(s), dtype=np.int64)
+
+        for _ in range(self.depth):
+            left = 2 * idxs + 1
+            left_sum = self.tree[left]
+            go_right = (s > left_sum) & (self.tree[left + 1] > 0)
+            s -= left_sum * go_right
+            idxs = left + go_right
+
+        data_idxs = idxs - self.num_leaves + 1
+        return idxs, self.tree[idxs], data_idxs
@@ -0,0 +1,187 @@
+"""
+File: replay_storage
+
+Storage for the frames held in the replay memory. Each store holds a
+fixed number of frames of one shape, written one at a time with
+`store[slot] = frame` and read back in batches as float32 with
+`store[slots]`. Besides storing them as they are, frames can be
+
+    float16: stored at half precision
+    uint8: quantized to 256 levels between the minimum and maximum of
+        each channel of each frame, whose scale and offset are kept
+        alongside
+    zlib: compressed one frame at a time, which suits the grid features
+        since they are mostly zeros
+
+All but zlib can keep their arrays in memory mapped .npy files instead
+of in memory, so that they can be larger than RAM and outlive the process.
+`store.load(slots, out)` reads a batch straight into a preallocated array.
+"""
+
+import os
+import zlib
+import numpy as np
+
+
+def allocate(shape, dtype, path=None, existing=False):
+    """ makes a zeroed array, or one memory mapped to a .npy file
+    :param path: file to map the array to, or None to keep it in memory
+    :param existing: open the array already in the file instead of creating one
+    """
+    if path is None:
+        return np.zeros(shape, dtype=dtype)
+    if not existing:
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    array = np.lib.format.open_memmap(path, mode="r+")
+    if array.shape != tuple(shape) or array.dtype != dtype:
+        raise ValueError(f"{path} holds a {array.dtype} array of shape {array.shape}, "
+                         f"not {np.dtype(dtype)} of shape {tuple(shape)}")
+    return array
+
+
+def flush(array):
+    """ writes an array's changes to its file, if it's memory mapped """
+    if isinstance(array, np.memmap):
+        array.flush()
+
+
+class FrameStore:
+    """ stores frames in a preallocated array of the given type """
+    def __init__(self, capacity, shape, dtype=np.float32, directory=None, existing=False):
+        self.shape = tuple(shape)
+        path = None if directory is None else os.path.join(directory, "states.npy")
+        self.frames = allocate((capacity,) + self.shape, dtype, path, existing)
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    def flush(self):
+        flush(self.frames)
+
+    def __setitem__(self, slot, frame):
+        self.frames[slot] = frame
+
+    def __getitem__(self, slots):
+        return self.load(slots)
+
+    def load(self, slots, out=None):
+        """ loads the frames in `slots` as float32, into `out` if given """
+        if out is None:
+            return self.frames[slots].astype(np.float32, copy=False)
+        if self.frames.dtype == out.dtype:
+            # "raise" would take into a temporary copy of `out`, which takes several
+            # times as long for a batch of frames, so the slots are checked here instead
+            slots = np.asarray(slots)
+            assert len(slots) == 0 or (slots.min() >= 0 and slots.max() < len(self.frames)), \
+                f"Frame slots out of range [0, {len(self.frames)})"
+            return np.take(self.frames, slots, axis=0, out=out, mode="clip")
+        out[...] = self.frames[slots]
+        return out
+
+
+class QuantizedFrameStore:
+    """ stores frames as uint8, mapping the range of each channel of
+    each frame onto 0-255. The channels are the first axis of a frame,
+    or the whole frame if it's a vector. """
+    def __init__(self, capacity, shape, directory=None, existing=False):
+        self.shape = tuple(shape)
+        channels = self.shape[0] if len(self.shape) > 1 else 1
+
+        def path(name):
+            return None if directory is None else os.path.join(directory, f"states-{name}.npy")
+
+        self.codes = allocate((capacity, channels, int(np.prod(self.shape)) // channels), np.uint8,
+                              path("codes"), existing)
+        self.scales = allocate((capacity, channels, 1), np.float32, path("scales"), existing)
+        self.offsets = allocate((capacity, channels, 1), np.float32, path("offsets"), existing)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes + self.offsets.nbytes
+
+    def flush(self):
+        for array in (self.codes, self.scales, self.offsets):
+            flush(array)
+
+    def __setitem__(self, slot, frame):
+        channels = np.asarray(frame, dtype=np.float32).reshape(self.codes.shape[1:])
+        low = channels.min(axis=1, keepdims=True)
+        scale = (channels.max(axis=1, keepdims=True) - low) / 255
+        scale[scale == 0] = 1  # constant channels
+
+        self.codes[slot] = np.rint((channels - low) / scale)
+        self.scales[slot] = scale
+        self.offsets[slot] = low
+
+    def __getitem__(self, slots):
+        return self.load(slots)
+
+    def load(self, slots, out=None):
+        """ loads the frames in `slots` as float32, into `out` if given """
+        codes = self.codes[slots]
+        if out is None:
+            out = np.empty((len(codes),) + self.shape, dtype=np.float32)
+        frames = out.reshape(codes.shape)
+        np.multiply(codes, self.scales[slots], out=frames)
+        frames += self.offsets[slots]
+        return out
+
+
+class CompressedFrameStore:
+    """ stores each frame compressed with zlib """
+    def __init__(self, capacity, shape, level=1):
+        self.shape = tuple(shape)
+        self.level = level
+        self.frames = [b""] * capacity
+
+    @property
+    def nbytes(self):
+        return sum(len(frame) for frame in self.frames)
+
+    def flush(self):
+        pass
+
+    def __setitem__(self, slot, frame):
+        frame = np.ascontiguousarray(frame, dtype=np.float32)
+        self.frames[slot] = zlib.compress(frame, self.level)
+
+    def __getitem__(self, slots):
+        return self.load(slots)
+
+    def load(self, slots, out=None):
+        """ loads the frames in `slots` as float32, into `out` if given.
+        zlib decompresses one frame per call, so this loops over the frames in
+        Python, although almost all of the time goes to the decompression itself. """
+        slots = np.asarray(slots)
+        if out is None:
+            out = np.empty((len(slots),) + self.shape, dtype=np.float32)
+        for i, slot in enumerate(slots):
+            if self.frames[slot]:
+                out[i] = np.frombuffer(zlib.decompress(self.frames[slot]), dtype=np.float32).reshape(self.shape)
+            else:
+                out[i] = 0
+        return out
+
+
+def make_frame_store(codec, capacity, shape, directory=None, existing=False):
+    """ creates storage for `capacity` frames
+    :param codec: one of "float32", "float16", "uint8" or "zlib"
+    :param capacity: number of frames to store
+    :param shape: shape of each frame
+    :param directory: directory in which to memory map the frames, or None to keep them in memory
+    :param existing: open the frames already stored in `directory`
+    """
+    if codec == "float32":
+        return FrameStore(capacity, shape, np.float32, directory, existing)
+    elif codec == "float16":
+        return FrameStore(capacity, shape, np.float16, directory, existing)
+    elif codec == "uint8":
+        return QuantizedFrameStore(capacity, shape, directory, existing)
+    elif codec == "zlib":
+        if directory is not None:
+            raise ValueError("Frames compressed with zlib can't be memory mapped")
+        return CompressedFrameStore(capacity, shape)
+    else:
+        raise ValueError(f"Unknown replay codec: {codec}")
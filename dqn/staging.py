@@ -0,0 +1,53 @@
+"""
+File: staging
+"""
+
+import torch
+
+from dqn.replay_memory import TransitionBatch
+
+
+class BatchStaging:
+    """ preallocated tensors into which batches sampled from the replay memory
+    are gathered, so that assembling a batch doesn't allocate anything.
+
+    The replay memory gathers a batch straight into `arrays`, which are numpy
+    views of the tensors, and `to_tensor_batch` hands out views of the rows
+    it filled. On the CPU those are the tensors used for training, without
+    any copying. For a GPU, the tensors are in pinned memory so that they are
+    copied to it asynchronously. Each batch overwrites the last one, so its
+    tensors mustn't be used after the next batch is gathered.
+    """
+    def __init__(self, batch_size, state_shape, device):
+        """ Construct
+        :param batch_size: the largest batch to gather
+        :param state_shape: shape of a state
+        :param device: device on which the batches are used
+        """
+        self.device = torch.device(device)
+        pin = self.device.type == "cuda"
+
+        def buffer(shape, dtype):
+            tensor = torch.zeros(shape, dtype=dtype)
+            return tensor.pin_memory() if pin else tensor
+
+        state_shape = tuple(state_shape)
+        self.tensors = TransitionBatch(state=buffer((batch_size,) + state_shape, torch.float32),
+                                       action=buffer(batch_size, torch.int64),
+                                       next_state=buffer((batch_size,) + state_shape, torch.float32),
+                                       reward=buffer(batch_size, torch.float32),
+                                       done=buffer(batch_size, torch.bool))
+        self.arrays = TransitionBatch(*(tensor.numpy() for tensor in self.tensors))
+
+    def to_tensor_batch(self, batch: TransitionBatch):
+        """ the tensors holding a batch gathered into `arrays`
+        :return: tuple of the states, actions, rewards, non-final mask
+        and next states on the device, like `Trainer.to_tensor_batch`
+        """
+        def rows(name):
+            n = len(getattr(batch, name))
+            if n == 0: return None
+            return getattr(self.tensors, name)[:n].to(self.device, non_blocking=True)
+
+        done = rows('done')
+        return rows('state'), rows('action'), rows('reward'), ~done, rows('next_state')
@@ -6,6 +6,7 @@ Author: Jon Deaton (jdeaton@stanford.edu)
 
 import os, sys
 import argparse, logging
+from functools import partial
 
 logger = logging.getLogger()
 from log import tensorboard
@@ -16,6 +17,8 @@ import gym
 import gym_agario
 
 from dqn.training import Trainer
+from dqn.vector_env import VectorEnvironment
+from a2c.remote_environment import RemoteEnvironment
 from dqn.qn import DQN, DuelingDQN, StateEncoder, ConvEncoder
 from dqn import HyperParameters
 from dqn.hyperparameters import FullEnvHyperparameters, ScreenEnvHyperparameters, GridEnvHyperparameters
@@ -23,13 +26,14 @@ from dqn.hyperparameters import FullEnvHyperparameters, ScreenEnvHyperparameters
 import torch
 
 
-def make_q_networks(hyperams: HyperParameters, state_shape):
+def make_q_networks(hyperams: HyperParameters, state_shape, device=None):
     """ creates an online and target Q network
     :param hyperams: hyper-parameters
     :param state_shape: shape of the state in put into the networks
+    :param device: device for the networks, by default a GPU if there is one
     :return: tuple containing the online and target Q networks
     """
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     if hyperams.encoder_type == 'linear':
         encoder        = StateEncoder(state_shape, hyperams.layer_sizes, p_dropout=hyperams.p_dropout, device=device)
@@ -81,6 +85,19 @@ def make_environment(env_type, hyperams):
     return env
 
 
+def make_vector_environment(env_type, hyperams):
+    """ makes `num_envs` environments to be stepped together, each
+    in a process of its own if `remote_envs` is set """
+    get_env = partial(make_environment, env_type, hyperams)
+    if not hyperams.remote_envs:
+        return VectorEnvironment([get_env() for _ in range(hyperams.num_envs)])
+
+    envs = [RemoteEnvironment(get_env) for _ in range(hyperams.num_envs)]
+    for env in envs:
+        env.open()
+    return VectorEnvironment(envs)
+
+
 def get_feature_extractor(hyperams: HyperParameters):
     """ creates a feature extractor object for the given environment
     :param hyperams: hyper-parameters object
@@ -138,7 +155,7 @@ def main():
     output_dir = args.output
     os.makedirs(args.output, exist_ok=True)
 
-    training_dir = get_training_dir(output_dir, args.name)
+    training_dir = args.resume or get_training_dir(output_dir, args.name)
     os.makedirs(training_dir, exist_ok=True)
     logger.info(f"Model directory: {training_dir}")
 
@@ -148,20 +165,48 @@ def main():
     logger.debug(f"Saving hyper-parameters to: {hp_file}")
     hyperams.save(hp_file)
 
-    env = make_environment(args.env_type, hyperams)
+    if hyperams.num_envs > 1:
+        env = make_vector_environment(args.env_type, hyperams)
+    elif hyperams.remote_envs:
+        # the trainer overlaps the remote environment's steps with its own work
+        env = RemoteEnvironment(partial(make_environment, args.env_type, hyperams))
+        env.open()
+    else:
+        env = make_environment(args.env_type, hyperams)
 
     extractor = get_feature_extractor(hyperams)
     if extractor is not None:
         state_shape = extractor.shape
+    elif isinstance(env, RemoteEnvironment):
+        state_shape = env.observation_space().shape
     else:
         state_shape = env.observation_space.shape
 
     logger.info("Creating Q network...")
-    q, target_q = make_q_networks(hyperams, state_shape)
+    device = None
+    if hyperams.hogwild_workers > 0:
+        # the workers share the networks through CPU shared memory
+        if args.gpu or torch.cuda.is_available():
+            logger.warning("Hogwild trains on the CPU, not the GPU")
+        device = torch.device('cpu')
+    q, target_q = make_q_networks(hyperams, state_shape, device=device)
 
     logger.info("Training...")
     trainer = Trainer(env, q, target_q, hyperams=hyperams, extractor=extractor)
-    trainer.train(num_episodes=hyperams.num_episodes, training_dir=training_dir)
+    if hyperams.num_actors > 0:
+        from dqn.apex import ApeX
+        trainer = ApeX(trainer,
+                       get_env=partial(make_environment, args.env_type, hyperams),
+                       get_networks=partial(make_q_networks, hyperams, state_shape, device=torch.device('cpu')),
+                       get_extractor=partial(get_feature_extractor, hyperams))
+    elif hyperams.hogwild_workers > 0:
+        from dqn.hogwild import Hogwild
+        trainer = Hogwild(trainer,
+                          get_env=partial(make_environment, args.env_type, hyperams),
+                          get_extractor=partial(get_feature_extractor, hyperams))
+    trainer.train(num_episodes=hyperams.num_episodes, training_dir=training_dir,
+                  resume=args.resume is not None)
+    env.close()
     logger.info("Exiting.")
 
 
@@ -192,12 +237,35 @@ def parse_args():
     output_options.add_argument("--output", default="model_outputs", help="Output directory")
     output_options.add_argument("--name", default="dqn",
                                 help="Experiment or run name")
+    output_options.add_argument("--resume", help="Training directory of a run to continue from its latest checkpoint")
 
     hyperams_options = parser.add_argument_group("HyperParameters")
     # note: make sure that the "dest" value is exactly the same as the variable name in "Hyperparameters"
     # in order for over-riding to work correctly.
     hyperams_options.add_argument("-episodes", "--episodes", dest="num_episodes", type=int,
                                   help="Number of epochs to train")
+    hyperams_options.add_argument("--replay-capacity", dest="replay_memory_capacity", type=int,
+                                  help="Number of transitions in the replay memory")
+    hyperams_options.add_argument("--replay-codec", dest="replay_codec",
+                                  choices=["float32", "float16", "uint8", "zlib"],
+                                  help="How to store states in the replay memory")
+    hyperams_options.add_argument("--replay-on-disk", dest="replay_on_disk", action="store_true",
+                                  help="Memory map the replay memory to files in the training directory")
+    hyperams_options.add_argument("--priority-init", dest="priority_init", choices=["td", "max", "batched"],
+                                  help="How to set the priority of new transitions")
+    hyperams_options.add_argument("--priority-init-batch", dest="priority_init_batch", type=int,
+                                  help="Number of transitions to prioritize at once with --priority-init batched")
+    hyperams_options.add_argument("--prefetch-depth", dest="prefetch_depth", type=int,
+                                  help="Number of batches to sample on a background thread ahead of training")
+    hyperams_options.add_argument("--envs", dest="num_envs", type=int,
+                                  help="Number of environments to step together")
+    hyperams_options.add_argument("--remote-envs", dest="remote_envs", action="store_true",
+                                  help="Step each environment in a process of its own. With one "
+                                       "environment, training overlaps with its steps")
+    hyperams_options.add_argument("--actors", dest="num_actors", type=int,
+                                  help="Number of Ape-X actor processes feeding the learner, 0 for none")
+    hyperams_options.add_argument("--hogwild", dest="hogwild_workers", type=int,
+                                  help="Number of Hogwild processes training the shared networks, 0 for none")
 
     training_options = parser.add_argument_group("Training")
     training_options.add_argument("-gpu", "--gpu", action='store_true', help="Enable GPU")
@@ -6,7 +6,10 @@ Author: Jon Deaton (jdeaton@stanford.edu)
 
 from dqn import HyperParameters
 
-from dqn.replay_memory import ReplayMemory
+from dqn.replay_memory import ReplayMemory, Transition, TransitionBatch, stack_transitions
+from dqn.staging import BatchStaging
+from dqn.vector_env import VectorEnvironment
+from a2c.prefetch import Prefetcher
 
 from datetime import datetime, timedelta
 from tqdm import tqdm
@@ -19,14 +22,15 @@ import torch.optim as optim
 import numpy as np
 
 import os
+import copy
+import time
+import itertools
+import threading
 from log import tensorboard
+from utils.checkpoint import CheckpointWriter, latest_checkpoint, load_checkpoint
 import logging
 logger = logging.getLogger('root')
 
-from collections import namedtuple
-Transition = namedtuple('Transition',
-                        ('state', 'action', 'next_state', 'reward'))
-
 from typing import List, Tuple
 
 class Trainer(object):
@@ -34,7 +38,14 @@ class Trainer(object):
 
     def __init__(self, env, q, target_q, hyperams: HyperParameters, extractor=None):
         self.env = env
-        self.replay_memory = ReplayMemory(hyperams.replay_memory_capacity)
+        self.replay_memory = ReplayMemory(hyperams.replay_memory_capacity, codec=hyperams.replay_codec)
+        self.staging = None
+        self.unprioritized = []  # transitions waiting for their TD errors
+        self.unprioritized_continues = False  # whether they continue the last transition remembered
+
+        # guards the replay memory, which is sampled on another thread when prefetching
+        self.replay_lock = threading.Lock()
+        self.prefetcher = None
 
         self.device = q.device
 
@@ -63,76 +74,336 @@ class Trainer(object):
         self.set_seed(hyperams.seed)
 
 
-    def train(self, num_episodes=None, training_dir=None):
-        """ trains the DQN for a single epoch consisting of `num_episodes` """
+    def train(self, num_episodes=None, training_dir=None, resume=False):
+        """ trains the DQN until `num_episodes` episodes have been played in total.
+        As in A2C, a resumed run only plays the episodes that remain after its checkpoint.
+        :param resume: continue from the latest checkpoint in `training_dir`
+        """
         num_episodes = num_episodes or self.hyperams.num_episodes
-
-        checkpoint = training_dir is not None
-        if checkpoint:
-            checkpoint_dir = os.path.join(training_dir, "checkpoints")
-            os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoints = self.open_training_dir(training_dir, resume)
 
         self.q.train()
-        episode_iterator = tqdm(range(num_episodes), unit="Episode")
-        for ep in episode_iterator:
-            ep_return = self.train_episode()
-
-            episode_iterator.set_description("episode return: %.2f" % ep_return)
-            tensorboard.log_scalar("train/EpisodeReturns", ep_return, self.episodes)
-            tensorboard.log_scalar("train/epsilon", self.epsilon, self.episodes)
-            self.episodes += 1
-
-            # save checkpoint
-            should_checkpoint = checkpoint and (datetime.now() - self.last_save) > self.save_freq
-            if should_checkpoint:
-                torch.save(self.q, os.path.join(checkpoint_dir, "checkpoint"))
-                self.last_save = datetime.now()
+        try:
+            if isinstance(self.env, VectorEnvironment):
+                self.train_vectorized(max(num_episodes - self.episodes, 0), checkpoints)
+            else:
+                episode_iterator = tqdm(range(self.episodes, num_episodes), unit="Episode")
+                for ep in episode_iterator:
+                    start = time.perf_counter()
+                    ep_return = self.train_episode()
+                    tensorboard.log_scalar("train/EpisodeSeconds", time.perf_counter() - start, self.episodes)
+
+                    episode_iterator.set_description("episode return: %.2f" % ep_return)
+                    self.log_episode(ep_return)
+                    self.maybe_checkpoint(checkpoints)
+        finally:
+            self.finish_training(checkpoints)
+
+    def open_training_dir(self, training_dir, resume=False):
+        """ prepares to save checkpoints (and the replay memory, if it's kept
+        on disk) in `training_dir`, first resuming from them if `resume`
+        :return: CheckpointWriter for the checkpoints, or None without a training directory
+        """
+        if training_dir is None:
+            return None
+
+        checkpoint_dir = os.path.join(training_dir, "checkpoints")
+        if resume:
+            self.restore(checkpoint_dir)
+
+        if self.hyperams.replay_on_disk:
+            self.replay_memory = ReplayMemory(self.hyperams.replay_memory_capacity,
+                                              codec=self.hyperams.replay_codec,
+                                              directory=os.path.join(training_dir, "replay"),
+                                              resume=resume)
+
+        return CheckpointWriter(checkpoint_dir, keep=self.hyperams.keep_checkpoints)
+
+    def finish_training(self, checkpoints=None):
+        """ stops prefetching and saves the replay memory and last checkpoint """
+        if self.prefetcher is not None:
+            stats = self.prefetcher.stats()
+            logger.info(f"Prefetching hid {stats['hidden_time'] * 1e3:.2f} of {stats['prepare_time'] * 1e3:.2f} ms "
+                        f"of sampling per gradient step")
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+        if checkpoints is not None:
+            self.save_replay_memory()
+            checkpoints.close()
+
+    def train_vectorized(self, num_episodes, checkpoints=None):
+        """ trains the DQN on the environments of a VectorEnvironment for
+        `num_episodes` episodes in total. Each tick chooses actions for every
+        environment with one forward pass and steps them all together.
+        Each environment's transitions are added to the replay memory in runs of
+        `priority_init_batch`, which keeps consecutive transitions of an
+        episode next to each other in the replay memory.
+        """
+        env = self.env
+        n = env.num_envs
+        env.reset()
+
+        features = [None] * n
+        returns = np.zeros(n)
+        lengths = np.zeros(n, dtype=int)
+        env_episodes = np.zeros(n, dtype=int)
+        transitions = [[] for _ in range(n)]
+        last_run = None  # environment whose episode the last transitions remembered were from
+
+        progress = tqdm(total=num_episodes, unit="Episode")
+        finished = 0
+        while finished < num_episodes:
+            action_indices = self.choose_actions(features)
+            obs, rewards, dones, _ = env.step([self.to_action(index) for index in action_indices])
+
+            for i in range(n):
+                next_features = self.to_features(obs[i])
+                returns[i] += rewards[i]
+                lengths[i] += 1
+                if features[i] is not None:
+                    transitions[i].append(Transition(features[i], action_indices[i], next_features, rewards[i]))
+                features[i] = next_features
+
+                episode_over = dones[i] or lengths[i] >= self.hyperams.episode_length
+                if episode_over or len(transitions[i]) >= self.hyperams.priority_init_batch:
+                    if transitions[i]:
+                        self.remember_all(transitions[i], continues=last_run == i)
+                        last_run = i
+                    transitions[i] = []
+                    if episode_over and last_run == i:
+                        last_run = None
+
+                if episode_over:
+                    tensorboard.log_scalar(f"train/env_{i}/EpisodeReturns", returns[i], env_episodes[i])
+                    tensorboard.log_scalar(f"train/env_{i}/EpisodeLength", lengths[i], env_episodes[i])
+                    self.log_episode(returns[i])
+                    progress.set_description("episode return: %.2f" % returns[i])
+                    progress.update()
+                    finished += 1
+
+                    env.reset_env(i)
+                    features[i] = None
+                    returns[i] = 0
+                    lengths[i] = 0
+                    env_episodes[i] += 1
+
+            # keep to one gradient step every `lean_freq` time steps
+            steps_before = self.time_steps
+            self.time_steps += n
+            num_train_steps = self.time_steps // self.hyperams.lean_freq - steps_before // self.hyperams.lean_freq
+            for _ in range(num_train_steps if self.replay_memory.full() else 0):
+                self.gradient_step()
+
+            self.maybe_checkpoint(checkpoints)
+
+        progress.close()
+        for i, env_transitions in enumerate(transitions):
+            if env_transitions:
+                self.remember_all(env_transitions, continues=last_run == i)
+                last_run = i
+
+    def log_episode(self, ep_return):
+        """ logs the return of an episode that just finished and counts it """
+        tensorboard.log_scalar("train/EpisodeReturns", ep_return, self.episodes)
+        tensorboard.log_scalar("train/epsilon", self.epsilon, self.episodes)
+        if self.prefetcher is not None:
+            self.log_prefetch()
+        self.episodes += 1
+
+    def maybe_checkpoint(self, checkpoints):
+        """ saves a checkpoint if it's been long enough since the last one """
+        should_checkpoint = checkpoints is not None and (datetime.now() - self.last_save) > self.save_freq
+        if should_checkpoint:
+            checkpoints.save(self.time_steps, self.snapshot())
+            self.save_replay_memory()
+            self.last_save = datetime.now()
+
+    def snapshot(self):
+        """ copies everything needed to resume training into memory, so
+        that it can be written to disk while training continues """
+        def copy_state(module):
+            return {name: tensor.detach().cpu().clone() for name, tensor in module.state_dict().items()}
+
+        return {
+            'q': copy_state(self.q),
+            'target_q': copy_state(self.target_q),
+            'optimizer': copy.deepcopy(self.optimizer.state_dict()),
+            'time_steps': self.time_steps,
+            'episodes': self.episodes,
+            'gradient_steps': self.gradient_steps,
+            'num_target_updates': self.num_target_updates,
+        }
+
+    def save_replay_memory(self):
+        """ saves the replay memory, if it's kept on disk """
+        if self.replay_memory.directory is not None:
+            with self.replay_lock:
+                self.replay_memory.save()
+
+    def restore(self, checkpoint_dir):
+        """ restores the networks, optimizer and counters from the latest checkpoint.
+        Epsilon follows from the number of gradient steps, so it's restored too. """
+        path = latest_checkpoint(checkpoint_dir)
+        if path is None:
+            logger.warning(f"No checkpoint to resume from in {checkpoint_dir}")
+            return
+
+        state = load_checkpoint(path)
+        self.q.load_state_dict(state['q'])
+        self.target_q.load_state_dict(state['target_q'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.time_steps = state['time_steps']
+        self.episodes = state['episodes']
+        self.gradient_steps = state['gradient_steps']
+        self.num_target_updates = state['num_target_updates']
+        logger.info(f"Resumed from {path} at episode {self.episodes} (epsilon {self.epsilon:.3f})")
 
     def train_episode(self):
-        """ train DQN for a single episode """
+        """ train DQN for a single episode.
+
+        If the environment is a RemoteEnvironment, the work that doesn't depend
+        on the step's result is done while the environment simulates it: the
+        previous transition is added to the replay memory and the gradient step
+        is taken between sending the action and receiving the result. The
+        environment is rendered after each step either way, unless it can't be
+        rendered from here, as a RemoteEnvironment's can't.
+        """
         total_returns = 0
         log = dict()
 
         self.env.reset()
+        pipelined = hasattr(self.env, "step_async")
 
         next_state_fts = None
+        transition = None  # not yet added to the replay memory
+        continues = False  # whether a transition of this episode has been added
         for i in range(self.hyperams.episode_length):
             state_fts = next_state_fts
 
             action_index = self.choose_action(state_fts)
             action = self.to_action(action_index)
-            next_state, reward, done, info = self.env.step(action)
 
-            self.env.render()
+            if pipelined:
+                self.env.step_async(action)
+                if transition is not None:
+                    self.remember(transition, continues)
+                    continues = True
+                self.maybe_gradient_step()
+                next_state, reward, done, info = self.env.step_wait()
+            else:
+                next_state, reward, done, info = self.env.step(action)
+            if hasattr(self.env, "render"):
+                self.env.render()
 
             next_state_fts = self.to_features(next_state)
             total_returns += reward
 
+            transition = None
             if state_fts is not None:
                 transition = Transition(state_fts, action_index, next_state_fts, reward)
-                errors = self.get_errors([transition])
-                self.replay_memory.push(errors[0], transition)
-
-            # only train for a step if the replay buffer is full
-            if self.time_steps % self.hyperams.lean_freq == 0 and self.replay_memory.full():
-                self.train_step()
-                self.gradient_steps += 1
 
-                if self.gradient_steps % self.hyperams.target_update_freq == 0:
-                    self.update_target_network()
+            if not pipelined:
+                if transition is not None:
+                    self.remember(transition, continues)
+                    continues = True
+                    transition = None
+                self.maybe_gradient_step()
 
             self.time_steps += 1
             if done: break
 
+        if transition is not None:
+            self.remember(transition, continues)
+        self.prioritize()
         return total_returns
 
+    def maybe_gradient_step(self):
+        """ takes a gradient step every `lean_freq` time steps,
+        but only once the replay buffer is full """
+        if self.time_steps % self.hyperams.lean_freq == 0 and self.replay_memory.full():
+            self.gradient_step()
+
+    def remember(self, transition: Transition, continues=False):
+        """ adds a transition to the replay memory. Its initial priority is
+        set according to the `priority_init` hyper-parameter:
+
+            td: from its TD error, with a forward pass for the transition alone
+            max: the highest priority so far, without any forward pass
+            batched: from its TD error, computed in one forward pass for every
+                `priority_init_batch` transitions
+
+        :param continues: whether the transition is the next step of the episode
+        of the transition remembered just before it
+        """
+        if self.hyperams.priority_init == "td":
+            errors = self.get_errors([transition])
+            with self.replay_lock:
+                self.replay_memory.push(errors[0], transition, continues)
+
+        elif self.hyperams.priority_init == "max":
+            with self.replay_lock:
+                self.replay_memory.push(None, transition, continues)
+
+        elif self.hyperams.priority_init == "batched":
+            if self.unprioritized and not continues:
+                self.prioritize()
+            if not self.unprioritized:
+                self.unprioritized_continues = continues
+            self.unprioritized.append(transition)
+            if len(self.unprioritized) >= self.hyperams.priority_init_batch:
+                self.prioritize()
+
+        else:
+            raise ValueError(f"Unknown priority initialization: {self.hyperams.priority_init}")
+
+    def prioritize(self):
+        """ computes the TD errors of the transitions waiting for them
+        in a single batch, and adds them to the replay memory """
+        self.remember_all(self.unprioritized, self.unprioritized_continues)
+        self.unprioritized = []
+
+    def remember_all(self, transitions: List[Transition], continues=False):
+        """ adds consecutive transitions to the replay memory together. Unless new
+        transitions get the highest priority so far, their TD errors are computed
+        in a single batch.
+        :param continues: whether the first transition is the next step of the
+        episode of the transition remembered just before it
+        """
+        if not transitions:
+            return
+        if self.hyperams.priority_init == "max":
+            errors = [None] * len(transitions)
+        else:
+            errors = np.atleast_1d(self.get_errors(transitions))
+        with self.replay_lock:
+            for i, (error, transition) in enumerate(zip(errors, transitions)):
+                self.replay_memory.push(error, transition, continues or i > 0)
+
+    def gradient_step(self):
+        """ takes a gradient step, updating the target network every `target_update_freq` steps """
+        self.train_step()
+        self.gradient_steps += 1
+
+        if self.gradient_steps % self.hyperams.target_update_freq == 0:
+            self.update_target_network()
+
     def train_step(self):
         """ Runs a single step of parameter optimization using a batch of experience
             examples from the replay buffer.
         """
-        # sample an experience batch from replay buffer
-        batch, indexes, _ = self.replay_memory.sample(self.hyperams.batch_size)
-        sars_batches = self.to_tensor_batch(batch)
+        # sample an experience batch from replay buffer, straight into staging tensors
+        if self.hyperams.prefetch_depth > 0:
+            if self.prefetcher is None:
+                self.prefetcher = self.make_prefetcher()
+            staging, (batch, indexes, generation) = self.prefetcher.get()
+        else:
+            if self.staging is None:
+                self.staging = BatchStaging(self.hyperams.batch_size, self.replay_memory.states.shape, self.device)
+            staging = self.staging
+            batch, indexes, generation = self.sample_batch(staging)
+
+        sars_batches = staging.to_tensor_batch(batch)
         state_batch, action_batch, reward_batch, _, next_state_batch = sars_batches
 
         # the estimate for the quality of taking those actions in those states
@@ -146,12 +417,48 @@ class Trainer(object):
         tensorboard.log_scalar("train/Qsa", float(torch.mean(Q_sa)), self.gradient_steps)
 
         # update the new errors in the replay memory
+        # transitions overwritten since the batch was sampled keep their own priorities
         errors = torch.abs(Q_sa - target).cpu().data.numpy()
-        for i in range(self.hyperams.batch_size):
-            self.replay_memory.update(indexes[i], errors[i])
+        with self.replay_lock:
+            self.replay_memory.update(indexes, errors, generation)
 
         self.optimize_q(loss)
 
+    def sample_batch(self, staging: BatchStaging):
+        """ samples a batch from the replay memory into `staging`
+        :return: the TransitionBatch, the tree indices of its transitions and their generations
+        """
+        with self.replay_lock:
+            batch, indexes, _ = self.replay_memory.sample(self.hyperams.batch_size, out=staging.arrays)
+            return batch, indexes, self.replay_memory.generation(indexes)
+
+    def make_prefetcher(self):
+        """ starts sampling batches on a background thread, up to `prefetch_depth`
+        ahead of the gradient steps. Each batch is gathered into staging tensors
+        of its own, which are reused once the batch has been trained on. """
+        depth = self.hyperams.prefetch_depth
+
+        # one batch being sampled, `depth` waiting and one being trained on
+        shape = self.replay_memory.states.shape
+        stagings = itertools.cycle([BatchStaging(self.hyperams.batch_size, shape, self.device)
+                                    for _ in range(depth + 2)])
+
+        def prepare():
+            staging = next(stagings)
+            return staging, self.sample_batch(staging)
+
+        prefetcher = Prefetcher(prepare, depth=depth)
+        prefetcher.start()
+        return prefetcher
+
+    def log_prefetch(self):
+        """ logs the mean time per gradient step spent sampling batches, waiting
+        for them, and the sampling time hidden behind the gradient steps """
+        stats = self.prefetcher.stats()
+        tensorboard.log_scalar("prefetch/sample_time", stats['prepare_time'], self.episodes)
+        tensorboard.log_scalar("prefetch/wait_time", stats['wait_time'], self.episodes)
+        tensorboard.log_scalar("prefetch/hidden_time", stats['hidden_time'], self.episodes)
+
     def get_target(self, sars_batches: Tuple):
         _, _, reward_batch, non_final_mask, next_state_batch = sars_batches
         Q_tgt = torch.zeros_like(reward_batch, device=self.device)
@@ -174,8 +481,8 @@ class Trainer(object):
         # now, select from those, the actions specified in action_batch
         return torch.gather(Q_s, 1, action_batch.unsqueeze(dim=1)).squeeze()
 
-    def get_errors(self, transition_batch: List[Transition]):
-        sars_batches = self.to_tensor_batch(transition_batch)
+    def get_errors(self, transitions: List[Transition]):
+        sars_batches = self.to_tensor_batch(stack_transitions(transitions))
         state_batch, action_batch, reward_batch, _, next_state_batch = sars_batches
 
         Q_sa = self.get_Qsa(self.q, state_batch, action_batch)
@@ -217,6 +524,23 @@ class Trainer(object):
             index = torch.argmax(qa).item()
         return index
 
+    def choose_actions(self, features):
+        """ chooses actions for several states at once using the epsilon-greedy
+        policy, with one forward pass for all of the states that act greedily
+        :param features: list of the states' features, any of which may be None
+        :return: array of action indices
+        """
+        n = len(features)
+        actions = np.random.randint(self.num_actions, size=n)
+        has_state = np.array([f is not None for f in features])
+        greedy = np.flatnonzero(has_state & (np.random.random(n) > self.epsilon))
+        if len(greedy) > 0:
+            states = np.stack([features[i] for i in greedy]).astype(np.float32)
+            with torch.no_grad():
+                qa = self.q(torch.from_numpy(states).to(self.device))
+            actions[greedy] = torch.argmax(qa, dim=1).cpu().numpy()
+        return actions
+
     def to_action(self, index):
         """ converts a raw action index into an action shape """
         indices = np.unravel_index(index, self.hyperams.action_shape)
@@ -227,25 +551,20 @@ class Trainer(object):
         y = np.sin(theta) * mag
         return x, y, act
 
-    def to_tensor_batch(self, transition_batch):
-        """ converts a batch (i.e. simple list) of Transition objects
-            into a tuple of tensors for the batch of states, actions,
-            rewards, and next states. Yes... this function is poorly written.
+    def to_tensor_batch(self, batch: TransitionBatch):
+        """ converts a TransitionBatch into a tuple of tensors for the batch
+            of states, actions, rewards, and next states.
         """
-        batch = Transition(*zip(*transition_batch))
-
-        def to_tensor(array_list):
-            """ converts a list of numpy arrays into a single tensor """
-            tensors = tuple(torch.from_numpy(np.array(a)) for a in array_list if a is not None)
-            if not tensors: return None
-            return torch.stack(tensors, dim=0).type(torch.FloatTensor).to(self.device)
+        def to_tensor(array):
+            if array is None or len(array) == 0: return None
+            return torch.from_numpy(array).to(self.device)
 
         feature_batch = to_tensor(batch.state)
-        action_batch = to_tensor(batch.action).to(torch.long)
+        action_batch = to_tensor(batch.action)
         reward_batch = to_tensor(batch.reward)
         next_feature_batch = to_tensor(batch.next_state)
 
-        non_final_mask = torch.tensor(tuple(s is not None for s in batch.next_state), device=self.device, dtype=torch.uint8)
+        non_final_mask = torch.from_numpy(~batch.done).to(self.device)
 
         return feature_batch, action_batch, reward_batch, non_final_mask, next_feature_batch
 
@@ -265,6 +584,7 @@ class Trainer(object):
     def set_seed(self, seed):
         """ Sets random seeds for reproducibility """
         random.seed(seed)
+        np.random.seed(seed)
         torch.manual_seed(seed)
         torch.cuda.manual_seed_all(seed)
 
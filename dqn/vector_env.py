@@ -0,0 +1,59 @@
+"""
+File: vector_env
+"""
+
+
+class VectorEnvironment:
+    """ steps several single-agent environments together, so that actions
+    for all of them can be chosen with one forward pass of the Q network.
+
+    The environments may be local, or RemoteEnvironments running in processes
+    of their own, which are all sent their actions before any of their results
+    are waited for so that they step in parallel. Each environment is reset
+    on its own as soon as its episode is over.
+    """
+    def __init__(self, envs):
+        """ Construct
+        :param envs: the environments, either local or open RemoteEnvironments
+        """
+        self.envs = list(envs)
+
+    @property
+    def num_envs(self):
+        return len(self.envs)
+
+    @property
+    def observation_space(self):
+        space = self.envs[0].observation_space
+        return space() if callable(space) else space  # a method of RemoteEnvironment
+
+    def reset(self):
+        """ resets every environment
+        :return: list of their initial observations
+        """
+        return [env.reset() for env in self.envs]
+
+    def reset_env(self, i):
+        """ resets the i'th environment
+        :return: its initial observation
+        """
+        return self.envs[i].reset()
+
+    def step(self, actions):
+        """ steps every environment
+        :param actions: one action for each environment
+        :return: lists of the observations, rewards, done flags and
+        infos of each of the environments
+        """
+        for env, action in zip(self.envs, actions):
+            if hasattr(env, "step_async"):
+                env.step_async(action)
+
+        results = [env.step_wait() if hasattr(env, "step_async") else env.step(action)
+                   for env, action in zip(self.envs, actions)]
+        obs, rewards, dones, infos = zip(*results)
+        return list(obs), list(rewards), list(dones), list(infos)
+
+    def close(self):
+        for env in self.envs:
+            env.close()
@@ -0,0 +1,171 @@
+"""
+File: allreduce_test
+"""
+
+import time
+import numpy as np
+import unittest
+from threading import BrokenBarrierError
+from multiprocessing import Process, Queue
+
+from a2c.allreduce import SharedAllReduce
+
+
+def sum_target(rank, allreduce, vectors, results):
+    allreduce.open(rank, vectors.shape[1])
+    results.put((rank, allreduce.sum(vectors[rank])))
+    allreduce.close()
+
+
+def sgd_target(rank, allreduce, features, targets, num_steps, learning_rate, results):
+    """ fits a linear regression on this rank's shard of the data
+    with gradients averaged across all ranks """
+    num_ranks = allreduce.num_ranks
+    x, y = features[rank::num_ranks], targets[rank::num_ranks]
+    allreduce.open(rank, x.shape[1])
+
+    # each rank starts from different weights, so they only agree after the broadcast
+    weights = np.random.RandomState(rank).randn(x.shape[1]).astype(np.float32)
+    weights = allreduce.broadcast(weights)
+
+    for _ in range(num_steps):
+        grad = (2 * x.T @ (x @ weights - y) / len(y)).astype(np.float32)
+        weights -= learning_rate * allreduce.mean(grad)
+
+    results.put((rank, weights))
+    allreduce.close()
+
+
+class SlowBarrier:
+    """ a barrier whose waiters dawdle after it's released """
+    def __init__(self, barrier, delay):
+        self.barrier = barrier
+        self.delay = delay
+
+    def wait(self):
+        self.barrier.wait()
+        time.sleep(self.delay)
+
+
+def interleaved_target(rank, allreduce, num_rounds, results):
+    """ alternates sums with broadcasts from rank 0. Ranks other than the
+    root are slow to copy each sum, which the root's broadcast would
+    overwrite if it didn't wait for them """
+    allreduce.open(rank, 1000)
+    if rank != 0:
+        allreduce._barrier = SlowBarrier(allreduce._barrier, 0.01)
+    outputs = []
+    for i in range(num_rounds):
+        total = allreduce.sum(np.full(1000, i, dtype=np.float32))
+        root = allreduce.broadcast(np.full(1000, -i, dtype=np.float32))
+        outputs.append((float(total[0]), float(root[0])))
+    results.put((rank, outputs))
+    allreduce.close()
+
+
+def abort_target(rank, allreduce, results):
+    """ the last rank fails and aborts, which must release the others """
+    if rank == allreduce.num_ranks - 1:
+        allreduce.abort()
+        results.put((rank, "aborted"))
+        return
+
+    try:
+        allreduce.open(rank, 4)
+        allreduce.sum(np.ones(4, dtype=np.float32))
+        results.put((rank, "finished"))
+    except BrokenBarrierError:
+        results.put((rank, "broken"))
+    allreduce.close()
+
+
+def model_target(rank, allreduce, num_steps, results):
+    """ trains a Keras model on this rank's own data with
+    Trainer._apply_flat_gradients, as data-parallel learners do """
+    import tensorflow as tf
+    from a2c.training import Trainer
+    from a2c.hyperparameters import HyperParameters
+    from a2c.losses import flatten_gradients, unflatten_gradients
+
+    tf.random.set_seed(rank)
+    model = tf.keras.Sequential([tf.keras.layers.Dense(8, activation='relu'), tf.keras.layers.Dense(2)])
+    model(tf.zeros((1, 4)))
+    trainer = Trainer(None, HyperParameters(), None)
+    trainer.optimizer = tf.keras.optimizers.Adam(learning_rate=0.01, clipnorm=1.0)
+
+    variables = model.trainable_variables
+    allreduce.open(rank, sum(int(np.prod(v.shape)) for v in variables))
+
+    def flat_weights():
+        return np.concatenate([np.ravel(v.numpy()) for v in variables])
+
+    for var, value in zip(variables, unflatten_gradients(allreduce.broadcast(flat_weights()), variables)):
+        var.assign(value)
+
+    data = np.random.RandomState(rank)
+    for _ in range(num_steps):
+        x = data.randn(16, 4).astype(np.float32)
+        y = data.randn(16, 2).astype(np.float32)
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(tf.square(model(x) - y))
+        grads = tape.gradient(loss, variables)
+        trainer._apply_flat_gradients(model, allreduce.mean(flatten_gradients(grads, variables)))
+
+    results.put((rank, flat_weights()))
+    allreduce.close()
+
+
+def run(num_ranks, target, args):
+    allreduce = SharedAllReduce(num_ranks)
+    results = Queue()
+    processes = [Process(target=target, args=(rank, allreduce) + args + (results, ))
+                 for rank in range(num_ranks)]
+    for p in processes:
+        p.start()
+    outputs = dict(results.get(timeout=60) for _ in processes)
+    for p in processes:
+        p.join()
+    return [outputs[rank] for rank in range(num_ranks)]
+
+
+class SharedAllReduceTest(unittest.TestCase):
+    """ tests the 'SharedAllReduce' class """
+    def setUp(self):
+        np.random.seed(10)
+
+    def test_sum(self):
+        # a length that doesn't divide evenly into chunks
+        vectors = np.random.randn(3, 1001).astype(np.float32)
+        for result in run(3, sum_target, (vectors, )):
+            np.testing.assert_allclose(result, vectors.sum(axis=0), rtol=1e-5, atol=1e-5)
+
+    def test_replicas_bit_identical(self):
+        features = np.random.randn(400, 16).astype(np.float32)
+        targets = (features @ np.random.randn(16) + 0.1 * np.random.randn(400)).astype(np.float32)
+
+        replicas = run(4, sgd_target, (features, targets, 50, 0.05))
+        for weights in replicas[1:]:
+            self.assertTrue(np.array_equal(weights, replicas[0]))
+
+        # and they match training on the whole data set in one process
+        weights = np.random.RandomState(0).randn(16).astype(np.float32)
+        for _ in range(50):
+            grads = [2 * x.T @ (x @ weights - y) / len(y)
+                     for x, y in ((features[r::4], targets[r::4]) for r in range(4))]
+            weights -= 0.05 * np.mean(grads, axis=0).astype(np.float32)
+        np.testing.assert_allclose(replicas[0], weights, rtol=1e-4, atol=1e-4)
+
+    def test_model_replicas_bit_identical(self):
+        replicas = run(2, model_target, (10, ))
+        self.assertTrue(np.array_equal(replicas[0], replicas[1]))
+
+    def test_sum_then_broadcast(self):
+        expected = [(3 * i, -i) for i in range(5)]
+        self.assertEqual(run(3, interleaved_target, (5, )), [expected] * 3)
+
+    def test_abort(self):
+        self.assertEqual(run(3, abort_target, ()), ["broken", "broken", "aborted"])
+
+
+if __name__ == "__main__":
+    unittest.main()
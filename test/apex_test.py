@@ -0,0 +1,101 @@
+"""
+File: apex_test
+"""
+
+import queue
+import threading
+import unittest
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from dqn import HyperParameters
+from dqn.apex import ApeX, Actor, SharedWeights, epsilon_ladder
+from dqn.replay_memory import Transition
+from dqn.training import Trainer
+
+
+def make_networks():
+    torch.manual_seed(10)
+    q, target_q = nn.Linear(3, 4), nn.Linear(3, 4)
+    q.device = target_q.device = "cpu"
+    return q, target_q
+
+
+def failing_env():
+    raise RuntimeError("No environment")
+
+
+class EpsilonLadderTest(unittest.TestCase):
+    def test_values(self):
+        epsilons = epsilon_ladder(8, epsilon=0.4, alpha=7)
+        np.testing.assert_allclose(epsilons, 0.4 ** (1 + np.arange(8)))
+        np.testing.assert_allclose(epsilon_ladder(3, epsilon=0.5, alpha=2), [0.5, 0.25, 0.125])
+        np.testing.assert_allclose(epsilon_ladder(1, epsilon=0.3), [0.3])
+
+
+class SharedWeightsTest(unittest.TestCase):
+    def test_versions(self):
+        q, target_q = make_networks()
+        weights = SharedWeights(q, target_q)
+        actor_q, actor_target_q = make_networks()
+        with torch.no_grad():
+            actor_q.weight.zero_()
+
+        # weights which haven't been published since the version given aren't loaded
+        version = weights.load(actor_q, actor_target_q, 0)
+        self.assertEqual(version, 0)
+        self.assertFalse(actor_q.weight.detach().any())
+
+        with torch.no_grad():
+            q.weight.add_(1)
+        weights.publish(q, target_q)
+        version = weights.load(actor_q, actor_target_q, version)
+        self.assertEqual(version, 1)
+        torch.testing.assert_close(actor_q.weight, q.weight)
+        torch.testing.assert_close(actor_target_q.weight, target_q.weight)
+
+
+class ActorTest(unittest.TestCase):
+    def setUp(self):
+        self.hyperams = HyperParameters()
+        self.hyperams.action_shape = (4, 1, 1)
+        self.hyperams.replay_memory_capacity = 10
+        self.hyperams.actor_block_size = 3
+        q, target_q = make_networks()
+        self.messages = queue.Queue()
+        self.actor = Actor(0, None, q, target_q, self.hyperams, 0.1,
+                           SharedWeights(q, target_q), self.messages, threading.Event())
+
+    def transition(self):
+        return Transition(np.random.randn(3), 0, np.random.randn(3), 1.0)
+
+    def test_blocks(self):
+        for i in range(4):
+            self.actor.remember(self.transition(), continues=i > 0)
+        kind, aid, block, errors, continues = self.messages.get_nowait()
+        self.assertEqual((kind, aid, len(block), len(errors), continues), ("transitions", 0, 3, 3, False))
+        self.assertTrue(self.messages.empty())
+
+        # a new episode sends the rest of the last one
+        self.actor.remember(self.transition(), continues=False)
+        _, _, block, _, continues = self.messages.get_nowait()
+        self.assertEqual((len(block), continues), (1, True))
+        self.assertEqual(len(self.actor.block), 1)
+
+
+class ApeXTest(unittest.TestCase):
+    def test_dead_actors(self):
+        """ the learner stops if its actors die instead of waiting for them forever """
+        hyperams = HyperParameters()
+        hyperams.num_actors = 2
+        q, target_q = make_networks()
+        trainer = Trainer(None, q, target_q, hyperams)
+        apex = ApeX(trainer, failing_env, make_networks)
+        with self.assertRaises(RuntimeError):
+            apex.train(num_episodes=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+File: async_coordinator_test
+"""
+
+import time
+import queue
+import threading
+import unittest
+
+from a2c.async_coordinator import RolloutQueue, AsyncCoordinator
+
+
+def put_versions(wid, rollout_queue, signal, versions):
+    """ a worker which sends a datum made by each version of the weights """
+    signal.wait()
+    for version in versions:
+        rollout_queue.put((version, f"datum {version}"))
+
+
+class RolloutQueueTest(unittest.TestCase):
+    """ tests the 'RolloutQueue' class """
+    def test_full_queue_blocks(self):
+        rollout_queue = RolloutQueue(capacity=1)
+        rollout_queue.put("first")
+        producer = threading.Thread(target=rollout_queue.put, args=("second", ))
+        producer.start()
+        time.sleep(0.2)
+        self.assertTrue(producer.is_alive())
+
+        self.assertEqual(rollout_queue.get(timeout=5), "first")
+        producer.join(timeout=5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(rollout_queue.get(timeout=5), "second")
+        self.assertEqual(rollout_queue.num_put, 2)
+        self.assertGreaterEqual(rollout_queue.wait_time, 0.15)
+
+    def test_get_timeout(self):
+        rollout_queue = RolloutQueue()
+        with self.assertRaises(queue.Empty):
+            rollout_queue.get(timeout=0.1)
+
+
+class AsyncCoordinatorTest(unittest.TestCase):
+    """ tests popping data from an 'AsyncCoordinator' """
+    def test_stale_data_dropped(self):
+        coordinator = AsyncCoordinator(1, put_versions, ([0, 1, 2, 3], ), max_staleness=1)
+        with coordinator:
+            coordinator.start()
+            self.assertEqual(coordinator.pop(3, timeout=10), (2, "datum 2"))
+            self.assertEqual(coordinator.num_dropped, 2)
+            self.assertEqual(coordinator.pop(3, timeout=10), (3, "datum 3"))
+            self.assertEqual(coordinator.stats()['dropped'], 2)
+
+            with self.assertRaises(queue.Empty):
+                coordinator.pop(3, timeout=0.1)
+
+    def test_pop_without_version(self):
+        coordinator = AsyncCoordinator(1, put_versions, ([0, 1], ), max_staleness=0)
+        with coordinator:
+            coordinator.start()
+            self.assertEqual(coordinator.pop(timeout=10), (0, "datum 0"))
+            self.assertEqual(coordinator.pop(), (1, "datum 1"))
+            self.assertEqual(coordinator.num_dropped, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+File: autoscaler_test
+"""
+
+import unittest
+from unittest import mock
+
+from a2c.autoscaler import Autoscaler
+
+
+class StubQueue:
+    """ a roll-out queue whose depth and number of puts are set by the test """
+    def __init__(self):
+        self.num_put = 0
+        self.depth = 0
+
+    def qsize(self):
+        return self.depth
+
+
+class StubCoordinator:
+    """ records the workers added and retired by the autoscaler """
+    def __init__(self, num_workers, max_workers, queue_capacity=4):
+        self.num_workers = num_workers
+        self.max_workers = max_workers
+        self.queue_capacity = queue_capacity
+        self.queue = StubQueue()
+
+    def add_worker(self):
+        self.num_workers += 1
+        return self.num_workers - 1
+
+    def retire_worker(self):
+        self.num_workers -= 1
+        return self.num_workers
+
+
+class AutoscalerTest(unittest.TestCase):
+    """ tests the 'Autoscaler' class """
+    def setUp(self):
+        self.now = 0.0
+        patcher = mock.patch('a2c.autoscaler.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.coordinator = StubCoordinator(num_workers=2, max_workers=4)
+        self.autoscaler = Autoscaler(self.coordinator, min_workers=1, max_workers=8, interval=5)
+
+    def window(self, num_put, depth, step_time=0.1, seconds=1.0, waited=False):
+        """ feeds the autoscaler one interval of learner steps, during which the
+        workers put `num_put` roll-outs and after which the queue holds `depth`
+        :return: the autoscaler's decision at the end of the interval
+        """
+        decisions = []
+        for _ in range(self.autoscaler.interval):
+            self.now += seconds / self.autoscaler.interval
+            self.coordinator.queue.num_put += num_put / self.autoscaler.interval
+            self.coordinator.queue.depth = depth
+            decisions.append(self.autoscaler.update(step_time, waited=waited))
+        self.assertEqual(decisions[:-1], [None] * (self.autoscaler.interval - 1))
+        return decisions[-1]
+
+    def test_max_workers_bounded_by_coordinator(self):
+        self.assertEqual(self.autoscaler.max_workers, 4)
+
+    def test_grows_when_starved(self):
+        # the learner could take 10 roll-outs/s, but the workers only make 5
+        self.assertEqual(self.window(num_put=5, depth=0, waited=True), 1)
+        self.assertEqual(self.coordinator.num_workers, 3)
+        stats = self.autoscaler.stats
+        self.assertAlmostEqual(stats['production_rate'], 5)
+        self.assertAlmostEqual(stats['consumption_rate'], 10)
+        self.assertEqual(stats['starved'], 1)
+
+        # up to the coordinator's limit
+        self.assertEqual(self.window(num_put=5, depth=0), 1)
+        self.assertEqual(self.window(num_put=5, depth=0), 0)
+        self.assertEqual(self.coordinator.num_workers, 4)
+
+    def test_no_growth_with_data_waiting(self):
+        """ the workers are slower than the learner but the queue isn't empty yet """
+        self.assertEqual(self.window(num_put=5, depth=2), 0)
+        self.assertEqual(self.coordinator.num_workers, 2)
+
+    def test_shrinks_when_too_fast(self):
+        self.assertEqual(self.window(num_put=20, depth=1), -1)
+        self.assertEqual(self.coordinator.num_workers, 1)
+
+        # but not below the minimum
+        self.assertEqual(self.window(num_put=20, depth=1), 0)
+        self.assertEqual(self.coordinator.num_workers, 1)
+
+    def test_shrinks_when_queue_full(self):
+        """ production within tolerance, but the learner can't keep up with the backlog """
+        self.assertEqual(self.window(num_put=10, depth=4), -1)
+        self.assertEqual(self.coordinator.num_workers, 1)
+
+    def test_steady_within_tolerance(self):
+        self.assertEqual(self.window(num_put=10.5, depth=0), 0)
+        self.assertEqual(self.window(num_put=9.5, depth=1), 0)
+        self.assertEqual(self.coordinator.num_workers, 2)
+
+    def test_worker_not_ready(self):
+        """ a retired worker that hasn't exited yet keeps its slot """
+        self.coordinator.add_worker = lambda: None
+        self.assertEqual(self.window(num_put=5, depth=0), 0)
+        self.assertEqual(self.coordinator.num_workers, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+File: checkpoint_test
+"""
+
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from utils.checkpoint import CheckpointWriter, list_checkpoints, latest_checkpoint, load_checkpoint
+
+
+class CheckpointWriterTest(unittest.TestCase):
+    """ tests the 'CheckpointWriter' class """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_round_trip(self):
+        weights = [np.random.randn(3, 4), np.random.randn(4)]
+        with CheckpointWriter(self.directory) as writer:
+            writer.save(7, {'step': 7, 'weights': weights})
+
+        state = load_checkpoint(latest_checkpoint(self.directory))
+        self.assertEqual(state['step'], 7)
+        for saved, original in zip(state['weights'], weights):
+            np.testing.assert_array_equal(saved, original)
+
+    def test_keeps_latest(self):
+        with CheckpointWriter(self.directory, keep=2) as writer:
+            for step in range(5):
+                writer.save(step, {'step': step})
+                writer.wait()
+
+        checkpoints = list_checkpoints(self.directory)
+        self.assertEqual([load_checkpoint(path)['step'] for path in checkpoints], [3, 4])
+        self.assertFalse([name for name in os.listdir(self.directory) if name.endswith(".tmp")])
+
+    def test_keep_all(self):
+        with CheckpointWriter(self.directory, keep=0) as writer:
+            for step in range(4):
+                writer.save(step, {'step': step})
+                writer.wait()
+
+        self.assertEqual(len(list_checkpoints(self.directory)), 4)
+
+    def test_no_checkpoints(self):
+        self.assertIsNone(latest_checkpoint(self.directory))
+        self.assertIsNone(latest_checkpoint(os.path.join(self.directory, "missing")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+File: coordinator_test
+"""
+
+import os
+import unittest
+from functools import partial
+
+from a2c.coordinator import Coordinator, MultiEnvironment
+
+
+class StubEnvironment:
+    """ a multi-agent environment whose observations say which process it
+    runs in and the action that each agent took. An agent is done once it
+    takes a negative action, and stepping the environment after all of its
+    agents are done is an error """
+    observation_space = (2, )
+    action_space = (1, )
+
+    def __init__(self, num_agents):
+        self.num_agents = num_agents
+        self.num_steps = 0
+        self.done = False
+
+    def reset(self):
+        self.num_steps = 0
+        self.done = False
+        return [(os.getpid(), 0)] * self.num_agents
+
+    def step(self, actions):
+        if self.done:
+            raise RuntimeError("Stepped a finished environment")
+        self.num_steps += 1
+        dones = [action < 0 for action in actions]
+        self.done = all(dones)
+        observations = [(os.getpid(), action) for action in actions]
+        return observations, [float(action) for action in actions], dones, {'steps': self.num_steps}
+
+
+class MultiEnvironmentTest(unittest.TestCase):
+    """ tests the 'MultiEnvironment' class """
+    def setUp(self):
+        self.coordinator = Coordinator(partial(StubEnvironment, 2), 3)
+        self.coordinator.open()
+        self.addCleanup(self.coordinator.close)
+        self.env = MultiEnvironment(self.coordinator, 2)
+        self.pids = [pid for worker in self.coordinator.workers for pid in (worker.pid, ) * 2]
+
+    def test_reset(self):
+        self.assertEqual(self.env.num_agents, 6)
+        self.assertEqual(self.env.reset(), [(pid, 0) for pid in self.pids])
+        self.assertEqual(self.env.observation_space, (2, ))
+
+    def test_step_in_order(self):
+        """ each agent's action goes to its own environment, and the results come back in the same order """
+        self.env.reset()
+        actions = list(range(6))
+        obs, rewards, dones, infos = self.env.step(actions)
+        self.assertEqual(obs, list(zip(self.pids, actions)))
+        self.assertEqual(rewards, [float(a) for a in actions])
+        self.assertEqual(dones, [False] * 6)
+        self.assertEqual(infos, [{'steps': 1}] * 3)
+
+    def test_finished_environment_not_stepped(self):
+        self.env.reset()
+        obs, _, dones, _ = self.env.step([1, 2, -3, -4, 5, -6])
+        self.assertEqual(dones, [False, False, True, True, False, True])
+        last = obs[2:4]
+
+        # the second environment is left alone, its agents repeating their last observation
+        obs, rewards, dones, infos = self.env.step([7, 8, 9, 10, 11, 12])
+        self.assertEqual(obs, [(self.pids[0], 7), (self.pids[1], 8)] + last +
+                         [(self.pids[4], 11), (self.pids[5], 12)])
+        self.assertEqual(rewards, [7, 8, 0, 0, 11, 12])
+        self.assertEqual(dones, [False, False, True, True, False, False])
+        self.assertEqual(infos, [{'steps': 2}, None, {'steps': 2}])
+
+        # until the next reset
+        self.env.reset()
+        _, _, dones, infos = self.env.step([1] * 6)
+        self.assertEqual(dones, [False] * 6)
+        self.assertEqual(infos, [{'steps': 1}] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+"""
+File: dqn_training_test
+"""
+
+import unittest
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from dqn import HyperParameters
+from dqn.training import Trainer
+from dqn.replay_memory import Transition
+from dqn.vector_env import VectorEnvironment
+
+STATE_SHAPE = (2, 3)
+
+
+class StubEnvironment:
+    """ an environment whose episodes are `length` steps long, which
+    records the number of steps in each of its episodes """
+    def __init__(self, length):
+        self.length = length
+        self.episode_steps = []
+        self.renders = 0
+
+    def reset(self):
+        self.episode_steps.append(0)
+        return self.observation()
+
+    def step(self, action):
+        if self.episode_steps[-1] >= self.length:
+            raise RuntimeError("Stepped past the end of the episode")
+        self.episode_steps[-1] += 1
+        done = self.episode_steps[-1] == self.length
+        return self.observation(), 1.0, done, {}
+
+    def observation(self):
+        return np.random.randn(*STATE_SHAPE)
+
+    def render(self):
+        self.renders += 1
+
+    def close(self):
+        pass
+
+
+class CountingEnvironment(StubEnvironment):
+    """ a StubEnvironment whose observations count its steps, so
+    that they don't depend on the random state """
+    def observation(self):
+        return np.full(STATE_SHAPE, sum(self.episode_steps), dtype=float)
+
+
+class PipelinedEnvironment(CountingEnvironment):
+    """ a CountingEnvironment with the step interface of a RemoteEnvironment """
+    def __init__(self, length):
+        super(PipelinedEnvironment, self).__init__(length)
+        self._action = None
+
+    def step_async(self, action):
+        self._action = action
+
+    def step_wait(self):
+        return self.step(self._action)
+
+
+class LinearQ(nn.Module):
+    def __init__(self, num_actions):
+        super(LinearQ, self).__init__()
+        self.fc = nn.Linear(int(np.prod(STATE_SHAPE)), num_actions)
+        self.device = "cpu"
+
+    def forward(self, x):
+        return self.fc(x.reshape(x.shape[0], -1))
+
+
+def make_trainer(env, **hyperams):
+    hp = HyperParameters()
+    hp.replay_memory_capacity = 1000
+    hp.batch_size = 8
+    for name, value in hyperams.items():
+        setattr(hp, name, value)
+    num_actions = int(np.prod(hp.action_shape))
+    return Trainer(env, LinearQ(num_actions), LinearQ(num_actions), hp)
+
+
+def fill(memory):
+    """ fills a replay memory with transitions of a single episode """
+    state = np.random.randn(*STATE_SHAPE)
+    for i in range(memory.capacity):
+        next_state = np.random.randn(*STATE_SHAPE)
+        memory.push(1.0, Transition(state, 0, next_state, 0.0), continues=i > 0)
+        state = next_state
+
+
+class TrainVectorizedTest(unittest.TestCase):
+    """ tests training on several environments stepped together """
+    def setUp(self):
+        np.random.seed(10)
+        torch.manual_seed(10)
+
+    def test_episode_accounting(self):
+        envs = [StubEnvironment(length) for length in (3, 5, 7)]
+        trainer = make_trainer(VectorEnvironment(envs), priority_init_batch=4)
+        trainer.train_vectorized(10)
+
+        # every episode ran to its end before its environment was reset
+        finished = sum(len([n for n in env.episode_steps if n == env.length]) for env in envs)
+        for env in envs:
+            self.assertTrue(all(n == env.length for n in env.episode_steps[:-1]))
+        self.assertEqual(trainer.episodes, finished)
+        self.assertGreaterEqual(finished, 10)
+        self.assertEqual(trainer.time_steps, sum(sum(env.episode_steps) for env in envs))
+
+        # the first step of each episode has no state to make a transition from
+        transitions = sum(n - 1 for env in envs for n in env.episode_steps if n > 0)
+        memory = trainer.replay_memory
+        priorities = memory.tree.tree[memory.tree.num_leaves - 1:][:memory.capacity]
+        self.assertEqual(np.count_nonzero(priorities), transitions)
+        self.assertEqual(trainer.gradient_steps, 0)  # the replay memory isn't full
+
+    def test_gradient_step_per_lean_freq(self):
+        envs = [StubEnvironment(5) for _ in range(4)]
+        trainer = make_trainer(VectorEnvironment(envs), replay_memory_capacity=32, lean_freq=6)
+        fill(trainer.replay_memory)
+        trainer.train_vectorized(4)
+
+        # the four episodes take five ticks of four steps each
+        self.assertEqual(trainer.time_steps, 20)
+        self.assertEqual(trainer.gradient_steps, 20 // 6)
+
+
+class TrainEpisodeTest(unittest.TestCase):
+    """ tests overlapping the environment's steps with training """
+    def train_episode(self, env):
+        trainer = make_trainer(env, replay_memory_capacity=64, lean_freq=2, episode_length=20)
+        fill(trainer.replay_memory)
+        trainer.train_episode()
+        return trainer
+
+    def test_pipelined_matches_serial(self):
+        serial_env = CountingEnvironment(15)
+        serial = self.train_episode(serial_env)
+        pipelined_env = PipelinedEnvironment(15)
+        pipelined = self.train_episode(pipelined_env)
+
+        self.assertEqual(serial.time_steps, pipelined.time_steps)
+        self.assertEqual(serial.gradient_steps, pipelined.gradient_steps)
+        self.assertGreater(pipelined.gradient_steps, 0)
+        self.assertEqual((serial_env.renders, pipelined_env.renders), (15, 15))
+
+        slots = np.arange(64)
+        for serial_field, pipelined_field in zip(serial.replay_memory.gather(slots),
+                                                 pipelined.replay_memory.gather(slots)):
+            np.testing.assert_array_equal(serial_field, pipelined_field)
+
+
+class ChooseActionsTest(unittest.TestCase):
+    """ tests choosing actions for several states at once """
+    def setUp(self):
+        np.random.seed(10)
+        torch.manual_seed(10)
+        self.trainer = make_trainer(None, action_shape=(4, 2, 1), epsilon_base=0, epsilon_end=0)
+
+    def test_greedy(self):
+        features = [np.random.randn(*STATE_SHAPE) for _ in range(6)]
+        actions = self.trainer.choose_actions(features)
+        self.assertEqual(actions.shape, (6, ))
+
+        with torch.no_grad():
+            q_values = self.trainer.q(torch.from_numpy(np.stack(features)).float())
+        np.testing.assert_array_equal(actions, torch.argmax(q_values, dim=1).numpy())
+        self.assertEqual(actions.tolist(), [self.trainer.choose_action(f) for f in features])
+
+    def test_without_state(self):
+        """ states that aren't known yet get random actions """
+        features = [None, np.random.randn(*STATE_SHAPE), None]
+        actions = self.trainer.choose_actions(features)
+        self.assertEqual(actions.shape, (3, ))
+        self.assertTrue(np.all((0 <= actions) & (actions < self.trainer.num_actions)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+File: evaluation_test
+"""
+
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from a2c.evaluation import AsyncEvaluator, load_best_weights
+from a2c.hyperparameters import GridEnvHyperparameters
+
+
+class StubEnvironment:
+    """ a multi-agent environment which rewards each agent with its action,
+    and which is slow enough to tell whether its episodes block the caller """
+    def __init__(self, num_agents, step_time):
+        self.num_agents = num_agents
+        self.step_time = step_time
+
+    def reset(self):
+        return [np.zeros(2)] * self.num_agents
+
+    def step(self, actions):
+        time.sleep(self.step_time)
+        return [np.zeros(2)] * self.num_agents, [float(a) for a in actions], [False] * self.num_agents, {}
+
+
+class StubModel:
+    def __init__(self):
+        self.weights = [np.zeros(1)]
+
+    def get_weights(self):
+        return self.weights
+
+    def set_weights(self, weights):
+        self.weights = weights
+
+
+class StubPolicy:
+    """ takes the action given by the model's weights """
+    def __init__(self, model):
+        self.model = model
+        self.version = None
+
+    def reset(self):
+        pass
+
+    def __call__(self, observations):
+        n = len(observations)
+        actions = np.full(n, self.model.weights[0][0])
+        return actions, np.zeros(n), np.zeros((n, 2))
+
+
+def make_stub_policy(hyperams, observation_shape):
+    model = StubModel()
+    return model, StubPolicy(model)
+
+
+class AsyncEvaluatorTest(unittest.TestCase):
+    """ tests the 'AsyncEvaluator' class """
+    def setUp(self):
+        self.hyperams = GridEnvHyperparameters()
+        self.hyperams.eval_workers = 1
+        self.hyperams.eval_agents = 2
+        self.hyperams.eval_episodes = 2
+        self.hyperams.episode_length = 5
+        self.best_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.best_directory)
+
+    def make_evaluator(self, step_time):
+        return AsyncEvaluator(lambda: StubEnvironment(self.hyperams.eval_agents, step_time), float,
+                              self.hyperams, (2, ), best_directory=self.best_directory,
+                              make_policy=make_stub_policy)
+
+    def wait_for_results(self, evaluator, count):
+        finished = []
+        deadline = time.time() + 30
+        while len(finished) < count and time.time() < deadline:
+            finished.extend(evaluator.poll())
+            time.sleep(0.01)
+        return finished
+
+    def test_evaluates_in_background(self):
+        with self.make_evaluator(step_time=0.05) as evaluator:
+            # an evaluation takes at least half a second, but submitting it doesn't
+            start = time.time()
+            self.assertTrue(evaluator.submit(3, [np.array([2.0])]))
+            self.assertLess(time.time() - start, 0.2)
+            self.assertEqual(evaluator.poll(), [])
+
+            # the only evaluation process is busy, so the next snapshot is skipped
+            self.assertFalse(evaluator.submit(4, [np.array([5.0])]))
+            (episode, metrics), = self.wait_for_results(evaluator, 1)
+            self.assertEqual((episode, metrics['return']), (3, 10))
+
+    def test_results_for_submitted_weights(self):
+        with self.make_evaluator(step_time=0) as evaluator:
+            evaluator.submit(1, [np.array([1.0])])
+            (episode, metrics), = self.wait_for_results(evaluator, 1)
+            self.assertEqual(episode, 1)
+            self.assertEqual(metrics['return'], 5)
+
+            evaluator.submit(2, [np.array([3.0])])
+            (episode, metrics), = self.wait_for_results(evaluator, 1)
+            self.assertEqual((episode, metrics['return']), (2, 15))
+
+            evaluator.submit(3, [np.array([2.0])])
+            self.wait_for_results(evaluator, 1)
+
+        self.assertEqual((evaluator.best_episode, evaluator.best_return), (2, 15))
+        weights, episode = load_best_weights(self.best_directory)
+        self.assertEqual(episode, 2)
+        np.testing.assert_array_equal(weights[0], [3.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+File: hogwild_test
+"""
+
+import unittest
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+from dqn import HyperParameters
+from dqn.hogwild import Hogwild, HogwildWorker
+from dqn.training import Trainer
+
+
+def make_networks(device="cpu"):
+    q, target_q = nn.Linear(3, 4).to(device), nn.Linear(3, 4).to(device)
+    q.device = target_q.device = device
+    return q, target_q
+
+
+def failing_env():
+    raise RuntimeError("No environment")
+
+
+class HogwildWorkerTest(unittest.TestCase):
+    def test_shared_target_sync(self):
+        """ the target network is updated by the gradient step that takes the
+        count of every worker's steps to a multiple of `target_update_freq` """
+        hyperams = HyperParameters()
+        hyperams.hogwild_workers = 2
+        hyperams.target_update_freq = 4
+        q, target_q = make_networks()
+        global_steps = mp.Value('l', 2)
+        worker = HogwildWorker(0, None, q, target_q, hyperams, global_steps)
+        worker.train_step = lambda: None
+
+        worker.gradient_step()
+        self.assertEqual(worker.num_target_updates, 0)
+        self.assertFalse(torch.equal(target_q.weight, q.weight))
+
+        global_steps.value += 3  # steps taken by the other worker
+        worker.gradient_step()
+        self.assertEqual(global_steps.value, 7)
+        self.assertEqual(worker.num_target_updates, 0)
+        worker.gradient_step()
+        self.assertEqual(worker.gradient_steps, 3)
+        self.assertEqual(worker.num_target_updates, 1)
+        self.assertTrue(torch.equal(target_q.weight, q.weight))
+
+    def test_epsilon(self):
+        hyperams = HyperParameters()
+        hyperams.hogwild_workers = 1
+        q, target_q = make_networks()
+        global_steps = mp.Value('l', 0)
+        worker = HogwildWorker(0, None, q, target_q, hyperams, global_steps)
+        self.assertAlmostEqual(worker.epsilon, hyperams.epsilon_base)
+        global_steps.value = 500
+        np.testing.assert_allclose(worker.epsilon, (hyperams.epsilon_base + hyperams.epsilon_end) / 2)
+
+
+class HogwildTest(unittest.TestCase):
+    def test_dead_workers(self):
+        """ training fails if a worker fails, rather than finishing without its episodes """
+        hyperams = HyperParameters()
+        hyperams.hogwild_workers = 2
+        q, target_q = make_networks()
+        hogwild = Hogwild(Trainer(None, q, target_q, hyperams), failing_env)
+        with self.assertRaises(RuntimeError):
+            hogwild.train(num_episodes=4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+"""
+File: inference_server_test
+"""
+
+import time
+import unittest
+import threading
+import numpy as np
+
+from a2c.hyperparameters import HyperParameters
+from a2c.inference_server import InferenceServer
+from a2c.parameter_server import SharedWeights
+
+OBSERVATION_SHAPE = (3, )
+
+
+class StubModel:
+    """ a model with a single weight, which it adds to the observations """
+    def __init__(self):
+        self.weights = [np.zeros(1, dtype=np.float32)]
+
+    def get_weights(self):
+        return self.weights
+
+    def set_weights(self, weights):
+        self.weights = weights
+
+
+def make_stub_policy(hyperams, observation_shape):
+    model = StubModel()
+
+    def policy(observations):
+        sums = observations.sum(axis=1) + model.weights[0][0]
+        return sums, 2 * sums, np.stack([sums, -sums], axis=1)
+
+    return model, policy
+
+
+class InferenceServerTest(unittest.TestCase):
+    """ tests the 'InferenceServer' class """
+    def setUp(self):
+        self.shared_weights = SharedWeights()
+        self.shared_weights.publish(StubModel().get_weights())
+        self.addCleanup(self.shared_weights.close)
+
+    def make_server(self, num_clients, batch_size, max_wait):
+        hyperams = HyperParameters()
+        hyperams.inference_batch_size = batch_size
+        hyperams.inference_max_wait = max_wait
+        return InferenceServer(num_clients, self.shared_weights, OBSERVATION_SHAPE, hyperams,
+                               make_policy=make_stub_policy)
+
+    def request_concurrently(self, server, observations):
+        """ each client sends its own observations at the same time
+        :return: the replies to each client, and how long it took to get them all
+        """
+        replies = [None] * len(observations)
+
+        def request(cid):
+            replies[cid] = server.client(cid)(observations[cid])
+
+        threads = [threading.Thread(target=request, args=(cid, )) for cid in range(len(observations))]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=30)
+        return replies, time.time() - start
+
+    def test_clients_answered_from_one_batch(self):
+        observations = [np.full((2, ) + OBSERVATION_SHAPE, cid, dtype=np.float32) for cid in range(3)]
+        with self.make_server(3, batch_size=6, max_wait=10) as server:
+            replies, _ = self.request_concurrently(server, observations)
+        self.assertEqual(server.stats()['mean_batch_size'], 6)  # counted after the replies are sent
+
+        # each client got the answers for its own observations
+        for cid, (actions, values, logits) in enumerate(replies):
+            np.testing.assert_array_equal(actions, [3 * cid, 3 * cid])
+            np.testing.assert_array_equal(values, [6 * cid, 6 * cid])
+            self.assertEqual(logits.shape, (2, 2))
+
+    def test_full_batch_flushed(self):
+        """ the server doesn't wait any longer once it has enough observations """
+        observations = [np.ones((1, ) + OBSERVATION_SHAPE, dtype=np.float32) for _ in range(2)]
+        with self.make_server(2, batch_size=2, max_wait=10) as server:
+            _, seconds = self.request_concurrently(server, observations)
+        self.assertEqual(server.stats()['observations'], 2)
+        self.assertLess(seconds, 5)
+
+    def test_timeout_flush(self):
+        """ a lone request is answered once the server has waited for others for long enough """
+        with self.make_server(2, batch_size=100, max_wait=0.2) as server:
+            client = server.client(0)
+            start = time.time()
+            actions, _, _ = client(np.ones((1, ) + OBSERVATION_SHAPE, dtype=np.float32))
+            seconds = time.time() - start
+            self.assertEqual(client.version, 1)
+        np.testing.assert_array_equal(actions, [3])
+        self.assertGreaterEqual(seconds, 0.2)
+        self.assertLess(seconds, 5)
+
+    def test_latest_weights(self):
+        with self.make_server(1, batch_size=1, max_wait=0) as server:
+            client = server.client(0)
+            observation = np.zeros((1, ) + OBSERVATION_SHAPE, dtype=np.float32)
+            client(observation)
+            self.shared_weights.publish([np.array([5], dtype=np.float32)])
+            client.reset()
+            actions, _, _ = client(observation)
+            self.assertEqual((client.version, actions[0]), (2, 5))
+
+    def test_shutdown(self):
+        """ closing stops the server without having to terminate it """
+        server = self.make_server(1, batch_size=4, max_wait=0.01)
+        server.open()
+        server.client(0)(np.zeros((1, ) + OBSERVATION_SHAPE, dtype=np.float32))
+        start = time.time()
+        server.close()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(server._process.exitcode, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+File: parameter_server_test
+"""
+
+import unittest
+import numpy as np
+from multiprocessing import Process, Queue
+from multiprocessing.shared_memory import SharedMemory
+
+from a2c.parameter_server import SharedWeights
+
+SHAPES = [(3, 2), (2, )]
+
+
+class StubModel:
+    """ holds a list of weights, like a Keras model """
+    def __init__(self, value=0.0):
+        self.weights = [np.full(shape, value, dtype=np.float32) for shape in SHAPES]
+        self.num_set = 0
+
+    def get_weights(self):
+        return self.weights
+
+    def set_weights(self, weights):
+        self.weights = weights
+        self.num_set += 1
+
+
+def pull_target(shared_weights, versions, results):
+    """ pulls the weights into a model once for each of the given versions """
+    model = StubModel()
+    pulls = []
+    for version in versions:
+        new_version = shared_weights.pull(model, version)
+        pulls.append((new_version, model.num_set, [w.tolist() for w in model.get_weights()]))
+    results.put(pulls)
+    shared_weights.close()
+
+
+def publish_target(shared_weights, value, results):
+    results.put(shared_weights.publish(StubModel(value).get_weights()))
+    shared_weights.close()
+
+
+def run(target, args):
+    results = Queue()
+    process = Process(target=target, args=args + (results, ))
+    process.start()
+    output = results.get(timeout=30)
+    process.join()
+    return output
+
+
+class SharedWeightsTest(unittest.TestCase):
+    """ tests the 'SharedWeights' class """
+    def test_pull_from_another_process(self):
+        with SharedWeights() as shared_weights:
+            self.assertEqual(shared_weights.version, 0)
+            weights = [np.arange(6, dtype=np.float32).reshape(3, 2), np.array([6, 7], dtype=np.float32)]
+            self.assertEqual(shared_weights.publish(weights), 1)
+
+            # the worker is at version 0, then has the latest weights
+            outputs = run(pull_target, (shared_weights, [0, 1]))
+            self.assertEqual(len(outputs), 2)
+            version, num_set, pulled = outputs[0]
+            self.assertEqual((version, num_set), (1, 1))
+            self.assertEqual(pulled, [w.tolist() for w in weights])
+
+            # so the second pull leaves its model alone
+            version, num_set, _ = outputs[1]
+            self.assertEqual((version, num_set), (1, 1))
+
+    def test_publish_from_another_process(self):
+        """ the segment is created in the process that publishes first,
+        and later publishes from any process bump the version """
+        with SharedWeights() as shared_weights:
+            shared_weights.publish(StubModel(1).get_weights())
+            self.assertEqual(run(publish_target, (shared_weights, 2.0)), 2)
+            self.assertEqual(shared_weights.version, 2)
+
+            model = StubModel()
+            self.assertEqual(shared_weights.pull(model, 1), 2)
+            self.assertTrue(all(np.all(w == 2) for w in model.get_weights()))
+
+    def test_size_mismatch(self):
+        with SharedWeights() as shared_weights:
+            shared_weights.publish(StubModel().get_weights())
+            with self.assertRaises(ValueError):
+                shared_weights.publish([np.zeros(3)])
+
+    def test_context_manager_cleanup(self):
+        """ workers' closing doesn't destroy the segment, but the owner's does """
+        with SharedWeights() as shared_weights:
+            shared_weights.publish(StubModel(1).get_weights())
+            name = shared_weights._name.value.decode()
+            run(pull_target, (shared_weights, [0]))
+
+            segment = SharedMemory(name=name)  # still there after the worker has closed it
+            segment.close()
+
+        self.assertIsNone(shared_weights._shm)
+        with self.assertRaises(FileNotFoundError):
+            SharedMemory(name=name)
+        shared_weights.close()  # closing twice is harmless
+
+
+if __name__ == "__main__":
+    unittest.main()
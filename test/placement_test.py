@@ -0,0 +1,68 @@
+"""
+File: placement_test
+"""
+
+import os
+import unittest
+from multiprocessing import Process, Queue
+
+from a2c.placement import PlacementPolicy, THREAD_VARIABLES, placed_target
+
+VARIABLES = ["TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"] + THREAD_VARIABLES
+
+
+def report_target(results):
+    """ reports where the calling process was placed """
+    results.put((sorted(os.sched_getaffinity(0)), {name: os.environ.get(name) for name in VARIABLES}))
+
+
+def run_placed(placement, wid):
+    """ runs a worker process placed by the given policy
+    :return: the worker's cores and thread variables
+    """
+    results = Queue()
+    process = Process(target=placed_target, args=(placement, wid, report_target, results))
+    process.start()
+    placed = results.get(timeout=30)
+    process.join()
+    return placed
+
+
+class PlacementPolicyTest(unittest.TestCase):
+    """ tests the 'PlacementPolicy' class """
+    def test_assignment(self):
+        placement = PlacementPolicy(learner_cores=2, worker_threads=2, cores=range(10, 18),
+                                    num_learners=2, server_cores=1)
+        self.assertEqual(placement.learner_cores(0), [10, 11])
+        self.assertEqual(placement.learner_cores(1), [12, 13])
+        self.assertEqual(placement.server_cores(), [14])
+
+        # the workers' cores are disjoint until they run out, then wrap around
+        self.assertEqual([placement.worker_cores(wid) for wid in range(4)],
+                         [[15, 16], [15, 17], [16, 17], [15, 16]])
+        self.assertEqual(placement.learner_threads, 2)
+
+    def test_too_few_cores(self):
+        """ with nothing left over the server and workers share the learner's cores """
+        with self.assertLogs("root", level="WARNING"):
+            placement = PlacementPolicy(learner_cores=2, worker_threads=4, cores=[0, 1], server_cores=1)
+        self.assertEqual(placement.server_cores(), [0, 1])
+        self.assertEqual(placement.worker_cores(0), [0, 1])
+        self.assertEqual(placement.worker_cores(1), [0, 1])
+
+    @unittest.skipUnless(hasattr(os, "sched_setaffinity"), "requires sched_setaffinity")
+    def test_apply_worker(self):
+        cores = sorted(os.sched_getaffinity(0))
+        placement = PlacementPolicy(learner_cores=1, worker_threads=3, cores=cores)
+        worker_cores, variables = run_placed(placement, 1)
+        self.assertEqual(worker_cores, placement.worker_cores(1))
+        self.assertEqual(variables["TF_NUM_INTEROP_THREADS"], "1")
+        for name in ["TF_NUM_INTRAOP_THREADS"] + THREAD_VARIABLES:
+            self.assertEqual(variables[name], "3", name)
+
+        # the parent process is left alone
+        self.assertEqual(sorted(os.sched_getaffinity(0)), cores)
+
+
+if __name__ == "__main__":
+    unittest.main()
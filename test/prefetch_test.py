@@ -0,0 +1,87 @@
+"""
+File: prefetch_test
+"""
+
+import time
+import queue
+import unittest
+
+from a2c.prefetch import Prefetcher
+from a2c.async_coordinator import AsyncCoordinator
+
+
+def put_versions(wid, rollout_queue, signal, versions):
+    signal.wait()
+    for version in versions:
+        rollout_queue.put((version, version))
+
+
+class PrefetcherTest(unittest.TestCase):
+    """ tests the 'Prefetcher' class """
+    def test_items_in_order(self):
+        items = iter(range(10))
+        with Prefetcher(lambda: next(items), depth=2) as prefetcher:
+            self.assertEqual([prefetcher.get() for _ in range(5)], list(range(5)))
+
+    def test_stop_with_items_waiting(self):
+        """ the thread exits even though the consumer stopped taking items """
+        prefetcher = Prefetcher(lambda: 0, depth=2)
+        prefetcher.start()
+        prefetcher.get()
+        thread = prefetcher._thread
+        prefetcher.stop()
+        self.assertFalse(thread.is_alive())
+
+    def test_stop_while_fetching(self):
+        """ a fetch which times out lets the thread notice that it's been stopped """
+        def fetch():
+            time.sleep(0.01)
+            raise queue.Empty
+
+        prefetcher = Prefetcher(lambda data: data, fetch=fetch)
+        prefetcher.start()
+        thread = prefetcher._thread
+        prefetcher.stop()
+        self.assertFalse(thread.is_alive())
+
+    def test_fetch_from_coordinator(self):
+        """ prefetches roll-outs popped from a coordinator, then stops while waiting for more """
+        coordinator = AsyncCoordinator(1, put_versions, ([0, 1, 2], ))
+        with coordinator:
+            coordinator.start()
+
+            def fetch():
+                return coordinator.pop(2, timeout=Prefetcher.poll_interval)
+
+            prefetcher = Prefetcher(lambda popped: popped[1], fetch=fetch)
+            prefetcher.start()
+            self.assertEqual([prefetcher.get() for _ in range(3)], [0, 1, 2])
+            thread = prefetcher._thread
+            prefetcher.stop()
+            self.assertFalse(thread.is_alive())
+
+    def test_prepare_time_per_item_prepared(self):
+        def prepare():
+            time.sleep(0.01)
+            return 0
+
+        prefetcher = Prefetcher(prepare, depth=3)
+        prefetcher.start()
+        prefetcher.get()
+        time.sleep(0.1)  # the thread prepares more items than are consumed
+        prefetcher.stop()
+
+        self.assertGreater(prefetcher.num_prepared, prefetcher.num_items)
+        self.assertLess(prefetcher.stats()['prepare_time'], 0.05)
+
+    def test_error(self):
+        def prepare():
+            raise ValueError()
+
+        with Prefetcher(prepare) as prefetcher:
+            with self.assertRaises(ValueError):
+                prefetcher.get()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,258 @@
+"""
+File: replay_memory_test
+"""
+
+import os
+import numpy as np
+import tempfile
+import unittest
+
+from dqn.replay_memory import SumTree, ReplayMemory, Transition
+from dqn.replay_storage import make_frame_store
+from dqn.staging import BatchStaging
+
+
+def retrieve(tree, idx, s):
+    """ reference recursive descent to the leaf at which `s` falls """
+    left = 2 * idx + 1
+    if left >= len(tree):
+        return idx
+    if s <= tree[left]:
+        return retrieve(tree, left, s)
+    return retrieve(tree, left + 1, s - tree[left])
+
+
+class SumTreeTest(unittest.TestCase):
+    """ tests the 'SumTree' class """
+    def setUp(self):
+        np.random.seed(10)
+        # not a power of two, so that the tree has spare leaves
+        self.capacity = 37
+        self.tree = SumTree(self.capacity)
+        self.priorities = np.random.uniform(0.1, 2, size=self.capacity)
+        for i, p in enumerate(self.priorities):
+            self.tree.add(p)
+
+    def test_total_and_min(self):
+        self.assertAlmostEqual(self.tree.total(), self.priorities.sum())
+        self.assertEqual(self.tree.min(), self.priorities.min())
+
+    def test_get_batch(self):
+        s = np.random.uniform(0, self.tree.total(), size=100)
+        idxs, priorities, data_idxs = self.tree.get_batch(s)
+
+        # the same leaves as descending the tree one value at a time
+        expected = [retrieve(self.tree.tree, 0, value) for value in s]
+        np.testing.assert_array_equal(idxs, expected)
+        np.testing.assert_array_equal(priorities, self.tree.tree[expected])
+        np.testing.assert_array_equal(self.priorities[data_idxs], priorities)
+
+    def test_update_batch_with_duplicates(self):
+        data_idxs = np.array([3, 20, 3, 36, 0])
+        new_priorities = np.array([5.0, 0.01, 7.0, 1.5, 2.5])
+        self.tree.update_batch(data_idxs + self.tree.num_leaves - 1, new_priorities)
+
+        for i, p in zip(data_idxs, new_priorities):
+            self.priorities[i] = p  # the last priority of a duplicate wins
+        self.assertAlmostEqual(self.tree.total(), self.priorities.sum())
+        self.assertEqual(self.tree.min(), 0.01)
+
+        # every internal node is the sum of its children
+        internal = np.arange(self.tree.num_leaves - 1)
+        np.testing.assert_allclose(self.tree.tree[internal],
+                                   self.tree.tree[2 * internal + 1] + self.tree.tree[2 * internal + 2])
+
+
+class ReplayMemoryTest(unittest.TestCase):
+    """ tests the 'ReplayMemory' class """
+    def test_sample_weights(self):
+        np.random.seed(10)
+        memory = ReplayMemory(50)
+        state = np.random.randn(2, 3)
+        for i in range(50):
+            next_state = np.random.randn(2, 3)
+            memory.push(np.random.uniform(0, 3), Transition(state, i, next_state, 1.0), continues=i > 0)
+            state = next_state
+
+        batch, idxs, is_weight = memory.sample(16)
+        self.assertEqual(len(batch.state), 16)
+        self.assertTrue(np.all(is_weight <= 1 + 1e-9))
+
+        memory.update(idxs, np.zeros(16))
+        self.assertAlmostEqual(memory.tree.min(), memory.e ** memory.a)
+
+    def test_max_priority(self):
+        memory = ReplayMemory(10)
+        state = np.zeros(3)
+        memory.push(None, Transition(state, 0, state, 0.0))
+        self.assertEqual(memory.tree.total(), 1.0)
+
+        memory.update(memory.tree.num_leaves - 1, 4.0)
+        memory.push(None, Transition(state, 1, None, 0.0), continues=True)
+        self.assertEqual(memory.tree.tree[memory.tree.num_leaves], memory.max_priority)
+        self.assertAlmostEqual(memory.max_priority, (4.0 + memory.e) ** memory.a)
+
+    def test_update_overwritten(self):
+        """ priorities of transitions overwritten since they were sampled aren't updated """
+        memory = ReplayMemory(4)
+        state = np.zeros(3)
+        for i in range(4):
+            memory.push(1.0, Transition(state, i, state, 0.0), continues=i > 0)
+        idxs = np.arange(4) + memory.tree.num_leaves - 1
+        generation = memory.generation(idxs)
+
+        memory.push(2.0, Transition(state, 4, state, 0.0), continues=True)  # overwrites the first slot
+        memory.update(idxs, np.full(4, 3.0), generation)
+        priorities = memory.tree.tree[idxs]
+        self.assertAlmostEqual(priorities[0], memory._get_priority(2.0))
+        np.testing.assert_allclose(priorities[1:], memory._get_priority(3.0))
+
+    def test_next_states(self):
+        """ next states are found across episode boundaries and wrap around the ring """
+        np.random.seed(10)
+        memory = ReplayMemory(9)
+        transitions = []
+        for episode_length, terminal in [(3, True), (4, False), (5, True), (2, False)]:
+            state = np.random.randn(4)
+            for t in range(episode_length):
+                next_state = None if terminal and t == episode_length - 1 else np.random.randn(4)
+                transitions.append(Transition(state, t, next_state, float(t)))
+                memory.push(1.0, transitions[-1], continues=t > 0)
+                state = next_state
+
+        # the first truncated episode's last frame took a slot of its own,
+        # so the last 9 slots hold that frame and the last 8 transitions
+        expected = transitions[-8:]
+        data_idxs = np.array([slot for slot in range(memory.capacity) if memory.tree.tree[slot + memory.tree.num_leaves - 1] > 0])
+        batch = memory.gather(data_idxs)
+        self.assertEqual(sorted(batch.action.tolist()), sorted(t.action for t in expected))
+
+        next_states = iter(batch.next_state)
+        for state, action, done in zip(batch.state, batch.action, batch.done):
+            transition = next(t for t in expected if np.allclose(t.state, state))
+            self.assertEqual(action, transition.action)
+            self.assertEqual(done, transition.next_state is None)
+            if not done:
+                np.testing.assert_allclose(next(next_states), transition.next_state, rtol=1e-6)
+
+    def test_explicit_continuation(self):
+        """ a transition starts a new run unless it says it continues, even if its
+        state is the same frame as the last transition's next state """
+        memory = ReplayMemory(10)
+        state = np.zeros(3)
+        memory.push(1.0, Transition(state, 0, state, 0.0))
+        memory.push(1.0, Transition(state, 1, state, 0.0))  # a new episode
+        self.assertEqual(memory.tree.n_entries, 3)
+        self.assertEqual(memory.tree.tree[memory.tree.num_leaves], 0)  # the first one's next state
+
+        memory.push(1.0, Transition(state + 1, 2, None, 0.0), continues=True)
+        self.assertEqual(memory.tree.n_entries, 4)
+        np.testing.assert_array_equal(memory.gather(np.array([2])).next_state, [state + 1])
+
+    def test_gather_into_staging(self):
+        np.random.seed(10)
+        memory = ReplayMemory(12, codec="uint8")
+        state = np.random.randn(2, 3)
+        for i in range(12):
+            next_state = None if i % 5 == 4 else np.random.randn(2, 3)
+            memory.push(1.0, Transition(state, i, next_state, float(i)), continues=i % 5 > 0)
+            state = next_state if next_state is not None else np.random.randn(2, 3)
+
+        staging = BatchStaging(8, (2, 3), "cpu")
+        slots = np.array([4, 0, 9, 4, 11])
+        staged = memory.gather(slots, out=staging.arrays)
+        for expected, gathered in zip(memory.gather(slots), staged):
+            np.testing.assert_array_equal(gathered, expected)
+
+        state_batch, action_batch, reward_batch, non_final_mask, next_state_batch = staging.to_tensor_batch(staged)
+        self.assertEqual(tuple(state_batch.shape), (5, 2, 3))
+        self.assertEqual(non_final_mask.tolist(), [False, True, False, False, True])
+        self.assertEqual(len(next_state_batch), 2)
+
+    def test_resume_from_disk(self):
+        np.random.seed(10)
+        directory = tempfile.mkdtemp()
+        for codec in ["float32", "uint8"]:
+            memory = ReplayMemory(20, codec=codec, directory=directory)
+            state = np.random.randn(2, 3)
+            for i in range(30):
+                next_state = np.random.randn(2, 3)
+                memory.push(np.random.uniform(0, 3), Transition(state, i, next_state, float(i)), continues=i > 0)
+                state = next_state
+            memory.save()
+
+            resumed = ReplayMemory(20, codec=codec, directory=directory, resume=True)
+            self.assertTrue(resumed.full())
+            np.testing.assert_array_equal(resumed.tree.tree, memory.tree.tree)
+
+            slots = np.arange(20)
+            for saved, loaded in zip(memory.gather(slots), resumed.gather(slots)):
+                np.testing.assert_array_equal(saved, loaded)
+
+        with self.assertRaises(ValueError):
+            ReplayMemory(10, codec="uint8", directory=directory, resume=True)
+
+    def test_resume_without_max_priority(self):
+        """ snapshots saved without the highest priority take it from the tree """
+        directory = tempfile.mkdtemp()
+        memory = ReplayMemory(4, directory=directory)
+        state = np.zeros(3)
+        for i, error in enumerate([0.5, 20.0, 3.0]):
+            memory.push(error, Transition(state, i, state, 0.0), continues=i > 0)
+        memory.save()
+
+        path = os.path.join(directory, "tree.npz")
+        snapshot = dict(np.load(path))
+        del snapshot['max_priority']
+        np.savez(path, **snapshot)
+
+        resumed = ReplayMemory(4, directory=directory, resume=True)
+        self.assertAlmostEqual(resumed.max_priority, memory.max_priority)
+
+    def test_resume_after_crash(self):
+        """ slots written after the last save aren't sampled on resuming """
+        directory = tempfile.mkdtemp()
+        memory = ReplayMemory(10, directory=directory)
+        frames = [np.full(2, float(i)) for i in range(16)]
+        for i in range(12):
+            memory.push(1.0, Transition(frames[i], i, frames[i + 1], 0.0), continues=i > 0)
+        memory.save()
+        for i in range(12, 15):  # pushed before a crash, without saving
+            memory.push(1.0, Transition(frames[i], i, frames[i + 1], 0.0), continues=True)
+
+        resumed = ReplayMemory(10, directory=directory, resume=True)
+        self.assertEqual(resumed.tree.n_entries, 10)
+        self.assertTrue(resumed.full())
+        batch, _, _ = resumed.sample(32)
+        self.assertTrue(set(batch.action.tolist()) <= {5, 6, 7, 8, 9, 10, 11})
+        np.testing.assert_array_equal(batch.next_state, batch.state + 1)
+
+
+class FrameStoreTest(unittest.TestCase):
+    """ tests storing frames with each codec """
+    def test_round_trip(self):
+        np.random.seed(10)
+        shape = (3, 16, 16)
+        frames = np.zeros((8,) + shape, dtype=np.float32)
+        frames[:, :, :4] = -1
+        frames[:, :, 8:, 8:] = np.random.randint(0, 4, size=(8, 3, 8, 8))
+        frames[:, 0, 0, 0] = np.random.uniform(1, 50, size=8)
+
+        for codec, tolerance in [("float32", 0), ("float16", 0.02), ("uint8", 0.1), ("zlib", 0)]:
+            store = make_frame_store(codec, len(frames), shape)
+            for slot, frame in enumerate(frames):
+                store[slot] = frame
+
+            slots = np.array([5, 0, 5, 7])
+            loaded = store[slots]
+            self.assertEqual(loaded.dtype, np.float32, codec)
+            np.testing.assert_allclose(loaded, frames[slots], atol=tolerance, err_msg=codec)
+
+    def test_out_of_range(self):
+        store = make_frame_store("float32", 4, (2, ))
+        with self.assertRaises(AssertionError):
+            store.load(np.array([1, 4]), out=np.empty((2, 2), dtype=np.float32))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+File: rollout_slots_test
+"""
+
+import unittest
+import numpy as np
+
+from a2c.rollout import Rollout
+from a2c.rollout_slots import RolloutSlots
+
+
+class RolloutSlotsTest(unittest.TestCase):
+    """ tests that roll-outs recorded into slots match 'Rollout' """
+    def record(self, rollout, steps):
+        for observations, rewards, dones in steps:
+            rollout.record(observations, [0, 1], rewards, [0.5, 0.5], dones, logits=[np.zeros(3)] * 2)
+
+    def test_matches_rollout(self):
+        steps = [([np.full(4, t), np.full(4, -t)], [t, -t], [False, False]) for t in range(3)]
+        slots = RolloutSlots(1, 5, 2, (4, ), 3)
+        slot_rollout = slots.rollout(slots.acquire())
+        rollout = Rollout()
+        self.record(slot_rollout, steps)
+        self.record(rollout, steps)
+
+        for from_slot, expected in zip(slots.as_batch(0), rollout.as_batch()):
+            for agent_slot, agent_expected in zip(from_slot, expected):
+                np.testing.assert_array_equal(agent_slot, agent_expected)
+
+    def test_dead_agents_filtered(self):
+        # the second agent dies after the first step
+        steps = [([np.ones(4), np.full(4, 2)], [1, 2], [False, True]),
+                 ([np.ones(4), None], [3, None], [False, None])]
+        slots = RolloutSlots(1, 5, 2, (4, ), 3)
+        slot_rollout = slots.rollout(slots.acquire())
+        rollout = Rollout()
+        self.record(slot_rollout, steps)
+        self.record(rollout, steps)
+
+        batch, expected = slots.as_batch(0), rollout.as_batch()
+        for field in (0, 2, 4):  # observations, rewards and dones
+            self.assertEqual([len(agent) for agent in batch[field]], [2, 1])
+            for agent_slot, agent_expected in zip(batch[field], expected[field]):
+                np.testing.assert_array_equal(agent_slot, agent_expected)
+        self.assertFalse(np.isnan(np.concatenate(batch[2])).any())
+
+
+if __name__ == "__main__":
+    unittest.main()
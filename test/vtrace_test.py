@@ -0,0 +1,47 @@
+"""
+File: vtrace_test
+"""
+
+import numpy as np
+import unittest
+
+from a2c.losses import vtrace_targets, make_returns
+
+
+class VTraceTest(unittest.TestCase):
+    """ tests the 'vtrace_targets' function """
+    def setUp(self):
+        np.random.seed(10)
+        self.length = 30
+        self.num_actions = 4
+        self.rewards = np.random.randn(self.length)
+        self.values = np.random.randn(self.length)
+        self.actions = np.random.randint(self.num_actions, size=self.length)
+
+    def test_on_policy_returns(self):
+        # when behaviour and target policies match, the targets are the discounted returns
+        logits = np.random.randn(self.length, self.num_actions)
+        gamma = 0.9
+        vs, _ = vtrace_targets(logits, logits, self.actions, self.rewards, self.values, gamma)
+        np.testing.assert_allclose(vs, make_returns(self.rewards, gamma))
+
+    def test_on_policy_advantages(self):
+        logits = np.random.randn(self.length, self.num_actions)
+        gamma = 0.9
+        vs, advantages = vtrace_targets(logits, logits, self.actions, self.rewards, self.values, gamma)
+        np.testing.assert_allclose(advantages, vs - self.values)
+
+    def test_truncated_importance_weights(self):
+        # an action that the target policy prefers much more than the behaviour
+        # policy did should have its importance weight truncated at rho_bar
+        behaviour_logits = np.zeros((self.length, self.num_actions))
+        target_logits = np.zeros((self.length, self.num_actions))
+        target_logits[np.arange(self.length), self.actions] = 10
+
+        _, advantages = vtrace_targets(behaviour_logits, target_logits, self.actions,
+                                       self.rewards, self.values, 0, rho_bar=1.0)
+        np.testing.assert_allclose(advantages, self.rewards - self.values)
+
+
+if __name__ == "__main__":
+    unittest.main()
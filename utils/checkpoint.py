@@ -0,0 +1,143 @@
+"""
+File: checkpoint
+"""
+
+import os
+import re
+import pickle
+import threading
+
+import logging
+logger = logging.getLogger("root")
+
+CHECKPOINT_PATTERN = re.compile(r"checkpoint-(\d+)\.pkl$")
+
+
+class CheckpointWriter:
+    """ writes checkpoints to disk on a background thread.
+
+    The caller snapshots whatever it wants to save (weights, optimizer
+    state, counters...) into an in-memory dictionary and hands it to
+    `save`, which returns immediately. The background thread pickles the
+    snapshot to a temporary file, syncs it to disk and then renames it
+    into place, so that a crash never leaves a partially written
+    checkpoint. Only the `keep` most recent checkpoints are kept. If a
+    snapshot is saved while the previous one is still waiting to be
+    written, the older snapshot is superseded and never written.
+    """
+    def __init__(self, directory, keep=3):
+        """ Construct
+        :param directory: directory in which to write the checkpoints
+        :param keep: number of most recent checkpoints to keep, or 0 to keep all of them
+        """
+        if keep < 0:
+            raise ValueError(f"Can't keep {keep} checkpoints")
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+        self._pending = None  # (step, state) waiting to be written
+        self._writing = False
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, step, state):
+        """ schedules a snapshot to be written, without blocking
+        :param step: the training step of the snapshot, which orders the checkpoints
+        :param state: dictionary to pickle. It must not be modified after being passed
+        here, so it should hold copies of the model's weights, not references to them.
+        """
+        with self._condition:
+            self._raise_error()
+            if self._pending is not None:
+                logger.debug(f"Checkpoint of step {self._pending[0]} superseded by step {step}")
+            self._pending = step, state
+            self._condition.notify_all()
+
+    def wait(self):
+        """ blocks until every saved snapshot has been written """
+        with self._condition:
+            while self._pending is not None or self._writing:
+                self._condition.wait()
+            self._raise_error()
+
+    def close(self):
+        """ writes any remaining snapshot and stops the background thread """
+        self.wait()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                step, state = self._pending
+                self._pending = None
+                self._writing = True
+
+            try:
+                self._write(step, state)
+            except Exception as e:
+                self._error = e
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+    def _write(self, step, state):
+        path = os.path.join(self.directory, f"checkpoint-{step:09d}.pkl")
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        logger.debug(f"Wrote checkpoint: {path}")
+
+        if self.keep > 0:
+            for old in list_checkpoints(self.directory)[:-self.keep]:
+                os.remove(old)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Failed to write checkpoint") from error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def list_checkpoints(directory):
+    """ paths of the checkpoints in a directory, oldest first """
+    if not os.path.isdir(directory):
+        return []
+    steps = []
+    for name in os.listdir(directory):
+        match = CHECKPOINT_PATTERN.match(name)
+        if match:
+            steps.append((int(match.group(1)), os.path.join(directory, name)))
+    return [path for _, path in sorted(steps)]
+
+
+def latest_checkpoint(directory):
+    """ path of the most recent checkpoint in a directory, or None if there are none """
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load_checkpoint(path):
+    """ loads the state saved in a checkpoint """
+    with open(path, "rb") as f:
+        return pickle.load(f)